@@ -0,0 +1,238 @@
+import heapq
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from urllib.request import pathname2url
+
+import runs
+from habit import period_index
+from migrations import ORDINAL_OFFSET
+
+# Upper bounds of the completion rate buckets reported in the summary
+RATE_BUCKETS = (0.1, 0.25, 0.5, 0.75, 0.9, 1.0)
+
+
+def user_ranges(conn, shards):
+    """
+    Split the users into at most `shards` ranges of consecutive ids holding about
+    the same number of users. Returns a list of (first_id, last_id) pairs.
+    """
+    return conn.execute("""
+        SELECT MIN(id), MAX(id) FROM (
+            SELECT id, NTILE(?) OVER (ORDER BY id) AS shard FROM users
+        )
+        GROUP BY shard ORDER BY shard
+    """, (shards,)).fetchall()
+
+
+def open_read_only(db_path):
+    """
+    Open a read-only connection to a database file.
+    """
+    return sqlite3.connect(f"file:{pathname2url(os.path.abspath(db_path))}?mode=ro", uri=True)
+
+
+def analyze_users(conn, first_id, last_id, today, top=10):
+    """
+    Compute the analytics of the users whose ids are in [first_id, last_id]: per user the
+    number of habits and completions, the longest and current streak and the completion
+    rate (completed periods over the periods elapsed since each habit was created).
+    Returns a partial report: the `top` best users (see leaderboard_key) and the totals
+    needed to merge the summary tables.
+    """
+    users = {
+        user_id: {"user_id": user_id, "username": username, "habits": 0, "completions": 0,
+                  "longest_streak": 0, "best_habit": None, "current_streak": 0,
+                  "periods": 0, "expected": 0}
+        for user_id, username in conn.execute("""
+            SELECT id, username FROM users WHERE id BETWEEN ? AND ?
+            AND id NOT IN (SELECT user_id FROM user_shards WHERE shard <> 0)
+        """, (first_id, last_id))
+    }
+    habits = conn.execute(f"""
+        SELECT h.id, h.user_id, h.name, h.periodicity,
+               CAST(julianday(h.created_at) - {ORDINAL_OFFSET} AS INTEGER)
+        FROM habits h WHERE h.user_id BETWEEN ? AND ?
+    """, (first_id, last_id)).fetchall()
+    histories = habit_histories(conn, first_id, last_id)
+
+    by_periodicity = {}
+    for habit_id, user_id, name, periodicity, created in habits:
+        user = users.get(user_id)
+        if user is None:  # Habit of a user that no longer exists
+            continue
+        total, completed, longest, last_streak, last_period = histories.get(habit_id, (0, 0, 0, 0, None))
+        today_period = period_index(today, periodicity)
+        start = period_index(created, periodicity) if created is not None else today_period
+        expected = max(today_period - start + 1, completed, 1)
+        current = last_streak if last_period is not None and last_period >= today_period - 1 else 0
+
+        user["habits"] += 1
+        user["completions"] += total
+        user["periods"] += completed
+        user["expected"] += expected
+        user["current_streak"] = max(user["current_streak"], current)
+        if longest > user["longest_streak"]:
+            user["longest_streak"], user["best_habit"] = longest, name
+        totals = by_periodicity.setdefault(periodicity, {"habits": 0, "longest_sum": 0, "periods": 0, "expected": 0})
+        totals["habits"] += 1
+        totals["longest_sum"] += longest
+        totals["periods"] += completed
+        totals["expected"] += expected
+
+    rate_histogram = [0] * len(RATE_BUCKETS)
+    for user in users.values():
+        user["completion_rate"] = user["periods"] / user["expected"] if user["expected"] else 0.0
+        bucket = next(i for i, bound in enumerate(RATE_BUCKETS) if user["completion_rate"] <= bound)
+        rate_histogram[bucket] += 1
+    return {
+        "users": len(users),
+        "habits": sum(user["habits"] for user in users.values()),
+        "completions": sum(user["completions"] for user in users.values()),
+        "periods": sum(user["periods"] for user in users.values()),
+        "expected": sum(user["expected"] for user in users.values()),
+        "by_periodicity": by_periodicity,
+        "rate_histogram": rate_histogram,
+        "leaderboard": heapq.nlargest(top, users.values(), key=leaderboard_key),
+    }
+
+
+def habit_histories(conn, first_id, last_id):
+    """
+    Summarize the completions of the habits of users first_id..last_id in one streaming pass.
+    Returns a dict mapping habit ids to (completions, completed_periods, longest_streak,
+    last_streak, last_period). The rows come out of the indexes already grouped by habit
+    and ordered by day, which is much cheaper than the window functions of STREAK_STATE_SQL.
+    """
+    if runs.uses_run_storage(conn):
+        rows = conn.execute("""
+            SELECT r.habit_id, r.start, r.length FROM habits h
+            JOIN completion_runs r ON r.habit_id = h.id
+            WHERE h.user_id BETWEEN ? AND ?
+            ORDER BY h.user_id, h.name, r.start
+        """, (first_id, last_id))
+    else:
+        rows = conn.execute("""
+            SELECT c.habit_id, c.period, 1 FROM habits h
+            JOIN completions c ON c.habit_id = h.id
+            WHERE h.user_id BETWEEN ? AND ?
+            ORDER BY h.user_id, h.name, c.day
+        """, (first_id, last_id))
+
+    histories = {}
+    current = None
+    for habit_id, start, length in rows:
+        if habit_id != current:
+            if current is not None:
+                histories[current] = (total, completed, longest, streak, last)
+            current, total, completed, longest, streak, last = habit_id, 0, 0, 0, 0, None
+        total += length
+        if last is not None and start <= last:
+            continue  # Another completion in the same period
+        streak = streak + length if last is not None and start == last + 1 else length
+        completed += length
+        longest = max(longest, streak)
+        last = start + length - 1
+    if current is not None:
+        histories[current] = (total, completed, longest, streak, last)
+    return histories
+
+
+def leaderboard_key(user):
+    """
+    Leaderboard order: longest streak, then completion rate, then the oldest account.
+    """
+    return user["longest_streak"], user["completion_rate"], -user["user_id"]
+
+
+def _analyze_shard(db_path, first_id, last_id, today, top):
+    # Runs in a worker process, with its own read-only connection
+    conn = open_read_only(db_path)
+    try:
+        return analyze_users(conn, first_id, last_id, today, top)
+    finally:
+        conn.close()
+
+
+def merge_reports(partials, top=10):
+    """
+    Merge the partial reports of several shards into the leaderboard and summary tables.
+    """
+    report = {"users": 0, "habits": 0, "completions": 0}
+    periods = expected = 0
+    by_periodicity = {}
+    rate_histogram = [0] * len(RATE_BUCKETS)
+    leaders = []
+    for partial in partials:
+        for key in report:
+            report[key] += partial[key]
+        periods += partial["periods"]
+        expected += partial["expected"]
+        for periodicity, totals in partial["by_periodicity"].items():
+            merged = by_periodicity.setdefault(periodicity, dict.fromkeys(totals, 0))
+            for key, value in totals.items():
+                merged[key] += value
+        rate_histogram = [a + b for a, b in zip(rate_histogram, partial["rate_histogram"])]
+        leaders.extend(partial["leaderboard"])
+
+    report["completion_rate"] = periods / expected if expected else 0.0
+    report["by_periodicity"] = {
+        periodicity: {
+            "habits": totals["habits"],
+            "mean_longest_streak": totals["longest_sum"] / totals["habits"],
+            "completion_rate": totals["periods"] / totals["expected"] if totals["expected"] else 0.0,
+        }
+        for periodicity, totals in sorted(by_periodicity.items())
+    }
+    labels = [f"<={bound:.0%}" for bound in RATE_BUCKETS]
+    report["rate_histogram"] = dict(zip(labels, rate_histogram))
+    report["leaderboard"] = [
+        {key: user[key] for key in ("user_id", "username", "longest_streak", "best_habit",
+                                    "current_streak", "completion_rate", "habits", "completions")}
+        for user in heapq.nlargest(top, leaders, key=leaderboard_key)
+    ]
+    return report
+
+
+def run_report(db_path=None, conn=None, top=10, workers=None, shards=None, today=None):
+    """
+    Compute the analytics of every user: a top-`top` leaderboard and summary tables.
+    Users are split into `shards` ranges of ids (default: four per worker) analyzed by a
+    pool of `workers` processes (default: one per CPU), each with its own read-only
+    connection to the database file at db_path. With an open connection instead
+    (e.g. an in-memory database), or a single worker, the shards run in this process.
+    db_path may also be a list of the files of a sharded database (see shards.py), whose
+    users are split into ranges file by file.
+    """
+    today = (today or date.today()).toordinal()
+    workers = workers or os.cpu_count() or 1
+    shards = shards or workers * 4
+    started = time.perf_counter()
+    if conn is not None:
+        ranges = user_ranges(conn, shards)
+        partials = [analyze_users(conn, first, last, today, top) for first, last in ranges]
+        report = merge_reports(partials, top)
+        report.update(shards=len(ranges), workers=1, seconds=time.perf_counter() - started)
+        return report
+
+    paths = [db_path] if isinstance(db_path, (str, os.PathLike)) else list(db_path)
+    tasks = []
+    for path in paths:
+        conn = open_read_only(path)
+        try:
+            tasks.extend((path, first, last) for first, last in user_ranges(conn, shards))
+        finally:
+            conn.close()
+    if workers == 1:
+        partials = [_analyze_shard(path, first, last, today, top) for path, first, last in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_analyze_shard, path, first, last, today, top)
+                       for path, first, last in tasks]
+            partials = [future.result() for future in futures]
+
+    report = merge_reports(partials, top)
+    report.update(shards=len(tasks), workers=workers, seconds=time.perf_counter() - started)
+    return report
@@ -0,0 +1,386 @@
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+import passwords
+import storage
+from habit import Habit
+from habit_tracker import HabitTracker
+
+# Named dataset sizes: users, habits per user and days of history
+SCALES = {
+    "tiny": (20, 5, 90),
+    "small": (200, 10, 365),
+    "medium": (1000, 20, 730),
+    "large": (3000, 30, 1095),
+}
+
+OPERATIONS = [
+    "add_habit",
+    "complete_habit",
+    "get_user_habits",
+    "get_longest_streak",
+    "get_habits_by_periodicity",
+    "delete_all_habits",
+]
+
+
+def generate_dataset(tracker, users, habits_per_user, days, seed=0, end=None):
+    """
+    Fill the tracker's storage with synthetic users, habits and completions, through the
+    storage interface so that every backend gets the same data.
+    Every habit is completed over `days` days of history ending at `end` (default today):
+    a mix of daily and weekly habits, each with its own consistency, so histories
+    alternate between streaks and gaps of random length.
+    Returns the number of completions written.
+    """
+    rng = random.Random(seed)
+    end = end or date.today()
+    start = end - timedelta(days=days - 1)
+    storage = tracker.storage
+    created_at = datetime.combine(start, datetime.min.time())
+
+    # Every user's password is "pw"; sharing one hash (and salt) saves hashing it per user
+    password = passwords.hash_password("pw")
+    first_user = len(storage.usernames()) + 1
+    user_ids = storage.add_users([(f"bench{first_user + i}", password, created_at.isoformat(" "))
+                                  for i in range(users)])
+
+    habits = []
+    with storage.transaction():
+        for user_id in user_ids:
+            for number in range(habits_per_user):
+                periodicity = "weekly" if rng.random() < 0.3 else "daily"
+                habits.append((storage.add_habit(user_id, f"Habit {number}", periodicity, created_at), periodicity))
+
+    total = 0
+    for habit_id, periodicity in habits:
+        weekly = periodicity == "weekly"
+        step = 7 if weekly else 1
+        # Chance of keeping a streak going, and of starting a new one after a miss
+        keep, resume = rng.uniform(0.6, 0.98), rng.uniform(0.2, 0.7)
+        rows = []
+        active = rng.random() < resume
+        for offset in range(0, days, step):
+            active = rng.random() < (keep if active else resume)
+            if active:
+                day = start.toordinal() + offset
+                rows.append((habit_id, day, (day - 1) // 7 if weekly else day))
+        with storage.transaction():
+            storage.insert_completions(rows)
+        total += len(rows)
+
+    storage.refresh()
+    return total
+
+
+def summarize(samples):
+    """
+    Return call count and mean/p50/p95/max latency (ms) of a list of durations in seconds.
+    """
+    ordered = sorted(samples)
+    if not ordered:
+        return {"calls": 0}
+    return {
+        "calls": len(ordered),
+        "mean_ms": statistics.fmean(ordered) * 1000,
+        "p50_ms": ordered[len(ordered) // 2] * 1000,
+        "p95_ms": ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))] * 1000,
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+def time_operations(tracker, samples, seed=0):
+    """
+    Log in as `samples` random generated users and time each operation of OPERATIONS for them.
+    delete_all_habits runs last, as it wipes the sampled user's habits.
+    Returns a dict mapping each operation name to its latency summary.
+    """
+    rng = random.Random(seed)
+    usernames = [username for username in tracker.storage.usernames() if username.startswith("bench")]
+    timings = {name: [] for name in OPERATIONS}
+
+    def timed(name, call, *args):
+        started = time.perf_counter()
+        call(*args)
+        timings[name].append(time.perf_counter() - started)
+
+    for username in rng.sample(usernames, min(samples, len(usernames))):
+        with tracker.session():
+            tracker.login_user(username, "pw")
+            # Read from storage directly, so the timed reads don't start with a warm cache
+            habit_names = [row[1] for row in tracker.storage.habits(tracker.current_user.id)]
+            timed("add_habit", tracker.add_habit, Habit("Benchmark habit", "daily", tracker.current_user.id))
+            timed("complete_habit", tracker.complete_habit, rng.choice(habit_names) if habit_names else "Benchmark habit")
+            timed("get_user_habits", tracker.get_user_habits)
+            timed("get_longest_streak", tracker.get_longest_streak)
+            timed("get_habits_by_periodicity", tracker.get_habits_by_periodicity, rng.choice(["daily", "weekly"]))
+            timed("delete_all_habits", tracker.delete_all_habits)
+    return {name: summarize(values) for name, values in timings.items()}
+
+
+def _bench_directory(directory):
+    # The caller's directory as is, or a temporary one removed with its contents on exit
+    if directory is None:
+        return tempfile.TemporaryDirectory(prefix="habit-bench-")
+    return contextlib.nullcontext(directory)
+
+
+def run_scale(name, users, habits_per_user, days, samples, seed=0, directory=None, backend="sqlite"):
+    """
+    Build a fresh database of the given size on a storage backend and benchmark it.
+    Returns one result record; db_bytes is None for the memory backend.
+    """
+    with _bench_directory(directory) as directory:
+        db_path = os.path.join(directory, f"bench-{name}.db")
+        tracker = HabitTracker(db_path, backend=backend)
+        size = None
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                started = time.perf_counter()
+                completions = generate_dataset(tracker, users, habits_per_user, days, seed)
+                build_seconds = time.perf_counter() - started
+                operations = time_operations(tracker, samples, seed)
+            if backend == "sqlite":
+                size = os.path.getsize(db_path)
+        finally:
+            tracker.close()
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(db_path + suffix):
+                    os.remove(db_path + suffix)
+    return {
+        "scale": name,
+        "backend": backend,
+        "users": users,
+        "habits": users * habits_per_user,
+        "days": days,
+        "completions": completions,
+        "db_bytes": size,
+        "build_seconds": build_seconds,
+        "operations": operations,
+    }
+
+
+def login_throughput(pool_sizes=(0, 1, 2, 4), logins=64, threads=8, directory=None):
+    """
+    Measure password logins per second with `threads` concurrent callers when verification
+    runs in the calling threads (pool size 0) or in a pool of that many processes, and the
+    rate of logins with a session token, which skip verification. Returns one record per pool size.
+    """
+    with _bench_directory(directory) as directory:
+        db_path = os.path.join(directory, "bench-logins.db")
+        tracker = HabitTracker(db_path)
+        results = []
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                tracker.create_user("login-bench", "pw")
+
+                def login(_):
+                    with tracker.session():
+                        return tracker.login_user("login-bench", "pw")
+
+                for size in pool_sizes:
+                    tracker.disable_password_pool()
+                    if size:
+                        tracker.enable_password_pool(size)
+                        tracker.login_user("login-bench", "pw")  # Start the worker processes
+                    with ThreadPoolExecutor(max_workers=threads) as executor:
+                        started = time.perf_counter()
+                        succeeded = sum(executor.map(login, range(logins)))
+                        elapsed = time.perf_counter() - started
+                    results.append({"pool_size": size, "threads": threads, "logins": succeeded,
+                                    "seconds": elapsed, "logins_per_sec": succeeded / elapsed})
+
+                with tracker.session():
+                    tracker.login_user("login-bench", "pw")
+                    token = tracker.issue_token()
+                    started = time.perf_counter()
+                    for _ in range(logins * 100):
+                        tracker.login_with_token(token)
+                    token_rate = logins * 100 / (time.perf_counter() - started)
+        finally:
+            tracker.close()
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(db_path + suffix):
+                    os.remove(db_path + suffix)
+    for result in results:
+        result["token_logins_per_sec"] = token_rate
+    return results
+
+
+class DictHabit:
+    """
+    The in-memory habit layout before Habit was slotted: attributes in a per-instance
+    dict and the completions as a list of date objects. Kept to measure the difference.
+    """
+    def __init__(self, name, periodicity, user_id):
+        self.name = name
+        self.periodicity = periodicity
+        self.created_at = datetime.now()
+        self.user_id = user_id
+        self.completed_dates = []
+
+
+def _dict_habit(number, first_day, completions):
+    habit = DictHabit(f"Habit {number}", "daily", 1)
+    habit.completed_dates = [date.fromordinal(day) for day in range(first_day, first_day + completions)]
+    return habit
+
+
+def _slotted_habit(number, first_day, completions):
+    habit = Habit(f"Habit {number}", "daily", 1)
+    habit.completed_days = range(first_day, first_day + completions)
+    return habit
+
+
+def _traced_bytes(build):
+    # Bytes allocated by build() and still held by what it returns
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        objects = build()
+        held = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del objects
+    return held
+
+
+def memory_footprint(completions=1_000_000, habits=10_000):
+    """
+    Measure with tracemalloc the memory held by `habits` in-memory habits with `completions`
+    completions between them, in the old dict-backed layout with date objects and in the
+    slotted Habit with its array of day ordinals. Returns one record per layout with the
+    total bytes, the bytes per habit (measured without completions) and per completion.
+    """
+    per_habit = completions // habits
+    first_day = date(2020, 1, 1).toordinal()
+    results = []
+    for layout, make in (("dict_dates", _dict_habit), ("slots_array", _slotted_habit)):
+        empty = _traced_bytes(lambda: [make(number, first_day, 0) for number in range(habits)])
+        full = _traced_bytes(lambda: [make(number, first_day, per_habit) for number in range(habits)])
+        results.append({
+            "layout": layout,
+            "habits": habits,
+            "completions": per_habit * habits,
+            "bytes": full,
+            "bytes_per_habit": empty / habits,
+            "bytes_per_completion": (full - empty) / (per_habit * habits),
+        })
+    return results
+
+
+def environment():
+    """
+    Describe where the benchmark ran, so result files can be told apart.
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "commit": commit or None,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+    }
+
+
+def compare(baseline, current, threshold=0.2):
+    """
+    Return a list of messages for operations whose mean latency grew by more than
+    `threshold` (a fraction) between two benchmark result documents.
+    """
+    # Results from before backends were selectable ran on SQLite
+    before = {(r["scale"], r.get("backend", "sqlite"), op): s
+              for r in baseline["results"] for op, s in r["operations"].items()}
+    regressions = []
+    for result in current["results"]:
+        backend = result.get("backend", "sqlite")
+        for operation, summary in result["operations"].items():
+            old = before.get((result["scale"], backend, operation))
+            if old and old.get("mean_ms") and summary.get("mean_ms"):
+                change = summary["mean_ms"] / old["mean_ms"] - 1
+                if change > threshold:
+                    label = result["scale"] if backend == "sqlite" else f"{result['scale']}[{backend}]"
+                    regressions.append(f"{label}/{operation}: {old['mean_ms']:.3f} ms -> "
+                                       f"{summary['mean_ms']:.3f} ms (+{change:.0%})")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="benchmark.py", description="Benchmark HabitTracker on synthetic data.")
+    parser.add_argument("--scales", default="tiny,small",
+                        help=f"comma separated scales among {', '.join(SCALES)} (default: tiny,small)")
+    parser.add_argument("--backends", default="sqlite",
+                        help="comma separated storage backends to run every scale on, e.g. sqlite,memory "
+                             "(default: sqlite)")
+    parser.add_argument("--samples", type=int, default=50, help="users timed per scale (default: 50)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the generated data (default: 0)")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    parser.add_argument("--compare", help="earlier JSON results to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="relative slowdown reported as a regression (default: 0.2)")
+    parser.add_argument("--logins", metavar="SIZES",
+                        help="also measure logins/sec with these comma separated password pool sizes (0: no pool)")
+    parser.add_argument("--memory", metavar="COMPLETIONS", type=int,
+                        help="also measure the memory of in-memory habits holding this many completions")
+    args = parser.parse_args(argv)
+
+    backends = args.backends.split(",")
+    for backend in backends:
+        if backend not in storage.BACKENDS:
+            parser.error(f"unknown backend '{backend}'")
+    results = {"environment": environment(), "results": []}
+    for name in args.scales.split(","):
+        if name not in SCALES:
+            parser.error(f"unknown scale '{name}'")
+        users, habits_per_user, days = SCALES[name]
+        for backend in backends:
+            print(f"Running scale '{name}' on {backend} ({users} users x {habits_per_user} habits x {days} days)...",
+                  file=sys.stderr)
+            results["results"].append(run_scale(name, users, habits_per_user, days, args.samples, args.seed,
+                                                backend=backend))
+    if args.logins:
+        print(f"Measuring logins with password pool sizes {args.logins}...", file=sys.stderr)
+        results["logins"] = login_throughput([int(size) for size in args.logins.split(",")])
+
+    if args.memory:
+        print(f"Measuring the memory of habits with {args.memory} completions...", file=sys.stderr)
+        results["memory"] = memory_footprint(args.memory)
+
+    document = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as handle:
+            handle.write(document + "\n")
+    else:
+        print(document)
+
+    if args.compare:
+        with open(args.compare) as handle:
+            regressions = compare(json.load(handle), results, args.threshold)
+        for message in regressions:
+            print(f"Regression: {message}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,76 @@
+import csv
+import json
+import os
+from datetime import date, datetime
+
+# Columns (CSV) or keys (NDJSON) holding the habit name and the completion date
+HABIT_FIELD = "habit"
+DATE_FIELD = "date"
+
+
+def parse_date(value):
+    """
+    Return value as a date, accepting date/datetime objects and 'YYYY-MM-DD' strings,
+    or None if it is not a valid date.
+    """
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    try:
+        return date.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def read_csv(path):
+    """
+    Stream (habit_name, completion_date) pairs from a CSV file with 'habit' and 'date' columns.
+    Raises ValueError if the header lacks one of them.
+    """
+    with open(path, newline="", encoding="utf-8") as handle:
+        reader = csv.DictReader(handle)
+        for field in (HABIT_FIELD, DATE_FIELD):
+            if field not in (reader.fieldnames or ()):
+                raise ValueError(f'the CSV header has no "{field}" column')
+        for row in reader:
+            yield row[HABIT_FIELD], row[DATE_FIELD]
+
+
+def read_ndjson(path):
+    """
+    Stream (habit_name, completion_date) pairs from a file with one JSON object per line.
+    Raises ValueError, naming the line, for a line that is not an object with both keys.
+    """
+    with open(path, encoding="utf-8") as handle:
+        for number, line in enumerate(handle, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as error:
+                raise ValueError(f"line {number} is not valid JSON: {error}")
+            if not isinstance(record, dict):
+                raise ValueError(f"line {number} is not a JSON object")
+            for field in (HABIT_FIELD, DATE_FIELD):
+                if field not in record:
+                    raise ValueError(f'line {number} has no "{field}" field')
+            yield record[HABIT_FIELD], record[DATE_FIELD]
+
+
+READERS = {
+    "csv": read_csv,
+    "ndjson": read_ndjson,
+    "jsonl": read_ndjson,
+}
+
+
+def read_completions(path, fmt=None):
+    """
+    Stream completions from a CSV or NDJSON file. The format is taken from the
+    file extension unless fmt is given.
+    """
+    fmt = (fmt or os.path.splitext(path)[1].lstrip(".")).lower()
+    if fmt not in READERS:
+        raise ValueError(f"Unsupported import format '{fmt}'. Use one of: {', '.join(sorted(READERS))}.")
+    return READERS[fmt](path)
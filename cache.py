@@ -0,0 +1,190 @@
+import secrets
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+# Returned by HabitCache.get when the entry is not cached
+MISSING = object()
+
+
+class HabitCache:
+    """
+    Bounded LRU cache of the habits read for each user. An entry is keyed by
+    (user_id, habit_name); habit_name None holds the user's habit list.
+    Writes invalidate the affected entries. Every invalidation bumps the user's
+    version, and an entry read before that (put with an older version) is dropped,
+    so a slow reader never caches data that a concurrent writer has replaced.
+    Cached objects are shared, so callers must treat them as read-only.
+    """
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._keys_by_user = defaultdict(set)
+        self._versions = defaultdict(int)
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def version(self, user_id):
+        """
+        Return the current version of a user's entries, to pass to put() after reading the database.
+        """
+        with self._lock:
+            return self._versions[user_id]
+
+    def get(self, user_id, habit_name=None):
+        """
+        Return the cached value, or MISSING.
+        """
+        key = (user_id, habit_name)
+        with self._lock:
+            value = self._entries.get(key, MISSING)
+            if value is MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, user_id, habit_name, value, version):
+        """
+        Cache a value read while the user's entries were at `version`.
+        """
+        key = (user_id, habit_name)
+        with self._lock:
+            if self._versions[user_id] != version:
+                return
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            self._keys_by_user[user_id].add(key)
+            while len(self._entries) > self.max_entries:
+                old_key, _ = self._entries.popitem(last=False)
+                self._discard_key(old_key)
+                self.evictions += 1
+
+    def invalidate(self, user_id, *habit_names):
+        """
+        Drop the given habits of a user. None stands for the user's habit list.
+        """
+        with self._lock:
+            self._versions[user_id] += 1
+            for habit_name in habit_names:
+                key = (user_id, habit_name)
+                if self._entries.pop(key, MISSING) is not MISSING:
+                    self._discard_key(key)
+                    self.invalidations += 1
+
+    def invalidate_user(self, user_id):
+        """
+        Drop every entry of a user.
+        """
+        with self._lock:
+            self._versions[user_id] += 1
+            for key in self._keys_by_user.pop(user_id, ()):
+                del self._entries[key]
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            for user_id in self._keys_by_user:
+                self._versions[user_id] += 1
+            self._entries.clear()
+            self._keys_by_user.clear()
+
+    def stats(self):
+        """
+        Return the hit/miss/eviction/invalidation counters and the current size.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+    def _discard_key(self, key):
+        keys = self._keys_by_user.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_user[key[0]]
+
+
+class TokenCache:
+    """
+    In-memory session tokens that expire `ttl` seconds after they are issued. A token maps
+    to the (user_id, username) it was issued for, so a request presenting it skips password
+    verification. Tokens are random and never stored in the database; they are lost on restart.
+    At most max_entries tokens are kept, the oldest being dropped first.
+    """
+    def __init__(self, ttl=900, max_entries=100_000, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self._tokens = OrderedDict()  # token -> (expires, user_id, username), oldest first
+        self._lock = threading.Lock()
+        self.issued = self.hits = self.misses = self.expired = 0
+
+    def issue(self, user_id, username):
+        """
+        Return a new token for a verified user.
+        """
+        token = secrets.token_urlsafe(32)
+        with self._lock:
+            now = self.clock()
+            self._purge(now)
+            self._tokens[token] = (now + self.ttl, user_id, username)
+            while len(self._tokens) > self.max_entries:
+                self._tokens.popitem(last=False)
+            self.issued += 1
+        return token
+
+    def get(self, token):
+        """
+        Return the (user_id, username) of a valid token, or None if it is unknown or expired.
+        """
+        with self._lock:
+            entry = self._tokens.get(token)
+            if entry is not None and entry[0] <= self.clock():
+                del self._tokens[token]
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def revoke(self, token):
+        """
+        Forget a token. Returns True if it was known.
+        """
+        with self._lock:
+            return self._tokens.pop(token, None) is not None
+
+    def _purge(self, now):
+        # Every token lives for the same ttl, so the expired ones are the oldest
+        while self._tokens:
+            token, entry = next(iter(self._tokens.items()))
+            if entry[0] > now:
+                break
+            del self._tokens[token]
+            self.expired += 1
+
+    def stats(self):
+        """
+        Return the number of live tokens and the issue/hit/miss/expiry counters.
+        """
+        with self._lock:
+            return {
+                "tokens": len(self._tokens),
+                "ttl": self.ttl,
+                "issued": self.issued,
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+            }
@@ -0,0 +1,446 @@
+import argparse
+import itertools
+import json
+import shlex
+import sys
+import time
+from contextlib import redirect_stdout
+from datetime import date
+import export
+from habit import Habit
+from habit_tracker import HabitTracker
+
+# Commands that print one JSON object and may be fed to `batch`
+BATCH_COMMANDS = ("user", "habit", "complete", "streaks")
+
+
+def rebuild_streaks(tracker, args):
+    """
+    Recompute the streak table from the completions and report any drift.
+    """
+    drift = tracker.rebuild_streaks(check_only=args.check)
+    for habit_id, name, expected, actual in drift:
+        print(f"Habit {habit_id} ({name or 'deleted'}): expected {expected}, stored {actual}")
+    if not drift:
+        print("Streak table is up to date.")
+    elif args.check:
+        print(f"{len(drift)} habit(s) drifted. Run without --check to rebuild.")
+        return 1
+    else:
+        print(f"Rebuilt streak table, {len(drift)} habit(s) corrected.")
+    return 0
+
+
+def import_completions(tracker, args):
+    """
+    Stream completions from a CSV or NDJSON file into the given user's habits.
+    """
+    if not tracker.login_user(args.user, args.password):
+        return 1
+    try:
+        result = tracker.import_file(args.path, args.format, args.batch_size)
+    except (OSError, ValueError) as error:
+        print(f"Import failed: {error}")
+        return 1
+    print(f"Imported {result['imported']} completions ({result['skipped']} skipped) "
+          f"in {result['seconds']:.2f}s, {result['rows_per_sec']:.0f} rows/sec.")
+    return 0
+
+
+def set_storage(tracker, args):
+    """
+    Convert the completions between one row each and run-length storage.
+    """
+    if tracker.set_completion_storage(args.mode):
+        print(f"Completions are now stored as {args.mode}.")
+    else:
+        print(f"Completions are already stored as {args.mode}.")
+    return 0
+
+
+def compact(tracker, args):
+    """
+    Remove orphaned rows, refresh planner statistics and shrink the database file.
+    """
+    result = tracker.compact()
+    print(f"Removed {result['orphaned_completions']} orphaned completion(s) and "
+          f"{result['orphaned_streaks']} orphaned streak row(s).")
+    print(f"Database size: {result['bytes_before']} -> {result['bytes_after']} bytes "
+          f"({result['bytes_reclaimed']} reclaimed).")
+    return 0
+
+
+def leaderboard(tracker, args):
+    """
+    Analyze all users in parallel and print the leaderboard and summary tables.
+    """
+    report = tracker.leaderboard(args.top, args.workers)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return 0
+    print(f"{'#':>3}  {'User':<20} {'Longest':>7} {'Current':>7} {'Rate':>6}  Best habit")
+    for rank, user in enumerate(report["leaderboard"], start=1):
+        print(f"{rank:>3}  {user['username']:<20} {user['longest_streak']:>7} {user['current_streak']:>7} "
+              f"{user['completion_rate']:>6.1%}  {user['best_habit'] or '-'}")
+    print(f"\n{report['users']} users, {report['habits']} habits, {report['completions']} completions, "
+          f"completion rate {report['completion_rate']:.1%}")
+    for periodicity, summary in report["by_periodicity"].items():
+        print(f"  {periodicity}: {summary['habits']} habits, mean longest streak "
+              f"{summary['mean_longest_streak']:.1f}, completion rate {summary['completion_rate']:.1%}")
+    print(f"Analyzed {report['shards']} shard(s) with {report['workers']} worker(s) in {report['seconds']:.2f}s.")
+    return 0
+
+
+def export_history(tracker, args):
+    """
+    Stream habits or completions of one user, or of everyone, to a CSV or NDJSON file.
+    """
+    if not args.all and not (args.user and args.password):
+        print("Pass --user and --password, or --all.")
+        return 1
+    if not args.all and not tracker.login_user(args.user, args.password):
+        return 1
+    if args.habits:
+        records, fields = tracker.export_habits(args.all, args.batch_size), export.HABIT_FIELDS
+    else:
+        records = tracker.export_completions(args.all, args.after, args.batch_size)
+        fields = export.COMPLETION_FIELDS
+    if args.output:
+        # Resuming appends to the file of the interrupted export
+        with open(args.output, "a" if args.after else "w", newline="", encoding="utf-8") as handle:
+            result = export.write_export(records, handle, args.format, fields)
+    else:
+        result = export.write_export(records, sys.stdout, args.format, fields)
+    # The report goes to stderr so that stdout only holds the exported rows
+    print(f"Exported {result['rows']} rows in {result['seconds']:.2f}s, {result['rows_per_sec']:.0f} rows/sec.",
+          file=sys.stderr)
+    if result["cursor"] is not None and not args.habits:
+        print(f"Resume after this export with --after {result['cursor']}.", file=sys.stderr)
+    return 0
+
+
+def due(tracker, args):
+    """
+    List the habits of one user, or of everyone, that still have to be completed this period.
+    """
+    if not args.all and not (args.user and args.password):
+        print("Pass --user and --password, or --all.")
+        return 1
+    if not args.all and not tracker.login_user(args.user, args.password):
+        return 1
+    habits = tracker.due_habits(args.all, args.overdue, args.limit)
+    if args.json:
+        print(json.dumps(habits, indent=2))
+        return 0
+    for habit in habits:
+        state = "overdue since" if habit["overdue"] else "due"
+        print(f"{habit['username']:<20} {habit['habit']:<24} {habit['periodicity']:<7} {state} {habit['due']}")
+    if not habits:
+        print("Nothing is due.")
+    return 0
+
+
+def send_reminders(tracker, args):
+    """
+    Print a reminder whenever a habit becomes due, until interrupted, or once with --once.
+    """
+    scheduler = tracker.reminder_scheduler(hour=args.hour)
+    if args.once:
+        scheduler.tick()
+        return 0
+    try:
+        while True:
+            scheduler.tick()
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    print(f"Sent {scheduler.emitted} reminder(s).")
+    return 0
+
+
+def read_targets(args):
+    """
+    Return the command's targets: its arguments, or the non-empty lines of stdin when there are none.
+    """
+    if args.targets:
+        return args.targets
+    return [line.rstrip("\n") for line in sys.stdin if line.strip()]
+
+
+def emit(result):
+    print(json.dumps(result))
+
+
+def log_in(tracker, args):
+    """
+    Log in args.user. A password is only verified once per run, so a command stream
+    for the same user does not pay for a password hash on every line.
+    """
+    if not (args.user and args.password):
+        emit({"error": "pass --user and --password"})
+        return False
+    user = args.logins.get((args.user, args.password))
+    if user is not None:
+        tracker.current_user = user
+        return True
+    # The tracker reports to stdout, which is kept for the JSON output
+    with redirect_stdout(sys.stderr):
+        verified = tracker.login_user(args.user, args.password)
+    if not verified:
+        emit({"user": args.user, "error": "invalid username or password"})
+        return False
+    args.logins[(args.user, args.password)] = tracker.current_user
+    return True
+
+
+def create_users(tracker, args):
+    """
+    Create the given users, read as USERNAME or USERNAME<tab>PASSWORD, in one transaction.
+    """
+    credentials = []
+    for target in read_targets(args):
+        username, _, password = target.partition("\t")
+        credentials.append((username, password or args.password))
+    if not all(password for _, password in credentials):
+        print("Pass --password, or USERNAME<tab>PASSWORD lines.", file=sys.stderr)
+        return 1
+    with redirect_stdout(sys.stderr):
+        result = tracker.create_users(credentials)
+    emit(dict(command="user create", **result))
+    return 0
+
+
+def add_habits(tracker, args):
+    """
+    Add the given habits to a user in one transaction.
+    """
+    if not log_in(tracker, args):
+        return 1
+    habits = [Habit(name, args.periodicity, tracker.current_user.id) for name in read_targets(args)]
+    with redirect_stdout(sys.stderr):
+        result = tracker.add_habits(habits)
+    emit(dict(command="habit add", user=args.user, **result))
+    return 0
+
+
+def complete_habits(tracker, args):
+    """
+    Mark the given habits of a user as completed on a day (default: today), in one transaction.
+    """
+    if not log_in(tracker, args):
+        return 1
+    completed_on = args.date or date.today().isoformat()
+    with redirect_stdout(sys.stderr):
+        result = tracker.complete_habits(read_targets(args), completed_on)
+    if result is None:
+        emit({"command": "complete", "user": args.user, "error": f"invalid date '{completed_on}'"})
+        return 1
+    emit(dict(command="complete", user=args.user, date=completed_on, **result))
+    return 1 if result["unknown"] else 0
+
+
+def show_streaks(tracker, args):
+    """
+    Print the current and longest streak of a user's habits (the given ones, or all), or of every user's.
+    """
+    if not args.all and not log_in(tracker, args):
+        return 1
+    names = set(args.targets)
+    with redirect_stdout(sys.stderr):
+        rows = tracker.compute_streaks(all_users=args.all)
+    emit({"command": "streaks", "streaks": [
+        {"user_id": user_id, "habit": name, "periodicity": periodicity, "current": current, "longest": longest}
+        for user_id, name, periodicity, current, longest in rows
+        if not names or name in names
+    ]})
+    return 0
+
+
+def _batch_key(line):
+    # Consecutive lines running the same command with the same options are merged
+    number, command, _ = line
+    if command is None:
+        return number
+    return tuple(sorted((key, value) for key, value in vars(command).items()
+                        if key not in ("targets", "logins", "handler")))
+
+
+def run_batch(tracker, args):
+    """
+    Run a stream of commands read from stdin, one per line, e.g.
+    `complete --user ann --password pw Read Walk`, over one connection. Consecutive lines
+    with the same command and options are merged into one call, and so into one transaction.
+    Prints one JSON object per call; lines that fail to parse are reported and skipped.
+    """
+    parser = build_parser()
+
+    def parse(lines):
+        for number, line in enumerate(lines, start=1):
+            try:
+                words = shlex.split(line, comments=True)
+            except ValueError as error:  # Unbalanced quotes
+                yield number, None, f"invalid quoting: {error}"
+                continue
+            if not words:
+                continue
+            if words[0] not in BATCH_COMMANDS:
+                yield number, None, f"'{words[0]}' cannot be batched; use one of: {', '.join(BATCH_COMMANDS)}"
+                continue
+            try:
+                with redirect_stdout(sys.stderr):
+                    command = parser.parse_args(words)
+            except SystemExit:  # argparse has printed the problem to stderr
+                yield number, None, "invalid arguments"
+                continue
+            command.logins = args.logins
+            yield number, command, None
+
+    status = 0
+    for _, group in itertools.groupby(parse(sys.stdin), key=_batch_key):
+        group = list(group)
+        number, command, error = group[0]
+        if error is not None:
+            emit({"line": number, "error": error})
+            status = 1
+            continue
+        command.targets = [target for _, line, _ in group for target in line.targets]
+        if not command.targets and command.handler is not show_streaks:
+            continue  # Never fall back to reading stdin, which holds the stream
+        status = command.handler(tracker, command) or status
+    return status
+
+
+def manage_shards(tracker, args):
+    """
+    Spread users over several database files, list the shards or split one.
+    """
+    try:
+        if args.action == "init":
+            tracker.enable_sharding(args.number)
+        elif args.action == "split":
+            result = tracker.split_shard(args.number, args.path)
+            print(f"Moved {result['moved']} user(s) to shard {result['shard']}.")
+    except ValueError as error:
+        print(error)
+        return 1
+    for shard in tracker.shard_info():
+        print(f"Shard {shard['shard']}: {shard['path']}, {shard['users']} user(s), "
+              f"{shard['habits']} habit(s), {shard['bytes']} bytes")
+    return 0
+
+
+def build_parser():
+    """
+    Build the argument parser for the non-interactive commands.
+    """
+    parser = argparse.ArgumentParser(prog="main.py", description="Habit Tracking App maintenance commands.")
+    parser.add_argument("--db", default="habits.db", help="path to the SQLite database (default: habits.db)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    rebuild = commands.add_parser("rebuild-streaks", help="recompute the streak table from completions")
+    rebuild.add_argument("--check", action="store_true", help="only report drift, do not rebuild")
+    rebuild.set_defaults(handler=rebuild_streaks)
+
+    importer = commands.add_parser("import", help="bulk import completions from a CSV or NDJSON file")
+    importer.add_argument("path", help="file with 'habit' and 'date' (YYYY-MM-DD) columns or keys")
+    importer.add_argument("--user", required=True, help="username owning the habits")
+    importer.add_argument("--password", required=True, help="password of that user")
+    importer.add_argument("--format", choices=["csv", "ndjson"], help="file format (default: from the extension)")
+    importer.add_argument("--batch-size", type=int, default=10000, help="rows per transaction (default: 10000)")
+    importer.set_defaults(handler=import_completions)
+
+    storage = commands.add_parser("storage", help="switch between per-row and run-length completion storage")
+    storage.add_argument("mode", choices=["rows", "runs"], help="one row per completion, or runs of periods")
+    storage.set_defaults(handler=set_storage)
+
+    compactor = commands.add_parser("compact", help="remove orphaned rows, run ANALYZE and VACUUM")
+    compactor.set_defaults(handler=compact)
+
+    board = commands.add_parser("leaderboard", help="analyze all users in parallel and rank them by streak")
+    board.add_argument("--top", type=int, default=10, help="users in the leaderboard (default: 10)")
+    board.add_argument("--workers", type=int, help="worker processes (default: one per CPU)")
+    board.add_argument("--json", action="store_true", help="print the full report as JSON")
+    board.set_defaults(handler=leaderboard)
+
+    exporter = commands.add_parser("export", help="stream completions or habits to CSV or NDJSON")
+    exporter.add_argument("--user", help="username whose history is exported")
+    exporter.add_argument("--password", help="password of that user")
+    exporter.add_argument("--all", action="store_true", help="export every user instead")
+    exporter.add_argument("--habits", action="store_true", help="export habits instead of completions")
+    exporter.add_argument("--format", choices=sorted(export.WRITERS), default="csv", help="output format (default: csv)")
+    exporter.add_argument("--output", help="file to write (default: stdout)")
+    exporter.add_argument("--after", type=int, default=0, help="resume after this completion id")
+    exporter.add_argument("--batch-size", type=int, default=1000, help="rows fetched per query (default: 1000)")
+    exporter.set_defaults(handler=export_history)
+
+    lister = commands.add_parser("due", help="list the habits that still have to be completed this period")
+    lister.add_argument("--user", help="username whose habits are listed")
+    lister.add_argument("--password", help="password of that user")
+    lister.add_argument("--all", action="store_true", help="list the habits of every user instead")
+    lister.add_argument("--overdue", action="store_true", help="only habits that missed a whole period")
+    lister.add_argument("--limit", type=int, help="at most this many habits, most overdue first")
+    lister.add_argument("--json", action="store_true", help="print the habits as JSON")
+    lister.set_defaults(handler=due)
+
+    reminder = commands.add_parser("reminders", help="print a reminder whenever a habit becomes due")
+    reminder.add_argument("--hour", type=int, default=9, help="hour of the day reminders are sent (default: 9)")
+    reminder.add_argument("--interval", type=float, default=60, help="seconds between checks (default: 60)")
+    reminder.add_argument("--once", action="store_true", help="send the reminders due now and exit")
+    reminder.set_defaults(handler=send_reminders)
+
+    sharder = commands.add_parser("shards", help="spread users over several database files")
+    sharder.add_argument("action", choices=["init", "list", "split"], help="create shards, list them or split one")
+    sharder.add_argument("number", type=int, nargs="?", default=2,
+                         help="init: total number of shards; split: shard to split (default: 2)")
+    sharder.add_argument("--path", help="file of the new shard when splitting (default: next to the database)")
+    sharder.set_defaults(handler=manage_shards)
+
+    users = commands.add_parser("user", help="manage users in bulk, printing JSON")
+    user_commands = users.add_subparsers(dest="action", required=True)
+    creator = user_commands.add_parser("create", help="create users in one transaction")
+    creator.add_argument("targets", nargs="*", metavar="USERNAME",
+                         help="users to create (default: read USERNAME or USERNAME<tab>PASSWORD lines from stdin)")
+    creator.add_argument("--password", help="password of users given without one")
+    creator.set_defaults(handler=create_users)
+
+    habits = commands.add_parser("habit", help="manage habits in bulk, printing JSON")
+    habit_commands = habits.add_subparsers(dest="action", required=True)
+    adder = habit_commands.add_parser("add", help="add habits to a user in one transaction")
+    adder.add_argument("targets", nargs="*", metavar="HABIT", help="habit names (default: one per line of stdin)")
+    adder.add_argument("--user", help="username owning the habits")
+    adder.add_argument("--password", help="password of that user")
+    adder.add_argument("--periodicity", choices=["daily", "weekly"], default="daily",
+                       help="periodicity of the new habits (default: daily)")
+    adder.set_defaults(handler=add_habits)
+
+    completer = commands.add_parser("complete", help="mark habits of a user as completed, printing JSON")
+    completer.add_argument("targets", nargs="*", metavar="HABIT", help="habit names (default: one per line of stdin)")
+    completer.add_argument("--user", help="username owning the habits")
+    completer.add_argument("--password", help="password of that user")
+    completer.add_argument("--date", help="day of the completions, YYYY-MM-DD (default: today)")
+    completer.set_defaults(handler=complete_habits)
+
+    streak_lister = commands.add_parser("streaks", help="print current and longest streaks as JSON")
+    streak_lister.add_argument("targets", nargs="*", metavar="HABIT", help="only these habits (default: all)")
+    streak_lister.add_argument("--user", help="username whose streaks are printed")
+    streak_lister.add_argument("--password", help="password of that user")
+    streak_lister.add_argument("--all", action="store_true", help="print the streaks of every user instead")
+    streak_lister.set_defaults(handler=show_streaks)
+
+    batch = commands.add_parser("batch", help="run a stream of user/habit/complete/streaks commands from stdin")
+    batch.set_defaults(handler=run_batch)
+
+    return parser
+
+
+def run(argv):
+    """
+    Parse argv, run the selected command and return its exit code.
+    """
+    args = build_parser().parse_args(argv)
+    args.logins = {}  # (username, password) -> User verified during this run
+    tracker = HabitTracker(args.db)
+    try:
+        return args.handler(tracker, args)
+    finally:
+        tracker.close()
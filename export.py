@@ -0,0 +1,126 @@
+import csv
+import json
+import time
+from datetime import date
+
+from bulk_import import DATE_FIELD, HABIT_FIELD
+import runs
+
+# Fields of an exported completion; 'habit' and 'date' are the columns bulk_import reads back
+COMPLETION_FIELDS = ("id", "username", HABIT_FIELD, "periodicity", DATE_FIELD)
+HABIT_FIELDS = ("id", "username", "name", "periodicity", "created_at")
+
+
+def iter_completions(conn, user_id=None, after_id=0, batch_size=1000):
+    """
+    Yield the completions of one user (or of everyone when user_id is None) as dicts, in id order.
+    Rows are read in pages of batch_size with keyset pagination (id > last id seen), so memory
+    stays constant and an interrupted export resumes from the last id it wrote (after_id).
+    Under run-length storage the pages are pages of runs, expanded here with the ids of the
+    completions view; completions added later to a run already exported are not revisited.
+    """
+    user_filter, params = ("AND h.user_id = ?", (user_id,)) if user_id is not None else ("", ())
+    if runs.uses_run_storage(conn):
+        yield from _iter_run_completions(conn, user_filter, params, after_id, batch_size)
+        return
+    while True:
+        page = conn.execute(f"""
+            SELECT c.id, u.username, h.name, h.periodicity, c.day FROM completions c
+            JOIN habits h ON h.id = c.habit_id
+            JOIN users u ON u.id = h.user_id
+            WHERE c.id > ? {user_filter}
+            ORDER BY c.id LIMIT ?
+        """, (after_id,) + params + (batch_size,)).fetchall()
+        for completion_id, username, name, periodicity, day in page:
+            yield dict(zip(COMPLETION_FIELDS, (completion_id, username, name, periodicity,
+                                               date.fromordinal(day).isoformat())))
+        if len(page) < batch_size:
+            return
+        after_id = page[-1][0]
+
+
+def _iter_run_completions(conn, user_filter, params, after_id, batch_size):
+    # A view id is (run id << 16) | position in the run, see runs.RUN_VIEW_SQL
+    after_run = after_id >> 16
+    while True:
+        page = conn.execute(f"""
+            SELECT r.id, u.username, h.name, h.periodicity, r.start, r.length FROM completion_runs r
+            JOIN habits h ON h.id = r.habit_id
+            JOIN users u ON u.id = h.user_id
+            WHERE r.id >= ? {user_filter}
+            ORDER BY r.id LIMIT ?
+        """, (after_run,) + params + (batch_size,)).fetchall()
+        for run_id, username, name, periodicity, start, length in page:
+            for step in range(length):
+                completion_id = run_id << 16 | step
+                if completion_id <= after_id:
+                    continue
+                day = (start + step) * 7 + 1 if periodicity == 'weekly' else start + step
+                yield dict(zip(COMPLETION_FIELDS, (completion_id, username, name, periodicity,
+                                                   date.fromordinal(day).isoformat())))
+        if len(page) < batch_size:
+            return
+        after_run = page[-1][0] + 1
+
+
+def iter_habits(conn, user_id=None, after_id=0, batch_size=1000):
+    """
+    Yield the habits of one user (or of everyone) as dicts, in id order, paginated like iter_completions.
+    """
+    user_filter, params = ("AND h.user_id = ?", (user_id,)) if user_id is not None else ("", ())
+    while True:
+        page = conn.execute(f"""
+            SELECT h.id, u.username, h.name, h.periodicity, h.created_at FROM habits h
+            JOIN users u ON u.id = h.user_id
+            WHERE h.id > ? {user_filter}
+            ORDER BY h.id LIMIT ?
+        """, (after_id,) + params + (batch_size,)).fetchall()
+        for row in page:
+            yield dict(zip(HABIT_FIELDS, row))
+        if len(page) < batch_size:
+            return
+        after_id = page[-1][0]
+
+
+def write_csv(records, stream, fields):
+    writer = csv.DictWriter(stream, fieldnames=fields)
+    # A resumed export appends to its earlier file, which already has the header
+    if not (stream.seekable() and stream.tell() > 0):
+        writer.writeheader()
+    for record in records:
+        writer.writerow(record)
+        yield record
+
+
+def write_ndjson(records, stream, fields):
+    for record in records:
+        stream.write(json.dumps(record) + "\n")
+        yield record
+
+
+WRITERS = {
+    "csv": write_csv,
+    "ndjson": write_ndjson,
+}
+
+
+def write_export(records, stream, fmt="csv", fields=COMPLETION_FIELDS):
+    """
+    Write records to a text stream as CSV or NDJSON, one at a time.
+    Returns a dict with the rows written, the elapsed seconds, the rows per second and the
+    cursor: the id of the last record written, to pass as after_id to resume the export.
+    """
+    if fmt not in WRITERS:
+        raise ValueError(f"Unsupported export format '{fmt}'. Use one of: {', '.join(sorted(WRITERS))}.")
+    started = time.perf_counter()
+    written, cursor = 0, None
+    for record in WRITERS[fmt](records, stream, fields):
+        written += 1
+        cursor = record["id"]
+    elapsed = time.perf_counter() - started
+    return {
+        "rows": written,
+        "seconds": elapsed,
+        "rows_per_sec": written / elapsed if elapsed else 0.0,
+        "cursor": cursor,
+    }
@@ -1,11 +1,34 @@
+import bisect
 import sqlite3
-from datetime import datetime
+from array import array
+from datetime import date, datetime
+
+# Days between 0001-12-31 (ordinal 0) and the julian day epoch, so that
+# julianday(date) - ORDINAL_OFFSET == date.toordinal().
+ORDINAL_OFFSET = 1721424.5
+
+
+def period_index(day, periodicity):
+    """
+    Convert a day ordinal (date.toordinal()) into the number of the period it falls in.
+    Daily habits count days, weekly habits count Monday-based weeks, so two
+    completions are consecutive when their period numbers differ by one.
+    """
+    if periodicity == 'weekly':
+        return (day - 1) // 7
+    return day
+
 
 class Habit:
     """
     Represents a habit, which can be completed daily or weekly.
-    It stores the name, periodicity, creation date, and a list of completion dates.
+    It stores the name, periodicity, creation date, and the completion days as day ordinals.
+    Habits are slotted and keep their completion days in a sorted array of C ints (4 bytes
+    a completion instead of a list entry and an int object), as whole users' histories are
+    loaded into memory.
     """
+    __slots__ = ("name", "periodicity", "created_at", "user_id", "id", "_completed_days", "_load_completed_days")
+
     def __init__(self, name, periodicity, user_id):
         """
         Initialize a new habit with a name, periodicity (daily/weekly),
@@ -15,34 +38,88 @@ class Habit:
         self.periodicity = periodicity
         self.created_at = datetime.now()
         self.user_id = user_id
-        self.completed_dates = []
+        self.id = None  # Set once the habit is stored
+        self.completed_days = ()
+
+    @property
+    def completed_days(self):
+        """
+        The completion days as day ordinals, in ascending order, in an array('i'). Habits read
+        by HabitTracker load them from the database on first access. Add days with
+        add_completion(), which keeps them sorted.
+        """
+        if self._load_completed_days is not None:
+            self.completed_days = self._load_completed_days()
+        return self._completed_days
+
+    @completed_days.setter
+    def completed_days(self, days):
+        self._completed_days = array('i', sorted(days))
+        self._load_completed_days = None
+
+    def load_completed_days_with(self, loader):
+        """
+        Defer reading completed_days until it is first accessed, then call loader() for them.
+        """
+        self._load_completed_days = loader
+
+    @property
+    def completed_dates(self):
+        """
+        The completion days as a tuple of date objects. It is rebuilt on every access, so
+        record completions with add_completion() or assign a new sequence.
+        """
+        return tuple(date.fromordinal(day) for day in self.completed_days)
+
+    @completed_dates.setter
+    def completed_dates(self, dates):
+        self.completed_days = [completion_date.toordinal() for completion_date in dates]
+
+    def add_completion(self, day):
+        """
+        Record a completion on a date or a day ordinal, keeping completed_days sorted.
+        """
+        bisect.insort(self.completed_days, day.toordinal() if isinstance(day, date) else day)
 
     def complete_habit(self):
         """
         Mark the habit as completed for the current date.
-        Adds the current date to the completed_dates list.
+        Adds the current day to completed_days.
         """
-        completion_date = datetime.now().date()
-        self.completed_dates.append(completion_date)
+        self.add_completion(date.today().toordinal())
+
+    def _runs(self):
+        """
+        Return the runs of consecutive periods as (last_period, length) pairs, oldest first.
+        Several completions inside the same period count once. completed_days is sorted,
+        so the periods come in order.
+        """
+        runs = []
+        for day in self.completed_days:
+            period = period_index(day, self.periodicity)
+            if not runs or period > runs[-1][0] + 1:
+                runs.append((period, 1))
+            elif period == runs[-1][0] + 1:
+                runs[-1] = (period, runs[-1][1] + 1)
+        return runs
 
     def streak(self):
         """
-        Calculate the current streak of consecutive completions based on the habit's periodicity (daily/weekly).
+        Calculate the longest streak of consecutive completions based on the habit's periodicity (daily/weekly).
         Returns the streak length (number of consecutive days or weeks).
         """
-        if not self.completed_dates:
-            return 0
-
-        self.completed_dates.sort()
-        streak = 1
-
-        for i in range(1, len(self.completed_dates)):
-            delta = (self.completed_dates[i] - self.completed_dates[i - 1]).days
+        return max((length for _, length in self._runs()), default=0)
 
-            if self.periodicity == 'daily' and delta == 1:
-                streak += 1
-            elif self.periodicity == 'weekly' and delta == 7:
-                streak += 1
-            else:
-                break  # Streak is broken
-        return streak
+    def current_streak(self, today=None):
+        """
+        Return the length of the streak that is still alive, i.e. the run of
+        consecutive completions ending in the current or the previous period.
+        """
+        runs = self._runs()
+        if not runs:
+            return 0
+        today = (today or date.today()).toordinal()
+        last_period, length = runs[-1]
+        if last_period >= period_index(today, self.periodicity) - 1:
+            return length
+        return 0
@@ -1,88 +1,423 @@
 
-import sqlite3
-from datetime import datetime
+import atexit
+import heapq
+import itertools
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import date, timedelta
+from bulk_import import parse_date, read_completions
 from habit import Habit
 from user import User
+import analytics
+import export
+import migrations
+import passwords
+import reminders
+import rollups
+import runs
+import shards
+import storage
+import streaks
+from cache import MISSING, HabitCache, TokenCache
+from instrumentation import Instrumentation
+from pool import ConnectionPool
+from write_behind import WriteBehindQueue
 
 class HabitTracker:
     """
     Manages multiple users and their habits. Allows adding, completing, deleting habits,
-    and analyzing them (like getting streaks). It uses an SQLite database for persistence.
+    and analyzing them (like getting streaks). It uses an SQLite database for persistence,
+    or keeps everything in memory with the memory backend.
     """
-    def __init__(self):
+    def __init__(self, db_path='habits.db', timeout=30.0, cache_size=1024, token_ttl=900, shards=None,
+                 backend="sqlite"):
         """
-        Initialize the HabitTracker with a connection to the SQLite database and create tables if they don't exist.
+        Initialize the HabitTracker with a connection pool for the SQLite database and create tables if they don't exist.
+        Each thread gets its own connection; timeout is how long a connection waits for a lock held by another.
+        Up to cache_size habit lists and histories are kept in memory between reads (0 disables the cache).
+        Session tokens from issue_token() are valid for token_ttl seconds.
+        With shards, users are spread over that many database files (see enable_sharding);
+        a database that was sharded before is opened sharded either way.
+        backend="memory" keeps users, habits and completions in this process instead (see
+        storage.MemoryStorage), ignoring db_path. It covers the user, habit, completion and
+        streak operations, including compute_streaks and rebuild_streaks; sharding, exports,
+        analytics, rollups, reminders and other maintenance need the SQLite database.
         """
-        self.conn = sqlite3.connect('habits.db')
+        if backend not in storage.BACKENDS:
+            raise ValueError(f"Unknown storage backend '{backend}'. Use one of: {', '.join(storage.BACKENDS)}.")
+        self.pool = ConnectionPool(db_path, timeout) if backend == "sqlite" else None
+        self.cache = HabitCache(cache_size) if cache_size else None
+        self.tokens = TokenCache(token_ttl)
+        # Holds the User object of the logged-in user. It is a context variable so
+        # that every thread or asyncio task has its own session.
+        self._current_user = ContextVar(f"current_user_{id(self)}", default=None)
+        self.instrumentation = None  # Set by enable_instrumentation()
+        self.write_behind = None  # Set by enable_write_behind()
+        self.password_hasher = None  # Set by enable_password_pool()
+        self.router = None  # Set by enable_sharding()
+        self._shard_map_version = None  # Of an unsharded database file, see _routes_changed()
+        # Shard that maintenance and cross-user operations are working on, see _on_shard()
+        self._shard = ContextVar(f"shard_{id(self)}", default=None)
+        if self.pool is None:
+            self.storage = storage.MemoryStorage()
+            if shards:
+                raise ValueError("Sharding needs a database file.")
+            return
         self.create_tables()
-        self.current_user = None  # Holds the User object of the logged-in user
+        self.storage = storage.SQLiteStorage(lambda: self.conn, lambda: self.catalog, stale=self._routes_changed)
+        if shards or self.catalog.execute("SELECT 1 FROM shards LIMIT 1").fetchone():
+            self.enable_sharding(shards or 1)
+        elif self.pool.db_path not in (None, ':memory:'):
+            self._shard_map_version = self._read_shard_map_version()
+
+    @property
+    def conn(self):
+        """
+        The database connection of the calling thread. On a sharded database it is the
+        connection to the logged-in user's shard (or the shard set by _on_shard()).
+        """
+        pool = self._sqlite_pool()
+        if self._shard_map_version is not None:
+            self._routes_changed()  # Another process may have sharded the database
+        if self.router is not None:
+            shard = self._shard.get()
+            if shard is None and self.current_user is not None:
+                shard = self.router.shard_of(self.current_user.id)
+            if shard is not None:
+                pool = self.router.pool(shard)
+        if self.instrumentation is not None:
+            return self.instrumentation.wrap(pool.connection())
+        return pool.connection()
+
+    @property
+    def catalog(self):
+        """
+        The calling thread's connection to the main database, which holds every user's credentials.
+        """
+        if self.instrumentation is not None:
+            return self.instrumentation.wrap(self._sqlite_pool().connection())
+        return self._sqlite_pool().connection()
+
+    def _sqlite_pool(self):
+        if self.pool is None:
+            raise ValueError("This operation needs the SQLite backend.")
+        return self.pool
+
+    @property
+    def run_storage(self):
+        """
+        True when completions are stored as runs of consecutive periods (see runs.py).
+        """
+        return self.storage.run_storage
+
+    @property
+    def current_user(self):
+        """
+        The User logged in within the current thread or task, or None.
+        """
+        return self._current_user.get()
+
+    @current_user.setter
+    def current_user(self, user):
+        self._current_user.set(user)
+
+    @contextmanager
+    def session(self, user=None):
+        """
+        Run a block with its own user context, restoring the previous one afterwards.
+        Useful when threads or tasks are reused across requests.
+        """
+        token = self._current_user.set(user)
+        try:
+            yield self
+        finally:
+            self._current_user.reset(token)
+
+    def close(self):
+        """
+        Flush queued completions and close all database connections.
+        """
+        self.disable_write_behind()
+        self.disable_instrumentation()
+        self.disable_password_pool()
+        if self.router is not None:
+            self.router.close()
+        if self.pool is not None:
+            self.pool.close()
+        self.storage.close()
+
+    def enable_instrumentation(self, dump_interval=None, dump_path=None):
+        """
+        Start measuring every public method: calls, latency histogram, SQL statements,
+        rows fetched and SQLite VM steps. With dump_interval (seconds) a snapshot is also
+        written periodically to dump_path, or to stderr. Returns the Instrumentation,
+        whose snapshot() gives the figures.
+        """
+        if self.instrumentation is None:
+            self.instrumentation = Instrumentation()
+            self.instrumentation.install(self)
+        if dump_interval:
+            self.instrumentation.start_periodic_dump(dump_interval, dump_path)
+        return self.instrumentation
+
+    def disable_instrumentation(self):
+        """
+        Stop measuring and restore the uninstrumented methods.
+        """
+        if self.instrumentation is not None:
+            self.instrumentation.uninstall(self)
+            self.instrumentation = None
+
+    def enable_write_behind(self, max_batch=500, max_delay=0.05):
+        """
+        Queue completions instead of writing each in its own transaction. complete_habit
+        then returns as soon as the completion is queued; the queue is written in one
+        transaction when max_batch completions are waiting or the oldest has waited
+        max_delay seconds, and always on logout, close() and interpreter exit.
+        Reads only see a completion once it is flushed, except get_habit_streak, which
+        folds the queued ones in. Completions that hit a lock timeout are queued again
+        and retried with a growing delay; one that fails with another error, even on its
+        own, is dropped and reported on stderr. Returns the WriteBehindQueue, whose stats()
+        report the queue depth, flush latency and dropped items.
+        """
+        if self.write_behind is None:
+            self.write_behind = WriteBehindQueue(self._write_completions, max_batch, max_delay)
+            atexit.register(self._flush_at_exit)
+        return self.write_behind
+
+    def disable_write_behind(self):
+        """
+        Flush the queued completions and write each new one immediately again.
+        """
+        if self.write_behind is not None:
+            atexit.unregister(self._flush_at_exit)
+            self.write_behind.close()
+            self.write_behind = None
+
+    def enable_password_pool(self, workers=None, max_pending=None):
+        """
+        Hash and verify passwords in a pool of worker processes (default: one per CPU)
+        instead of the calling thread, so that logins use every core. Returns the PasswordHasher.
+        """
+        if self.password_hasher is None:
+            self.password_hasher = passwords.PasswordHasher(workers, max_pending)
+        return self.password_hasher
+
+    def disable_password_pool(self):
+        """
+        Stop the password worker processes and hash in the calling thread again.
+        """
+        if self.password_hasher is not None:
+            self.password_hasher.close()
+            self.password_hasher = None
+
+    def _hash_password(self, password):
+        if self.password_hasher is not None:
+            return self.password_hasher.hash(password)
+        return passwords.hash_password(password)
+
+    def _verify_password(self, password, stored):
+        if self.password_hasher is not None:
+            return self.password_hasher.verify(password, stored)
+        return passwords.verify_password(password, stored)
+
+    def enable_sharding(self, count=2):
+        """
+        Spread users over `count` database files: the main database, which keeps every
+        user's credentials and the shard map, and count - 1 shard files next to it.
+        Each user's habits and completions live on one shard, and user operations go to
+        the logged-in user's shard. Existing users stay on the main database until moved
+        with split_shard(). Shards are only ever added. Returns the ShardRouter.
+        """
+        if self._sqlite_pool().db_path in (None, ':memory:'):
+            raise ValueError("Sharding needs a database file.")
+        if self.router is None:
+            self.router = shards.ShardRouter(self.pool, on_change=self._shard_map_changed)
+        while len(self.router.numbers()) < count:
+            self.router.add_shard()
+        return self.router
+
+    def _shard_numbers(self):
+        """
+        Return the numbers of the shards, or [None] when the database is not sharded.
+        """
+        return self.router.numbers() if self.router is not None else [None]
+
+    def _shard_map_changed(self):
+        """
+        Forget cached habits when shards were added or users moved, here or by another process:
+        moved users' habits have new ids.
+        """
+        if self.cache is not None:
+            self.cache.clear()
+
+    def _routes_changed(self):
+        """
+        Return True if the shard map changed since the current connection was picked,
+        for write transactions to restart on the user's new shard (see SQLiteStorage.transaction).
+        An unsharded database becomes sharded here once another process added shards to it.
+        """
+        if self.router is not None:
+            return self.router.refresh()
+        if self._shard_map_version is None or self._read_shard_map_version() == self._shard_map_version:
+            return False
+        self._shard_map_version = None
+        self.enable_sharding(1)
+        self._shard_map_changed()
+        return True
+
+    def _read_shard_map_version(self):
+        return self.pool.connection().execute("SELECT version FROM shard_map").fetchone()[0]
+
+    def _shard_connection(self, number):
+        """
+        Return the calling thread's connection to a shard (None: the only database).
+        """
+        with self._on_shard(number):
+            return self.conn
+
+    @contextmanager
+    def _on_shard(self, number):
+        """
+        Route self.conn to one shard for the duration of a block.
+        """
+        token = self._shard.set(number)
+        try:
+            yield
+        finally:
+            self._shard.reset(token)
+
+    def split_shard(self, number, path=None):
+        """
+        Rebalance a shard by moving half of its users, with their habits and completions,
+        to a new shard file (by default next to the main database). Returns a dict with the
+        new shard's number and the number of users moved.
+        """
+        if self.router is None:
+            raise ValueError("The database is not sharded.")
+        if number not in self.router.numbers():
+            raise ValueError(f"There is no shard {number}.")
+        self.flush_completions()
+        moved = self.router.users_on(number)[1::2]
+        target = self.router.add_shard(path)
+        for user_id in moved:
+            self.router.move_user(user_id, target)
+            if self.cache is not None:
+                self.cache.invalidate_user(user_id)
+        return {"shard": target, "moved": len(moved)}
+
+    def shard_info(self):
+        """
+        Return the number, file, users, habits and size in bytes of every shard.
+        """
+        info = []
+        for number in self._shard_numbers():
+            with self._on_shard(number):
+                conn = self.conn
+                path = conn.execute("PRAGMA database_list").fetchone()[2]
+                info.append({
+                    "shard": number or 0,
+                    "path": path,
+                    "users": len(self.router.users_on(number)) if self.router is not None else
+                             conn.execute("SELECT COUNT(*) FROM users").fetchone()[0],
+                    "habits": conn.execute("SELECT COUNT(*) FROM habits").fetchone()[0],
+                    "bytes": os.path.getsize(path) if path else 0,
+                })
+        return info
+
+    def flush_completions(self):
+        """
+        Write the queued completions now. Returns how many were written.
+        """
+        return self.write_behind.flush() if self.write_behind is not None else 0
+
+    def _flush_at_exit(self):
+        if self.write_behind is not None:
+            self.write_behind.close()
 
     def create_tables(self):
         """
-        Create the database tables for storing users, habits, and completions.
+        Create or upgrade the database tables for storing users, habits, and completions.
+        Pending schema migrations run once; an up-to-date database is left untouched.
+        The memory backend has no tables.
         """
-        with self.conn:
-            # Create the 'users' table to store user information
-            self.conn.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    username TEXT UNIQUE NOT NULL,
-                    password TEXT NOT NULL,
-                    created_at TEXT NOT NULL
-                )
-            """)
-            # Drop the old habits table if it exists to fix the missing user_id column
-            self.conn.execute("DROP TABLE IF EXISTS habits")
-
-            # Create the 'habits' table to store habits linked to users
-            self.conn.execute("""
-                CREATE TABLE IF NOT EXISTS habits (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT NOT NULL,
-                    periodicity TEXT NOT NULL,
-                    created_at TEXT NOT NULL,
-                    user_id INTEGER NOT NULL,
-                    FOREIGN KEY (user_id) REFERENCES users (id)
-                )
-            """)
-            # Create the 'completions' table to store habit completion dates
-            self.conn.execute("""
-                CREATE TABLE IF NOT EXISTS completions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    habit_id INTEGER NOT NULL,
-                    completion_date TEXT NOT NULL,
-                    FOREIGN KEY (habit_id) REFERENCES habits (id)
-                )
-            """)
+        if self.pool is None:
+            return
+        migrations.migrate(self.conn)
+
+    def set_completion_storage(self, mode):
+        """
+        Switch how completions are stored: 'rows' keeps one row per completion, 'runs' keeps
+        runs of consecutive completed periods per habit (see runs.py), with `completions`
+        left as a view. Converting to runs drops duplicate completions within a period and
+        the weekday of weekly completions. Returns True if the storage was converted.
+        """
+        if mode not in ('rows', 'runs'):
+            raise ValueError(f"Unknown completion storage '{mode}'; expected 'rows' or 'runs'.")
+        converted = False
+        for number in self._shard_numbers():
+            with self._on_shard(number), self.conn:
+                if mode == 'runs':
+                    changed = runs.use_run_storage(self.conn)
+                else:
+                    changed = runs.use_row_storage(self.conn)
+                if changed:
+                    streaks.rebuild_streaks(self.conn)
+                    rollups.rebuild_rollups(self.conn)
+                converted = converted or changed
+        self.storage.run_storage = mode == 'runs'
+        if converted and self.cache is not None:
+            self.cache.clear()
+        return converted
 
     # User Management Methods
 
     def create_user(self, username, password):
         """
-        Create a new user with the given username and password.
+        Create a new user with the given username and password. Only a salted hash of the password is stored.
         """
-        user = User(username, password)
-        try:
-            with self.conn:
-                self.conn.execute("""
-                    INSERT INTO users (username, password, created_at)
-                    VALUES (?, ?, ?)
-                """, (user.username, user.password, user.created_at))
-            print(f"User '{username}' created successfully.")
-            return True
-        except sqlite3.IntegrityError:
+        user = User(username, self._hash_password(password))
+        user.id = self.storage.add_user(user.username, user.password, user.created_at)
+        if user.id is None:
             print(f"Username '{username}' is already taken.")
             return False
+        if self.router is not None:
+            self.router.place_users([user.id])
+        print(f"User '{username}' created successfully.")
+        return True
+
+    def create_users(self, credentials):
+        """
+        Create many users at once from (username, password) pairs. The passwords are hashed
+        in parallel (in the password pool when enabled, else in worker processes) and the
+        users inserted in one transaction. Usernames already taken, or repeated, are skipped.
+        Returns a dict with the lists of created and taken usernames.
+        """
+        credentials = list(credentials)
+        if self.password_hasher is not None:
+            hashes = self.password_hasher.hash_many([password for _, password in credentials])
+        else:
+            hashes = passwords.hash_many([password for _, password in credentials])
+        users = [User(username, hashed) for (username, _), hashed in zip(credentials, hashes)]
+        ids = self.storage.add_users([(user.username, user.password, user.created_at) for user in users])
+        created = [user.username for user, user_id in zip(users, ids) if user_id is not None]
+        taken = [user.username for user, user_id in zip(users, ids) if user_id is None]
+        if self.router is not None:
+            self.router.place_users([user_id for user_id in ids if user_id is not None])
+        print(f"Created {len(created)} user(s), {len(taken)} username(s) already taken.")
+        return {"created": created, "taken": taken}
 
     def login_user(self, username, password):
         """
-        Log in a user by verifying the username and password.
+        Log in a user by verifying the username and password. A password stored in plaintext
+        or with an outdated iteration count is hashed again once it has been verified.
         """
-        cursor = self.conn.execute("""
-            SELECT id, username, password FROM users WHERE username = ?
-        """, (username,))
-        result = cursor.fetchone()
-        if result and result[2] == password:
+        result = self.storage.find_user(username)
+        if result and self._verify_password(password, result[2]):
+            if passwords.needs_rehash(result[2]):
+                self.storage.set_password(result[0], self._hash_password(password))
             self.current_user = User(result[1], result[2])
             self.current_user.id = result[0]  # Assign the user ID from the database
             print(f"User '{username}' logged in successfully.")
@@ -91,10 +426,39 @@ class HabitTracker:
             print("Invalid username or password.")
             return False
 
+    def issue_token(self):
+        """
+        Return a session token for the logged-in user, valid for token_ttl seconds, or None.
+        """
+        if not self.current_user:
+            print("No user is logged in. Please log in first.")
+            return None
+        return self.tokens.issue(self.current_user.id, self.current_user.username)
+
+    def login_with_token(self, token):
+        """
+        Log in the user a session token was issued to, without verifying a password.
+        Returns False if the token is unknown or expired.
+        """
+        session = self.tokens.get(token)
+        if session is None:
+            print("Invalid or expired session token.")
+            return False
+        self.current_user = User(session[1], None)
+        self.current_user.id = session[0]
+        return True
+
+    def revoke_token(self, token):
+        """
+        End a token's session early. Returns True if the token was valid.
+        """
+        return self.tokens.revoke(token)
+
     def logout_user(self):
         """
-        Log out the current user.
+        Log out the current user, writing any queued completions first.
         """
+        self.flush_completions()
         if self.current_user:
             print(f"User '{self.current_user.username}' logged out.")
             self.current_user = None
@@ -105,83 +469,362 @@ class HabitTracker:
 
     def add_habit(self, habit):
         """
-        Add a new habit to the current user.
+        Add a new habit to the current user. Returns True if it was added.
         """
         if not self.current_user:
             print("No user is logged in. Please log in first.")
-            return
+            return False
 
-        self.conn.execute("""
-            INSERT INTO habits (name, periodicity, created_at, user_id)
-            VALUES (?, ?, ?, ?)
-        """, (habit.name, habit.periodicity, habit.created_at, self.current_user.id))
-        self.conn.commit()
+        with self.storage.transaction():
+            habit_id = self.storage.add_habit(self.current_user.id, habit.name, habit.periodicity, habit.created_at)
+        if habit_id is None:
+            print(f"Habit '{habit.name}' already exists for user '{self.current_user.username}'.")
+            return False
+        self._invalidate(None, habit.name)
         print(f"Habit '{habit.name}' added successfully for user '{self.current_user.username}'.")
+        return True
+
+    def add_habits(self, habits):
+        """
+        Add many habits to the current user in one transaction. Habits whose name the user
+        already has are skipped. Returns a dict with the lists of added and existing names,
+        or None if no user is logged in.
+        """
+        if not self.current_user:
+            print("No user is logged in. Please log in first.")
+            return None
+
+        added, existing = [], []
+        with self.storage.transaction():
+            for habit in habits:
+                if self.storage.add_habit(self.current_user.id, habit.name, habit.periodicity,
+                                          habit.created_at) is None:
+                    existing.append(habit.name)
+                else:
+                    added.append(habit.name)
+        if added:
+            self._invalidate(None, *added)
+        print(f"Added {len(added)} habit(s) for user '{self.current_user.username}', "
+              f"{len(existing)} already existed.")
+        return {"added": added, "existing": existing}
 
     def get_user_habits(self):
         """
-        Retrieve all habits for the current user.
+        Retrieve all habits for the current user. Their completed_dates are loaded on first access.
         """
         if not self.current_user:
             print("No user is logged in. Please log in first.")
             return []
 
-        cursor = self.conn.execute("""
-            SELECT id, name, periodicity, created_at FROM habits
-            WHERE user_id = ?
-        """, (self.current_user.id,))
-        habits = []
-        for row in cursor.fetchall():
-            habit = Habit(row[1], row[2], self.current_user.id)
-            habit.id = row[0]
-            habit.created_at = row[3]
-            habits.append(habit)
-        return habits
+        user_id = self.current_user.id
+        rows = MISSING
+        if self.cache is not None:
+            rows = self.cache.get(user_id)
+            version = self.cache.version(user_id)
+        if rows is MISSING:
+            rows = self.storage.habits(user_id)
+            if self.cache is not None:
+                self.cache.put(user_id, None, rows, version)
+        # The cache holds the rows, so every call hands out its own Habit objects
+        return [self._new_habit(row, user_id) for row in rows]
 
-    def complete_habit(self, habit_name):
+    def list_habits(self, name=None, periodicity=None, created_from=None, created_to=None,
+                    limit=50, after_id=0):
+        """
+        Return one page of the current user's habits ordered by id, optionally filtered by
+        a name substring, a periodicity and a creation date range (inclusive dates or
+        'YYYY-MM-DD' strings). Pass the id of the last habit of a page as after_id to get the next.
+        Their completed_dates are loaded on first access.
+        """
+        if not self.current_user:
+            print("No user is logged in. Please log in first.")
+            return []
+
+        bounds = [parse_date(value) for value in (created_from, created_to) if value is not None]
+        if None in bounds:
+            print("Invalid date, expected YYYY-MM-DD.")
+            return []
+        if created_from is not None:
+            created_from = parse_date(created_from)
+        if created_to is not None:
+            created_to = date.fromordinal(parse_date(created_to).toordinal() + 1)
+        rows = self.storage.page_habits(self.current_user.id, name, periodicity, created_from, created_to,
+                                        limit, after_id)
+        return [self._new_habit(row, self.current_user.id) for row in rows]
+
+    def get_habit(self, habit_name):
         """
-        Mark a habit as completed for the current user.
+        Return a habit of the current user, or None if it does not exist, without reading the
+        user's other habits. Its completed_dates are loaded on first access.
+        The result is cached until the habit is written to, so it must not be modified.
         """
         if not self.current_user:
             print("No user is logged in. Please log in first.")
+            return None
+
+        user_id = self.current_user.id
+        if self.cache is not None:
+            habit = self.cache.get(user_id, habit_name)
+            if habit is not MISSING:
+                return habit
+            version = self.cache.version(user_id)
+
+        result = self.storage.find_habit(user_id, habit_name)
+        if not result:
+            return None
+        habit = self._new_habit(result, user_id)
+        if self.cache is not None:
+            self.cache.put(user_id, habit_name, habit, version)
+        return habit
+
+    def _new_habit(self, row, user_id):
+        """
+        Build a Habit from an (id, name, periodicity, created_at) row, with lazily loaded completions.
+        """
+        habit_id, name, periodicity, created_at = row
+        habit = Habit(name, periodicity, user_id)
+        habit.id = habit_id
+        habit.created_at = created_at
+        habit.load_completed_days_with(lambda: self.storage.completion_days(habit_id, periodicity))
+        return habit
+
+    def cache_stats(self):
+        """
+        Return the hit/miss counters of the habit cache, or None when it is disabled.
+        """
+        return self.cache.stats() if self.cache is not None else None
+
+    def _invalidate(self, *habit_names):
+        """
+        Drop cached entries of the current user after a write: the given habits
+        (None for the habit list), or everything when no name is given.
+        """
+        if self.cache is None:
             return
+        if habit_names:
+            self.cache.invalidate(self.current_user.id, *habit_names)
+        else:
+            self.cache.invalidate_user(self.current_user.id)
 
-        cursor = self.conn.execute("""
-            SELECT id FROM habits WHERE name = ? AND user_id = ?
-        """, (habit_name, self.current_user.id))
-        result = cursor.fetchone()
+    def complete_habit(self, habit_name):
+        """
+        Mark a habit as completed for the current user. Returns True if the habit was found.
+        With write-behind enabled the completion is queued and written with the next flush.
+        """
+        if not self.current_user:
+            print("No user is logged in. Please log in first.")
+            return False
+
+        completion_date = date.today()
+        day = completion_date.toordinal()
+        if self.write_behind is not None:
+            result = self.storage.find_habit(self.current_user.id, habit_name)
+            if result:
+                self.write_behind.put((self.current_user.id, habit_name, result[0], result[2], day))
+        else:
+            # Looked up under the write lock, so the habit can't move to another shard in between
+            with self.storage.transaction():
+                result = self.storage.find_habit(self.current_user.id, habit_name)
+                if result:
+                    self.storage.record_completion(result[0], result[2], day)
+            if result:
+                self._invalidate(habit_name)
         if result:
-            habit_id = result[0]
-            completion_date = datetime.now().date()
-            self.conn.execute("""
-                INSERT INTO completions (habit_id, completion_date)
-                VALUES (?, ?)
-            """, (habit_id, completion_date))
-            self.conn.commit()
             print(f"Habit '{habit_name}' marked as completed on {completion_date}.")
+            return True
         else:
             print(f"Habit '{habit_name}' not found for user '{self.current_user.username}'.")
+            return False
+
+    def complete_habits(self, habit_names, completion_date=None):
+        """
+        Mark several habits of the current user as completed on a day (default: today) in one
+        transaction, folding each completion into the streak table like complete_habit. Unlike
+        bulk_import, which rebuilds the user's streaks afterwards, the cost does not grow with
+        the length of the history. Returns a dict with the completions stored, the duplicates
+        ignored and the unknown habit names, or None if no user is logged in.
+        """
+        if not self.current_user:
+            print("No user is logged in. Please log in first.")
+            return None
+
+        completion_date = parse_date(completion_date) if completion_date is not None else date.today()
+        if completion_date is None:
+            print("Invalid completion date. Use YYYY-MM-DD.")
+            return None
+        day = completion_date.toordinal()
+        self.flush_completions()  # Keep queued completions ahead of these
+        completed, duplicates, unknown = [], 0, []
+        with self.storage.transaction():
+            habits = {name: (habit_id, periodicity)
+                      for habit_id, name, periodicity, _ in self.storage.habits(self.current_user.id)}
+            for habit_name in habit_names:
+                habit = habits.get(habit_name)
+                if habit is None:
+                    unknown.append(habit_name)
+                    continue
+                if self.storage.record_completion(*habit, day):
+                    completed.append(habit_name)
+                else:
+                    duplicates += 1
+        if completed:
+            self._invalidate(*completed)
+        return {"completed": len(completed), "duplicates": duplicates, "unknown": unknown}
+
+    def _write_completions(self, batch):
+        """
+        Write a batch of queued (user_id, habit_name, habit_id, periodicity, day)
+        completions in a single transaction (one per shard).
+        """
+        remaining = batch
+        while remaining:
+            by_shard, pending = {}, []
+            for item in remaining:
+                by_shard.setdefault(self.router.shard_of(item[0]) if self.router is not None else None, []).append(item)
+            for number, items in by_shard.items():
+                with self._on_shard(number), self.storage.transaction():
+                    for item in items:
+                        user_id, habit_name, habit_id, periodicity, day = item
+                        if self.router is not None:
+                            # The user may have moved since the completion was queued, and
+                            # habits get new ids on their new shard
+                            if self.router.shard_of(user_id) != number:
+                                pending.append(item)
+                                continue
+                            habit = self.storage.find_habit(user_id, habit_name)
+                            if habit is None:
+                                continue  # Deleted since
+                            habit_id = habit[0]
+                        self.storage.record_completion(habit_id, periodicity, day)
+            remaining = pending
+        if self.cache is not None:
+            for user_id, habit_name, _, _, _ in batch:
+                self.cache.invalidate(user_id, habit_name)
+
+    def bulk_import(self, completions, batch_size=10000):
+        """
+        Record many completions for the current user at once. completions is an iterable of
+        (habit_name, completion_date) pairs, with dates as date objects or 'YYYY-MM-DD' strings.
+        It is consumed in batches of batch_size rows, each inserted in a single transaction,
+        and the streak table is refreshed once at the end.
+        Completions already recorded are ignored.
+        Returns a dict with the rows imported, skipped (unknown habit or bad date) and duplicated,
+        the elapsed seconds and the rows per second.
+        """
+        if not self.current_user:
+            print("No user is logged in. Please log in first.")
+            return None
+
+        weekly = {name: periodicity == 'weekly' for _, name, periodicity, _ in self.storage.habits(self.current_user.id)}
+        started = time.perf_counter()
+        imported = skipped = duplicates = 0
+        batch = []
+        try:
+            for habit_name, completion_date in completions:
+                completion_date = parse_date(completion_date)
+                if habit_name not in weekly or completion_date is None:
+                    skipped += 1
+                    continue
+                day = completion_date.toordinal()
+                batch.append((habit_name, day, (day - 1) // 7 if weekly[habit_name] else day))
+                if len(batch) >= batch_size:
+                    stored = self._import_batch(batch)
+                    imported += stored
+                    duplicates += len(batch) - stored
+                    batch = []
+            if batch:
+                stored = self._import_batch(batch)
+                imported += stored
+                duplicates += len(batch) - stored
+        finally:
+            if imported:
+                self.storage.refresh(self.current_user.id)
+                self._invalidate()
+
+        elapsed = time.perf_counter() - started
+        return {
+            "imported": imported,
+            "skipped": skipped,
+            "duplicates": duplicates,
+            "seconds": elapsed,
+            "rows_per_sec": imported / elapsed if elapsed else 0.0,
+        }
+
+    def _import_batch(self, batch):
+        """
+        Insert (habit_name, day, period) completions of the current user in one transaction,
+        looking the habit ids up under the write lock. Returns how many were stored.
+        """
+        with self.storage.transaction():
+            ids = {name: habit_id for habit_id, name, _, _ in self.storage.habits(self.current_user.id)}
+            return self.storage.insert_completions([(ids[name], day, period) for name, day, period in batch
+                                                    if name in ids])
+
+    def import_file(self, path, fmt=None, batch_size=10000):
+        """
+        Stream completions for the current user from a CSV or NDJSON file into bulk_import.
+        """
+        return self.bulk_import(read_completions(path, fmt), batch_size)
+
+    def export_completions(self, all_users=False, after_id=0, batch_size=1000):
+        """
+        Return an iterator over the completions of the current user, or of every user when
+        all_users is True, as dicts with the fields of export.COMPLETION_FIELDS in id order.
+        Rows are fetched lazily in pages of batch_size; pass the id of the last row already
+        written as after_id to resume an interrupted export. Write them with export.write_export.
+        On a sharded database every user's completions are read shard by shard; completion
+        ids are only unique within a shard, so such an export cannot be resumed.
+        """
+        if not all_users and not self.current_user:
+            print("No user is logged in. Please log in first.")
+            return iter(())
+        self.flush_completions()
+        if not all_users:
+            return export.iter_completions(self.conn, self.current_user.id, after_id, batch_size)
+        if self.router is not None and after_id:
+            print("An export of every user of a sharded database cannot be resumed.")
+            return iter(())
+        return itertools.chain.from_iterable(
+            export.iter_completions(self._shard_connection(number), None, after_id, batch_size)
+            for number in self._shard_numbers()
+        )
+
+    def export_habits(self, all_users=False, batch_size=1000):
+        """
+        Return an iterator over the habits of the current user, or of every user, as dicts
+        with the fields of export.HABIT_FIELDS, fetched lazily like export_completions.
+        """
+        if not all_users and not self.current_user:
+            print("No user is logged in. Please log in first.")
+            return iter(())
+        if not all_users:
+            return export.iter_habits(self.conn, self.current_user.id, batch_size=batch_size)
+        return itertools.chain.from_iterable(
+            export.iter_habits(self._shard_connection(number), batch_size=batch_size)
+            for number in self._shard_numbers()
+        )
 
     def delete_habit(self, habit_name):
         """
-        Delete a specific habit for the current user.
+        Delete a specific habit for the current user. Returns True if the habit was found.
         """
         if not self.current_user:
             print("No user is logged in. Please log in first.")
-            return
+            return False
 
-        cursor = self.conn.execute("""
-            SELECT id FROM habits WHERE name = ? AND user_id = ?
-        """, (habit_name, self.current_user.id))
-        result = cursor.fetchone()
+        # Queued completions of the habit must not outlive it
+        self.flush_completions()
+        with self.storage.transaction():
+            result = self.storage.find_habit(self.current_user.id, habit_name)
+            if result:
+                self.storage.delete_habit(result[0])
         if result:
-            habit_id = result[0]
-            with self.conn:
-                self.conn.execute("DELETE FROM habits WHERE id = ?", (habit_id,))
-                self.conn.execute("DELETE FROM completions WHERE habit_id = ?", (habit_id,))
+            self._invalidate(None, habit_name)
             print(f"Habit '{habit_name}' has been deleted for user '{self.current_user.username}'.")
+            return True
         else:
             print(f"Habit '{habit_name}' not found for user '{self.current_user.username}'.")
+            return False
 
     def delete_all_habits(self):
         """
@@ -189,12 +832,64 @@ class HabitTracker:
         """
         if not self.current_user:
             print("No user is logged in. Please log in first.")
-            return
+            return False
 
-        with self.conn:
-            self.conn.execute("DELETE FROM completions WHERE habit_id IN (SELECT id FROM habits WHERE user_id = ?)", (self.current_user.id,))
-            self.conn.execute("DELETE FROM habits WHERE user_id = ?", (self.current_user.id,))
+        self.flush_completions()
+        with self.storage.transaction():
+            self.storage.delete_user_habits(self.current_user.id)
+        self._invalidate()
         print(f"All habits have been deleted for user '{self.current_user.username}'.")
+        return True
+
+    def get_streaks(self):
+        """
+        Return the current and longest streak of every habit of the current user,
+        computed in one query, as (habit_name, periodicity, current_streak, longest_streak) tuples.
+        """
+        if not self.current_user:
+            print("No user is logged in. Please log in first.")
+            return []
+
+        return self.storage.streaks(self.current_user.id)
+
+    def compute_streaks(self, all_users=False):
+        """
+        Compute current and longest streaks with the batch kernel (vectorized when NumPy is
+        installed) for the current user, or for every user when all_users is True. Under
+        run-length storage the streaks are read from the runs instead.
+        Returns (user_id, habit_name, periodicity, current_streak, longest_streak) tuples ordered by habit id.
+        """
+        if not all_users and not self.current_user:
+            print("No user is logged in. Please log in first.")
+            return []
+        if all_users and self.router is not None and self._shard.get() is None:
+            results = []
+            for number in self._shard_numbers():
+                with self._on_shard(number):
+                    results.extend(self.compute_streaks(all_users=True))
+            return results
+
+        results, habits = self.storage.compute_streaks(None if all_users else self.current_user.id)
+        return [
+            (user_id, name, periodicity) + results.get(habit_id, (0, 0))
+            for habit_id, user_id, name, periodicity in habits
+        ]
+
+    def leaderboard(self, top=10, workers=None):
+        """
+        Analyze every user at once, independently of the logged-in user: the top users by
+        longest streak and summary tables of habits, completions and completion rates.
+        Users are sharded by id across a pool of worker processes (one per CPU by default)
+        reading the database file; an in-memory database is analyzed in this process.
+        See analytics.run_report for the returned dict.
+        """
+        self.flush_completions()
+        if self._sqlite_pool().db_path in (None, ':memory:'):
+            return analytics.run_report(conn=self.conn, top=top, workers=1)
+        if self.router is not None:
+            paths = [self.router.pool(number).db_path for number in self._shard_numbers()]
+            return analytics.run_report(paths, top=top, workers=workers)
+        return analytics.run_report(self.pool.db_path, top=top, workers=workers)
 
     def get_longest_streak(self):
         """
@@ -204,23 +899,173 @@ class HabitTracker:
             print("No user is logged in. Please log in first.")
             return None, 0
 
-        habits = self.get_user_habits()
-        longest_streak = 0
-        longest_habit = None
+        result = self.storage.longest_streak(self.current_user.id)
+        if result:
+            return result[0], result[1]
+        return None, 0
+
+    def get_habit_streak(self, habit_name):
+        """
+        Return the (current_streak, longest_streak) of a habit of the current user,
+        read from the maintained streak table, or None if the habit does not exist.
+        Completions still queued by write-behind are counted too.
+        """
+        if not self.current_user:
+            print("No user is logged in. Please log in first.")
+            return None
 
-        for habit in habits:
-            completions = self.conn.execute("""
-                SELECT completion_date FROM completions
-                WHERE habit_id = ?
-                ORDER BY completion_date ASC
-            """, (habit.id,)).fetchall()
-            habit.completed_dates = [datetime.strptime(row[0], "%Y-%m-%d").date() for row in completions]
-            current_streak = habit.streak()
-            if current_streak > longest_streak:
-                longest_streak = current_streak
-                longest_habit = habit.name
+        habit = self.storage.find_habit(self.current_user.id, habit_name)
+        if not habit:
+            print(f"Habit '{habit_name}' not found for user '{self.current_user.username}'.")
+            return None
+        state = self.storage.streak_state(habit[0])
+        if self.write_behind is not None:
+            queued = [item for item in self.write_behind.queued() if item[:2] == (self.current_user.id, habit_name)]
+            for _, _, _, periodicity, day in sorted(queued, key=lambda item: item[4]):
+                state = streaks.advance(state, periodicity, day)
+        current, longest, last_period = state
+        if not streaks.is_alive(habit[2], last_period):
+            current = 0
+        return current, longest
 
-        return longest_habit, longest_streak
+    def rebuild_streaks(self, check_only=False):
+        """
+        Recompute the streak table from the completions and return the drift found
+        before rebuilding, as returned by streaks.verify_streaks. With check_only the table is left as is.
+        """
+        drift = []
+        for number in self._shard_numbers():
+            with self._on_shard(number):
+                drift.extend(self.storage.rebuild_streaks(check_only))
+        return drift
+
+    def due_habits(self, all_users=False, overdue=False, limit=None, today=None):
+        """
+        Return the current user's habits (or everyone's) that still have to be completed in
+        the current period, or with overdue only those that missed a whole period, most
+        overdue first. Each is a dict with the habit and user ids and names, the periodicity,
+        the date it became due and whether it is overdue. Read from the next_due index.
+        """
+        if not all_users and not self.current_user:
+            print("No user is logged in. Please log in first.")
+            return []
+        self.flush_completions()
+        today = (today or date.today()).toordinal()
+        if not all_users:
+            return reminders.due_habits(self.conn, today, self.current_user.id, overdue, limit)
+        # Every shard's list is in due order already; merge them
+        due = heapq.merge(*(reminders.due_habits(self._shard_connection(number), today, None, overdue, limit)
+                            for number in self._shard_numbers()), key=lambda habit: habit["due"])
+        return list(itertools.islice(due, limit))
+
+    def reminder_scheduler(self, remind=None, hour=9):
+        """
+        Return a ReminderScheduler over every user's habits that calls remind(habit) (by
+        default prints) when a habit becomes due at `hour` o'clock and at the start of every
+        period it stays uncompleted. Call its tick() periodically, or start() it in a thread.
+        A sharded database gets a ReminderGroup running one scheduler per shard.
+        """
+        def print_reminder(habit):
+            state = "overdue since" if habit["overdue"] else "due"
+            print(f"Reminder for {habit['username']}: '{habit['habit']}' is {state} {habit['due']}.")
+
+        if self.router is None:
+            return reminders.ReminderScheduler(lambda: self.conn, remind or print_reminder, hour)
+        return reminders.ReminderGroup([
+            reminders.ReminderScheduler(lambda number=number: self._shard_connection(number),
+                                        remind or print_reminder, hour)
+            for number in self._shard_numbers()
+        ])
+
+    def completion_rates(self, habit_name=None, kind="week", start=None, end=None):
+        """
+        Return the completion rate of the current user's habits (or of one habit) per ISO week
+        or per month ('week' or 'month') between two dates, by default the last 12 buckets
+        up to today. Each entry has the bucket label, its first day, the completions, the
+        periods that could have been completed and the rate. Read from the rollup table.
+        """
+        if kind not in rollups.KINDS:
+            raise ValueError(f"Unknown bucket '{kind}'; expected 'week' or 'month'.")
+        end = parse_date(end) if end is not None else date.today()
+        if start is not None:
+            start = parse_date(start)
+        elif end is not None:
+            start = end - timedelta(weeks=11) if kind == "week" else date(end.year - (end.month < 12), end.month % 12 + 1, 1)
+        habits = self._rollup_habits(habit_name)
+        if habits is None or start is None or end is None:
+            return []
+        return rollups.completion_series(self.conn, habits, kind, start.toordinal(), end.toordinal())
+
+    def completion_heatmap(self, habit_name=None, start=None, end=None):
+        """
+        Return {'YYYY-MM-DD': completions} for every day between two dates (by default the
+        last year), summed over the current user's habits or for one habit.
+        """
+        end = parse_date(end) if end is not None else date.today()
+        start = parse_date(start) if start is not None else end - timedelta(days=364) if end else None
+        habits = self._rollup_habits(habit_name)
+        if habits is None or start is None or end is None:
+            return {}
+        return rollups.heatmap(self.conn, [habit_id for habit_id, _, _ in habits], start.toordinal(), end.toordinal())
+
+    def _rollup_habits(self, habit_name=None):
+        """
+        Return (habit_id, periodicity, created_day) of the current user's habits, or of the
+        named one, or None after printing why there are none to report on.
+        """
+        if not self.current_user:
+            print("No user is logged in. Please log in first.")
+            return None
+        name_filter, params = ("AND name = ?", (habit_name,)) if habit_name is not None else ("", ())
+        habits = self.conn.execute(f"""
+            SELECT id, periodicity, CAST(julianday(created_at) - {migrations.ORDINAL_OFFSET} AS INTEGER)
+            FROM habits WHERE user_id = ? {name_filter}
+        """, (self.current_user.id,) + params).fetchall()
+        if habit_name is not None and not habits:
+            print(f"Habit '{habit_name}' not found for user '{self.current_user.username}'.")
+            return None
+        return habits
+
+    def compact(self):
+        """
+        Remove completions and streak rows left behind by habits that no longer exist
+        (older versions dropped the habits table without them), refresh the query
+        planner statistics (ANALYZE) and rebuild the database file (VACUUM).
+        Returns a dict with the rows removed and the database size before and after, in bytes.
+        """
+        self.flush_completions()
+        if self.router is not None:
+            totals = {}
+            for number in self._shard_numbers():
+                with self._on_shard(number):
+                    for key, value in self._compact().items():
+                        totals[key] = totals.get(key, 0) + value
+            return totals
+        return self._compact()
+
+    def _compact(self):
+        size = lambda: self.conn.execute("PRAGMA page_count").fetchone()[0] * \
+            self.conn.execute("PRAGMA page_size").fetchone()[0]
+        with self.conn:
+            orphaned = self.conn.execute(f"""
+                DELETE FROM {self.storage._completion_table()} WHERE habit_id NOT IN (SELECT id FROM habits)
+            """).rowcount
+            orphaned_streaks = self.conn.execute("""
+                DELETE FROM habit_streaks WHERE habit_id NOT IN (SELECT id FROM habits)
+            """).rowcount
+            self.conn.execute("DELETE FROM completion_rollups WHERE habit_id NOT IN (SELECT id FROM habits)")
+            self.conn.execute("ANALYZE")
+        # Deleted rows only free pages inside the file, so its size is taken before VACUUM
+        bytes_before = size()
+        self.conn.execute("VACUUM")
+        bytes_after = size()
+        return {
+            "orphaned_completions": orphaned,
+            "orphaned_streaks": orphaned_streaks,
+            "bytes_before": bytes_before,
+            "bytes_after": bytes_after,
+            "bytes_reclaimed": bytes_before - bytes_after,
+        }
 
     def get_habits_by_periodicity(self, periodicity):
         """
@@ -230,7 +1075,4 @@ class HabitTracker:
             print("No user is logged in. Please log in first.")
             return []
 
-        cursor = self.conn.execute("""
-            SELECT name FROM habits WHERE periodicity = ? AND user_id = ?
-        """, (periodicity, self.current_user.id))
-        return [row[0] for row in cursor.fetchall()]
+        return self.storage.habit_names(self.current_user.id, periodicity)
@@ -0,0 +1,254 @@
+import json
+import sys
+import threading
+import time
+from functools import wraps
+
+# Upper bounds (ms) of the latency histogram buckets; slower calls land in the last, open bucket
+LATENCY_BUCKETS_MS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000)
+
+# The SQLite progress handler runs every this many virtual machine instructions
+PROGRESS_INTERVAL = 1000
+
+# HabitTracker methods that are plumbing rather than operations
+NOT_INSTRUMENTED = {"session", "close", "enable_instrumentation", "disable_instrumentation",
+                    "enable_write_behind", "disable_write_behind", "enable_password_pool",
+                    "disable_password_pool"}
+
+
+class MethodStats:
+    """
+    Counters for one instrumented method.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.statements = 0
+        self.rows = 0
+        self.vm_steps = 0
+
+    def as_dict(self):
+        labels = [f"<={bound}ms" for bound in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}ms"]
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "total_ms": self.total_seconds * 1000,
+            "mean_ms": self.total_seconds * 1000 / self.calls if self.calls else 0.0,
+            "latency_histogram": dict(zip(labels, self.histogram)),
+            "statements": self.statements,
+            "rows_fetched": self.rows,
+            "vm_steps": self.vm_steps,
+        }
+
+
+class Instrumentation:
+    """
+    Records, per public HabitTracker method, the call count, a latency histogram, the SQL
+    statements run (sqlite3 trace callback), the rows fetched and the SQLite virtual machine
+    steps (progress handler). Nested calls are counted in every enclosing method.
+    Nothing is wrapped or traced until it is installed, so a tracker without it pays nothing.
+    """
+    def __init__(self):
+        self.stats = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._connections = {}
+        self._dump_stop = None
+
+    # Installing on a tracker
+
+    def install(self, tracker):
+        """
+        Wrap the public methods of tracker so that they are measured.
+        """
+        for name in dir(type(tracker)):
+            attribute = getattr(type(tracker), name)
+            if name.startswith("_") or name in NOT_INSTRUMENTED or not callable(attribute):
+                continue
+            setattr(tracker, name, self._measure(name, getattr(tracker, name)))
+
+    def uninstall(self, tracker):
+        """
+        Restore the original methods of tracker and stop tracing its connections.
+        """
+        for name in list(vars(tracker)):
+            if getattr(vars(tracker)[name], "__instrumented__", False):
+                delattr(tracker, name)
+        self.stop_periodic_dump()
+        with self._lock:
+            connections, self._connections = list(self._connections.values()), {}
+        for conn in connections:
+            conn.set_trace_callback(None)
+            conn.set_progress_handler(None, 0)
+
+    def wrap(self, conn):
+        """
+        Return conn wrapped so that its statements and fetched rows are counted.
+        """
+        if id(conn) not in self._connections:
+            with self._lock:
+                self._connections[id(conn)] = conn
+            conn.set_trace_callback(self._on_statement)
+            conn.set_progress_handler(self._on_progress, PROGRESS_INTERVAL)
+        return TracedConnection(conn, self)
+
+    def _measure(self, name, method):
+        stats = self.stats.setdefault(name, MethodStats())
+
+        @wraps(method)
+        def measured(*args, **kwargs):
+            active = self._active()
+            active.append(stats)
+            started = time.perf_counter()
+            failed = False
+            try:
+                return method(*args, **kwargs)
+            except BaseException:
+                failed = True
+                raise
+            finally:
+                elapsed = time.perf_counter() - started
+                active.pop()
+                bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS_MS) if elapsed * 1000 <= bound),
+                              len(LATENCY_BUCKETS_MS))
+                with self._lock:
+                    stats.calls += 1
+                    stats.errors += failed
+                    stats.total_seconds += elapsed
+                    stats.histogram[bucket] += 1
+
+        measured.__instrumented__ = True
+        return measured
+
+    # Counters fed by the database callbacks, attributed to the methods running in this thread
+
+    def _active(self):
+        active = getattr(self._local, "active", None)
+        if active is None:
+            active = self._local.active = []
+        return active
+
+    def _add(self, field, amount):
+        active = self._active()
+        if active:
+            with self._lock:
+                for stats in active:
+                    setattr(stats, field, getattr(stats, field) + amount)
+
+    def _on_statement(self, statement):
+        self._add("statements", 1)
+
+    def _on_progress(self):
+        self._add("vm_steps", PROGRESS_INTERVAL)
+        return 0
+
+    def count_rows(self, count):
+        if count:
+            self._add("rows", count)
+
+    # Reporting
+
+    def snapshot(self):
+        """
+        Return the counters of every method that was called, keyed by method name.
+        """
+        with self._lock:
+            return {name: stats.as_dict() for name, stats in sorted(self.stats.items()) if stats.calls}
+
+    def reset(self):
+        """
+        Zero all counters.
+        """
+        with self._lock:
+            for name in self.stats:
+                self.stats[name].__init__()
+
+    def dump(self, stream=None):
+        """
+        Write the current snapshot as one JSON line, with a timestamp.
+        """
+        stream = stream or sys.stderr
+        stream.write(json.dumps({"time": time.time(), "methods": self.snapshot()}) + "\n")
+        stream.flush()
+
+    def start_periodic_dump(self, interval, path=None):
+        """
+        Dump a snapshot every `interval` seconds from a background thread, appending to the
+        file at path (or writing to stderr).
+        """
+        self.stop_periodic_dump()
+        stop = self._dump_stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                if path:
+                    with open(path, "a") as handle:
+                        self.dump(handle)
+                else:
+                    self.dump()
+
+        threading.Thread(target=run, name="instrumentation-dump", daemon=True).start()
+
+    def stop_periodic_dump(self):
+        if self._dump_stop is not None:
+            self._dump_stop.set()
+            self._dump_stop = None
+
+
+class TracedConnection:
+    """
+    Connection proxy whose cursors report the rows they hand out to an Instrumentation.
+    """
+    def __init__(self, conn, instrumentation):
+        self._conn = conn
+        self._instrumentation = instrumentation
+
+    def execute(self, *args):
+        return TracedCursor(self._conn.execute(*args), self._instrumentation)
+
+    def executemany(self, *args):
+        return TracedCursor(self._conn.executemany(*args), self._instrumentation)
+
+    def __enter__(self):
+        self._conn.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._conn.__exit__(*exc_info)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class TracedCursor:
+    """
+    Cursor proxy counting the rows fetched through it.
+    """
+    def __init__(self, cursor, instrumentation):
+        self._cursor = cursor
+        self._instrumentation = instrumentation
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        self._instrumentation.count_rows(row is not None)
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._cursor.fetchmany(*args)
+        self._instrumentation.count_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._instrumentation.count_rows(len(rows))
+        return rows
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._instrumentation.count_rows(1)
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
@@ -1,6 +1,7 @@
 from habit_tracker import HabitTracker
 from habit import Habit
 from datetime import datetime, timedelta  # Fix added here
+import sys
 
 def preload_habits_with_data(tracker):
     """
@@ -20,6 +21,7 @@ def preload_habits_with_data(tracker):
         print("No user is logged in. Please log in first.")
         return
 
+    completions = []
     for habit_data in predefined_habits:
         habit = Habit(habit_data["name"], habit_data["periodicity"], user_id)
         tracker.add_habit(habit)
@@ -35,15 +37,10 @@ def preload_habits_with_data(tracker):
                 (datetime.now() - timedelta(weeks=i)).date()
                 for i in range(4)  # Weekly completions for 4 weeks
             ]
+        completions.extend((habit.name, completion_date) for completion_date in completion_dates)
 
-        print(f"Preloading data for habit: {habit_data['name']}")  # Debugging line
-        for completion_date in completion_dates:
-            print(f"- Adding completion date: {completion_date}")  # Debugging line
-            tracker.conn.execute("""
-                INSERT INTO completions (habit_id, completion_date)
-                VALUES ((SELECT id FROM habits WHERE name = ? AND user_id = ?), ?)
-            """, (habit.name, user_id, completion_date))
-        tracker.conn.commit()
+    result = tracker.bulk_import(completions)
+    print(f"Preloaded {result['imported']} completions for {len(predefined_habits)} habits.")
 
 
 def main():
@@ -51,6 +48,11 @@ def main():
     Command-line interface to interact with the HabitTracker app.
     Allows users to create accounts, log in, add, complete, delete, analyze, and manage habits.
     """
+    if len(sys.argv) > 1:
+        # Run a maintenance command instead of the interactive menu
+        import cli
+        sys.exit(cli.run(sys.argv[1:]))
+
     tracker = HabitTracker()
 
     predefined_habits = ["Exercise", "Meditate", "Read", "Walk", "Drink Water"]
@@ -184,22 +186,10 @@ def main():
 
                 elif analyze_choice == '4':
                     name = input("Enter habit name to check longest streak: ")
-                    habits = tracker.get_user_habits()
-                    habit_found = next((h for h in habits if h.name == name), None)
-                    if habit_found:
-                        completions = tracker.conn.execute("""
-                            SELECT completion_date FROM completions
-                            WHERE habit_id = ?
-                            ORDER BY completion_date ASC
-                        """, (habit_found.id,)).fetchall()
-                        habit_found.completed_dates = [
-                            datetime.strptime(row[0], "%Y-%m-%d").date() for row in completions
-                        ]
-                        print(f"Loaded completion dates: {habit_found.completed_dates}")  # Debugging line
-                        streak = habit_found.streak()
-                        print(f"Longest streak for '{name}': {streak} consecutive completions.")
-                    else:
-                        print(f"Habit '{name}' not found.")
+                    result = tracker.get_habit_streak(name)
+                    if result:
+                        current, longest = result
+                        print(f"Longest streak for '{name}': {longest} consecutive completions (current: {current}).")
 
                 elif analyze_choice == '5':
                     continue
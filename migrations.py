@@ -0,0 +1,315 @@
+import passwords
+import reminders
+import rollups
+import streaks
+from habit import ORDINAL_OFFSET
+
+# Each migration brings the schema from version N-1 to version N, where N is its
+# position in MIGRATIONS (starting at 1). The version reached is stored in
+# PRAGMA user_version, so a step runs exactly once per database. Steps must
+# still be idempotent: databases created before versioning already have some
+# of the tables, at user_version 0. A step may only rely on the schema of its
+# own version, so the streak table is (re)computed by the latest step that
+# changes its inputs rather than by the step creating it.
+
+def _columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def create_base_tables(conn):
+    """
+    Create the users, habits and completions tables, upgrading the layouts
+    written by earlier versions of the app.
+    """
+    # Create the 'users' table to store user information
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+    """)
+    # Very old databases have a habits table without user_id; those habits
+    # cannot be attributed to anyone, so the table is recreated
+    habit_columns = _columns(conn, "habits")
+    if habit_columns and "user_id" not in habit_columns:
+        conn.execute("DROP TABLE habits")
+
+    # Create the 'habits' table to store habits linked to users
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS habits (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            periodicity TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    """)
+    # Older completions tables have no id column; copy them into the current layout
+    completion_columns = _columns(conn, "completions")
+    if completion_columns and "id" not in completion_columns:
+        conn.execute("ALTER TABLE completions RENAME TO completions_old")
+
+    # Create the 'completions' table to store habit completion dates
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS completions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            habit_id INTEGER NOT NULL,
+            completion_date TEXT NOT NULL,
+            FOREIGN KEY (habit_id) REFERENCES habits (id)
+        )
+    """)
+    if completion_columns and "id" not in completion_columns:
+        conn.execute("""
+            INSERT INTO completions (habit_id, completion_date)
+            SELECT habit_id, completion_date FROM completions_old
+            WHERE habit_id IS NOT NULL AND completion_date IS NOT NULL
+            ORDER BY rowid
+        """)
+        conn.execute("DROP TABLE completions_old")
+
+
+def create_streak_table(conn):
+    """
+    Create the 'habit_streaks' table holding the streak state of each habit.
+    current_streak is the length of the most recent run; it only counts while
+    last_period is the current or previous period.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS habit_streaks (
+            habit_id INTEGER PRIMARY KEY,
+            current_streak INTEGER NOT NULL DEFAULT 0,
+            longest_streak INTEGER NOT NULL DEFAULT 0,
+            last_period INTEGER,
+            last_completion TEXT,
+            total_completions INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY (habit_id) REFERENCES habits (id)
+        )
+    """)
+
+
+def create_indexes(conn):
+    """
+    Create the indexes for the lookups every habit operation does: by name within a user,
+    by periodicity within a user, and the completions of one habit in date order.
+    Habits sharing a name within a user are merged into the oldest one first.
+    """
+    duplicates = conn.execute("""
+        SELECT h.id, keep.id FROM habits h
+        JOIN (SELECT MIN(id) AS id, user_id, name FROM habits GROUP BY user_id, name HAVING COUNT(*) > 1) keep
+          ON keep.user_id = h.user_id AND keep.name = h.name AND keep.id <> h.id
+    """).fetchall()
+    for habit_id, keep_id in duplicates:
+        conn.execute("UPDATE completions SET habit_id = ? WHERE habit_id = ?", (keep_id, habit_id))
+        conn.execute("DELETE FROM habit_streaks WHERE habit_id = ?", (habit_id,))
+        conn.execute("DELETE FROM habits WHERE id = ?", (habit_id,))
+
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_habits_user_name ON habits (user_id, name)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_habits_user_periodicity ON habits (user_id, periodicity)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_completions_habit_date ON completions (habit_id, completion_date)")
+
+
+def store_day_ordinals(conn):
+    """
+    Store completion dates as integer day ordinals (date.toordinal()) instead of
+    'YYYY-MM-DD' text, together with the period they fall in: the day for daily
+    habits and the Monday-based week number for weekly ones. The streak table
+    keeps the ordinal of the last completion and is recomputed.
+    """
+    conn.execute("""
+        CREATE TABLE completions_days (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            habit_id INTEGER NOT NULL,
+            day INTEGER NOT NULL,
+            period INTEGER NOT NULL,
+            FOREIGN KEY (habit_id) REFERENCES habits (id)
+        )
+    """)
+    conn.execute(f"""
+        INSERT INTO completions_days (id, habit_id, day, period)
+        SELECT id, habit_id, day, CASE periodicity WHEN 'weekly' THEN (day - 1) / 7 ELSE day END
+        FROM (
+            SELECT c.id, c.habit_id, h.periodicity,
+                   CAST(julianday(c.completion_date) - {ORDINAL_OFFSET} AS INTEGER) AS day
+            FROM completions c
+            LEFT JOIN habits h ON h.id = c.habit_id
+            WHERE julianday(c.completion_date) IS NOT NULL
+        )
+    """)
+    conn.execute("DROP TABLE completions")
+    conn.execute("ALTER TABLE completions_days RENAME TO completions")
+    conn.execute("CREATE INDEX idx_completions_habit_day ON completions (habit_id, day, period)")
+
+    conn.execute("DROP TABLE habit_streaks")
+    conn.execute("""
+        CREATE TABLE habit_streaks (
+            habit_id INTEGER PRIMARY KEY,
+            current_streak INTEGER NOT NULL DEFAULT 0,
+            longest_streak INTEGER NOT NULL DEFAULT 0,
+            last_period INTEGER,
+            last_day INTEGER,
+            total_completions INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY (habit_id) REFERENCES habits (id)
+        )
+    """)
+    streaks.rebuild_streaks(conn)
+
+
+def create_run_table(conn):
+    """
+    Create the completion_runs table used by run-length storage (see runs.py).
+    It stays empty while completions are stored one row each.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS completion_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            habit_id INTEGER NOT NULL,
+            start INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            FOREIGN KEY (habit_id) REFERENCES habits (id)
+        )
+    """)
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_completion_runs_habit_start ON completion_runs (habit_id, start)")
+
+
+def deduplicate_completions(conn):
+    """
+    Remove repeated completions of a habit on the same day, keeping the first,
+    and make the completions index unique so that they cannot come back.
+    The period is derived from the day, so the index is unique per (habit_id, day).
+    Databases using run-length storage have no duplicates to remove.
+    """
+    kind = conn.execute("SELECT type FROM sqlite_master WHERE name = 'completions'").fetchone()
+    if kind is None or kind[0] != 'table':
+        return
+    conn.execute("""
+        DELETE FROM completions WHERE id NOT IN (
+            SELECT MIN(id) FROM completions GROUP BY habit_id, day
+        )
+    """)
+    conn.execute("DROP INDEX IF EXISTS idx_completions_habit_day")
+    conn.execute("CREATE UNIQUE INDEX idx_completions_habit_day ON completions (habit_id, day, period)")
+    streaks.rebuild_streaks(conn)
+
+
+def create_rollup_table(conn):
+    """
+    Create completion_rollups, the completion counts per habit and ISO week or month
+    (see rollups.py), and fill it from the existing completions.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS completion_rollups (
+            habit_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            completions INTEGER NOT NULL,
+            PRIMARY KEY (habit_id, kind, bucket)
+        ) WITHOUT ROWID
+    """)
+    rollups.rebuild_rollups(conn)
+
+
+def add_next_due(conn):
+    """
+    Store on every habit the first day of the earliest period it still has to be completed
+    in (see reminders.py), indexed so that due habits are found without reading histories.
+    """
+    conn.execute("ALTER TABLE habits ADD COLUMN next_due INTEGER")
+    reminders.rebuild_next_due(conn)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_habits_next_due ON habits (next_due)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_habits_user_next_due ON habits (user_id, next_due)")
+
+
+def hash_passwords(conn):
+    """
+    Replace the plaintext passwords stored by earlier versions with salted PBKDF2 hashes.
+    """
+    plaintext = [(user_id, password) for user_id, password in conn.execute("SELECT id, password FROM users")
+                 if not passwords.is_hashed(password)]
+    hashes = passwords.hash_many([password for _, password in plaintext])
+    conn.executemany("UPDATE users SET password = ? WHERE id = ?",
+                     [(hashed, user_id) for (user_id, _), hashed in zip(plaintext, hashes)])
+
+
+def create_shard_tables(conn):
+    """
+    Create the shard map of sharded databases (see shards.py): the shard files and the
+    shard each user lives on. Both stay empty until sharding is enabled.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS shards (
+            number INTEGER PRIMARY KEY,
+            path TEXT NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_shards (
+            user_id INTEGER PRIMARY KEY,
+            shard INTEGER NOT NULL
+        )
+    """)
+
+
+def create_shard_map_version(conn):
+    """
+    Create the shard map version, bumped whenever shards are added or users moved, so that
+    every open tracker notices the change and stops using the routes it has cached.
+    """
+    conn.execute("CREATE TABLE IF NOT EXISTS shard_map (version INTEGER NOT NULL)")
+    if not conn.execute("SELECT 1 FROM shard_map").fetchone():
+        conn.execute("INSERT INTO shard_map (version) VALUES (0)")
+
+
+MIGRATIONS = [
+    create_base_tables,
+    create_streak_table,
+    create_indexes,
+    store_day_ordinals,
+    create_run_table,
+    deduplicate_completions,
+    create_rollup_table,
+    add_next_due,
+    hash_passwords,
+    create_shard_tables,
+    create_shard_map_version,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def schema_version(conn):
+    """
+    Return the schema version recorded in the database.
+    """
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn):
+    """
+    Bring the database schema up to SCHEMA_VERSION, running each pending migration once.
+    Returns the list of migration names that were applied (empty when the schema was current).
+    """
+    if schema_version(conn) == SCHEMA_VERSION:
+        return []
+
+    applied = []
+    # Take the write lock before re-reading the version so that two processes
+    # starting at the same time do not both run the same migration
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        version = schema_version(conn)
+        if version > SCHEMA_VERSION:
+            raise RuntimeError(
+                f"Database schema version {version} is newer than this app supports ({SCHEMA_VERSION})."
+            )
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+            applied.append(migration.__name__)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return applied
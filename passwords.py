@@ -0,0 +1,109 @@
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# Passwords are stored as "pbkdf2_sha256$<iterations>$<salt>$<hash>" with a random
+# salt per user (salt and hash in base64). The iteration count is part of the stored
+# value, so raising ITERATIONS only affects new hashes; older ones are upgraded on login.
+ALGORITHM = "pbkdf2_sha256"
+ITERATIONS = 600_000
+SALT_BYTES = 16
+
+
+def hash_password(password, iterations=None, salt=None):
+    """
+    Return the stored form of a password, hashed with PBKDF2-HMAC-SHA256.
+    """
+    iterations = iterations or ITERATIONS
+    salt = salt or secrets.token_bytes(SALT_BYTES)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+    return "$".join((ALGORITHM, str(iterations), base64.b64encode(salt).decode("ascii"),
+                     base64.b64encode(digest).decode("ascii")))
+
+
+def is_hashed(stored):
+    """
+    Return True if a stored password is a hash rather than legacy plaintext.
+    """
+    return stored.startswith(ALGORITHM + "$")
+
+
+def verify_password(password, stored):
+    """
+    Return True if password matches the stored hash. Plaintext left by versions that did
+    not hash passwords is still accepted, so such users can log in and get upgraded.
+    """
+    if not is_hashed(stored):
+        return hmac.compare_digest(password.encode("utf-8"), stored.encode("utf-8"))
+    try:
+        _, iterations, salt, digest = stored.split("$")
+        expected = base64.b64decode(digest)
+        actual = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), base64.b64decode(salt), int(iterations))
+    except ValueError:
+        return False
+    return hmac.compare_digest(actual, expected)
+
+
+def needs_rehash(stored, iterations=None):
+    """
+    Return True if a stored password is plaintext or hashed with another iteration count.
+    """
+    return not is_hashed(stored) or stored.split("$")[1] != str(iterations or ITERATIONS)
+
+
+def hash_many(passwords, workers=None):
+    """
+    Hash a list of passwords, in parallel worker processes when there are several CPUs.
+    """
+    workers = min(workers or os.cpu_count() or 1, len(passwords))
+    if workers <= 1:
+        return [hash_password(password) for password in passwords]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(hash_password, passwords, [ITERATIONS] * len(passwords),
+                                 chunksize=max(1, len(passwords) // (workers * 4))))
+
+
+class PasswordHasher:
+    """
+    Hashes and verifies passwords in a pool of `workers` processes (default: one per CPU),
+    so that the key derivation runs on every core instead of holding up the calling thread's
+    process. At most max_pending calls are handed to the pool at once; further callers wait
+    for a slot, which keeps a login burst from queueing unbounded work.
+    """
+    def __init__(self, workers=None, max_pending=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.workers * 4
+        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+
+    def _run(self, function, *args):
+        with self._slots:
+            return self._executor.submit(function, *args).result()
+
+    def hash(self, password, iterations=None):
+        """
+        Hash a password in a worker process.
+        """
+        # Resolved here, as worker processes may not share this process's ITERATIONS
+        return self._run(hash_password, password, iterations or ITERATIONS)
+
+    def hash_many(self, passwords, iterations=None):
+        """
+        Hash a list of passwords across the worker processes.
+        """
+        iterations = iterations or ITERATIONS
+        chunksize = max(1, len(passwords) // (self.workers * 4))
+        return list(self._executor.map(hash_password, passwords, [iterations] * len(passwords), chunksize=chunksize))
+
+    def verify(self, password, stored):
+        """
+        Check a password against its stored hash in a worker process.
+        """
+        return self._run(verify_password, password, stored)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,96 @@
+import sqlite3
+import threading
+from contextlib import nullcontext
+
+
+class ConnectionPool:
+    """
+    Hands out one SQLite connection per thread, opened on first use. File databases run in
+    WAL mode so readers never block the writer, and every connection waits up to `timeout`
+    seconds for a lock instead of failing with 'database is locked'.
+    An in-memory database, or an existing connection passed in, is shared by all threads
+    through a SharedConnection, which lets one thread's transaction run at a time.
+    """
+    def __init__(self, db_path=None, timeout=30.0, connection=None):
+        """
+        Create a pool for the database at db_path, or a pool serving a single existing connection.
+        """
+        self.db_path = db_path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._shared = SharedConnection(connection) if connection is not None else None
+        if connection is None and db_path == ':memory:':
+            self._shared = SharedConnection(self._open())
+
+    def connection(self):
+        """
+        Return the connection of the calling thread, opening it if needed.
+        """
+        if self._shared is not None:
+            return self._shared
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._open()
+        return conn
+
+    def _open(self):
+        conn = sqlite3.connect(self.db_path, timeout=self.timeout, check_same_thread=False)
+        if self.db_path != ':memory:':
+            conn.execute("PRAGMA journal_mode = WAL")
+            # In WAL mode NORMAL only syncs at checkpoints and stays consistent on power loss
+            conn.execute("PRAGMA synchronous = NORMAL")
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    def close(self):
+        """
+        Close every connection opened by the pool.
+        """
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        if self._shared is not None:
+            self._shared.close()
+        self._local = threading.local()
+
+
+class SharedConnection:
+    """
+    Proxy of a connection used by several threads. A `with conn:` block holds a lock until
+    it commits or rolls back, so that threads don't commit or roll back each other's work;
+    hold() takes the same lock for a transaction begun explicitly.
+    """
+    def __init__(self, conn):
+        self._conn = conn
+        self._lock = threading.RLock()
+
+    def hold(self):
+        """
+        Return the lock giving the calling thread exclusive use of the connection.
+        """
+        return self._lock
+
+    def __enter__(self):
+        self._lock.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            return self._conn.__exit__(*exc_info)
+        finally:
+            self._lock.release()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def hold(conn):
+    """
+    Return a context manager giving the calling thread exclusive use of conn while it is
+    shared between threads, or doing nothing for a connection of its own.
+    """
+    return conn.hold() if hasattr(conn, "hold") else nullcontext()
@@ -0,0 +1,276 @@
+import heapq
+import threading
+import time
+from datetime import date, datetime
+
+from habit import ORDINAL_OFFSET, period_index
+
+# Every habit keeps next_due, the day ordinal of the first day of the earliest period
+# it still has to be completed in: the day after its last completion for daily habits,
+# the Monday after it for weekly ones, or the start of the period it was created in.
+# A habit is due once next_due is today or earlier, and overdue once it has missed a
+# whole period, i.e. next_due is before the start of the current period.
+
+# next_due of habits h from their creation date and streak row s (see streaks.py)
+NEXT_DUE_SQL = f"""
+    CASE h.periodicity
+        WHEN 'weekly' THEN COALESCE((s.last_day - 1) / 7 + 1,
+                                    (CAST(julianday(h.created_at) - {ORDINAL_OFFSET} AS INTEGER) - 1) / 7) * 7 + 1
+        ELSE COALESCE(s.last_day + 1, CAST(julianday(h.created_at) - {ORDINAL_OFFSET} AS INTEGER))
+    END
+"""
+
+
+def period_start(period, periodicity):
+    """
+    Return the day ordinal of the first day of a period.
+    """
+    return period * 7 + 1 if periodicity == 'weekly' else period
+
+
+def next_due_day(day, periodicity):
+    """
+    Return the next_due of a habit last completed on a day ordinal.
+    """
+    return period_start(period_index(day, periodicity) + 1, periodicity)
+
+
+def is_overdue(next_due, periodicity, today):
+    """
+    Return True if a habit has missed at least one whole period.
+    """
+    return next_due < period_start(period_index(today, periodicity), periodicity)
+
+
+def record(conn, habit_id, periodicity, day):
+    """
+    Move next_due past a new completion. Must run inside the transaction that stored it.
+    """
+    conn.execute("UPDATE habits SET next_due = MAX(COALESCE(next_due, 0), ?) WHERE id = ?",
+                 (next_due_day(day, periodicity), habit_id))
+
+
+def rebuild_next_due(conn, habit_filter="1", params=()):
+    """
+    Recompute next_due of the habits matching habit_filter (on habits h) from their
+    streak rows, which must be up to date. The caller owns the transaction.
+    """
+    conn.execute(f"""
+        UPDATE habits SET next_due = (
+            SELECT {NEXT_DUE_SQL} FROM habits h LEFT JOIN habit_streaks s ON s.habit_id = h.id
+            WHERE h.id = habits.id
+        )
+        WHERE id IN (SELECT h.id FROM habits h WHERE {habit_filter})
+    """, params)
+
+
+def due_habits(conn, today, user_id=None, overdue=False, limit=None):
+    """
+    Return the habits due on a day ordinal (or only the overdue ones) of one user, or of
+    everyone when user_id is None, most overdue first. Only the due part of the next_due
+    index is read. Each habit is a dict with its ids, names, due date and overdue flag.
+    """
+    user_filter, params = ("AND h.user_id = ?", (user_id,)) if user_id is not None else ("", ())
+    # A daily habit is overdue from yesterday, a weekly one from before this week's Monday
+    until = today - 1 if overdue else today
+    rows = conn.execute(f"""
+        SELECT h.id, h.user_id, u.username, h.name, h.periodicity, h.next_due FROM habits h
+        JOIN users u ON u.id = h.user_id
+        WHERE h.next_due <= ? {user_filter}
+        ORDER BY h.next_due, h.id
+        {"LIMIT ?" if limit is not None and not overdue else ""}
+    """, (until,) + params + ((limit,) if limit is not None and not overdue else ()))
+    habits = []
+    for row in rows:
+        habit = reminder(row, today)
+        if overdue and not habit["overdue"]:
+            continue
+        habits.append(habit)
+        if limit is not None and len(habits) >= limit:
+            break
+    return habits
+
+
+def reminder(row, today):
+    """
+    Return the dict of a (habit_id, user_id, username, name, periodicity, next_due) row.
+    """
+    habit_id, user_id, username, name, periodicity, next_due = row
+    return {
+        "habit_id": habit_id,
+        "user_id": user_id,
+        "username": username,
+        "habit": name,
+        "periodicity": periodicity,
+        "due": date.fromordinal(next_due).isoformat(),
+        "overdue": is_overdue(next_due, periodicity, today),
+    }
+
+
+class ReminderScheduler:
+    """
+    Emits a reminder for every habit when it becomes due (at `hour` o'clock on its
+    next_due day) and again at the start of each period it stays uncompleted, in due order.
+    Pending reminders are kept in a heap of (day, habit_id), so a tick only pops the
+    reminders that are due, and each day's habits are read once from the next_due index
+    when that day comes; habits created meanwhile are picked up by id. A popped entry is
+    checked against its habit row, so completed and deleted habits are skipped without
+    updating the heap. `connect` returns the database connection to use.
+    """
+    def __init__(self, connect, remind=None, hour=9, clock=time.time, batch_size=10000):
+        self.connect = connect
+        self.remind = remind or (lambda habit: None)
+        self.hour = hour
+        self.clock = clock
+        self.batch_size = batch_size
+        self._heap = []
+        self._scheduled = {}  # habit_id -> day of its live heap entry; other entries are stale
+        self._loaded_until = None  # Habits with next_due up to this day have been read
+        self._last_id = 0  # Highest habit id seen, to pick up new habits
+        self.emitted = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._scheduled)
+
+    def current_day(self, now=None):
+        """
+        Return the last day whose reminders are due at `now`: today once `hour` has passed.
+        """
+        moment = datetime.fromtimestamp(self.clock() if now is None else now)
+        today = moment.date().toordinal()
+        return today if moment.hour >= self.hour else today - 1
+
+    def _schedule(self, habit_id, day):
+        current = self._scheduled.get(habit_id)
+        if current is not None and current <= day:
+            return  # The earlier entry is checked and rescheduled when it fires
+        self._scheduled[habit_id] = day
+        heapq.heappush(self._heap, (day, habit_id))
+
+    def _load(self, conn, until):
+        # Read the habits whose next_due entered the window since the last load, by index range
+        cursor = (self._loaded_until + 1 if self._loaded_until is not None else 0, 0)
+        while True:
+            page = conn.execute("""
+                SELECT next_due, id FROM habits
+                WHERE (next_due, id) > (?, ?) AND next_due <= ?
+                ORDER BY next_due, id LIMIT ?
+            """, cursor + (until, self.batch_size)).fetchall()
+            for next_due, habit_id in page:
+                self._schedule(habit_id, next_due)
+            if len(page) < self.batch_size:
+                break
+            cursor = page[-1]
+        self._loaded_until = until
+
+    def _load_new_habits(self, conn, until):
+        for habit_id, next_due in conn.execute("""
+            SELECT id, next_due FROM habits WHERE id > ? ORDER BY id
+        """, (self._last_id,)):
+            self._last_id = habit_id
+            if next_due is not None and next_due <= until:
+                self._schedule(habit_id, next_due)
+
+    def tick(self, now=None):
+        """
+        Emit the reminders due at `now` (default: the clock) and return them.
+        """
+        conn = self.connect()
+        today = self.current_day(now)
+        if self._loaded_until is None:
+            self._last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM habits").fetchone()[0]
+        if self._loaded_until is None or today > self._loaded_until:
+            self._load(conn, today)
+        self._load_new_habits(conn, today)
+
+        emitted = []
+        while self._heap and self._heap[0][0] <= today:
+            day, habit_id = heapq.heappop(self._heap)
+            if self._scheduled.get(habit_id) != day:
+                continue  # Superseded by an earlier entry
+            del self._scheduled[habit_id]
+            row = conn.execute("""
+                SELECT h.id, h.user_id, u.username, h.name, h.periodicity, h.next_due FROM habits h
+                JOIN users u ON u.id = h.user_id WHERE h.id = ?
+            """, (habit_id,)).fetchone()
+            if row is None:
+                continue  # Deleted
+            periodicity, next_due = row[4], row[5]
+            if next_due > today:
+                continue  # Completed since; read again when its new next_due comes
+            habit = reminder(row, today)
+            self.remind(habit)
+            emitted.append(habit)
+            # Remind again when the next period starts if it is still not completed
+            self._schedule(habit_id, next_due_day(today, periodicity))
+        self.emitted += len(emitted)
+        return emitted
+
+    def next_wakeup(self):
+        """
+        Return the time (as clock() seconds) when the earliest pending reminder is due, or None.
+        """
+        while self._heap and self._scheduled.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return None
+        return datetime.combine(date.fromordinal(self._heap[0][0]), datetime.min.time()).replace(
+            hour=self.hour).timestamp()
+
+    def start(self, interval=60.0):
+        """
+        Run tick() every `interval` seconds in a background thread until stop().
+        """
+        def run():
+            while not self._stop.wait(interval):
+                self.tick()
+
+        self._stop.clear()
+        self.tick()
+        self._thread = threading.Thread(target=run, name="reminders", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class ReminderGroup:
+    """
+    Runs one ReminderScheduler per shard of a sharded database (see shards.py) as one.
+    """
+    def __init__(self, schedulers):
+        self.schedulers = schedulers
+
+    def __len__(self):
+        return sum(len(scheduler) for scheduler in self.schedulers)
+
+    @property
+    def emitted(self):
+        return sum(scheduler.emitted for scheduler in self.schedulers)
+
+    def tick(self, now=None):
+        """
+        Emit the reminders due at `now` on every shard and return them in due order.
+        """
+        emitted = [habit for scheduler in self.schedulers for habit in scheduler.tick(now)]
+        return sorted(emitted, key=lambda habit: habit["due"])
+
+    def next_wakeup(self):
+        return min((wakeup for wakeup in (scheduler.next_wakeup() for scheduler in self.schedulers)
+                    if wakeup is not None), default=None)
+
+    def start(self, interval=60.0):
+        for scheduler in self.schedulers:
+            scheduler.start(interval)
+
+    def stop(self):
+        for scheduler in self.schedulers:
+            scheduler.stop()
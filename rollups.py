@@ -0,0 +1,181 @@
+from datetime import date
+
+import runs
+from habit import ORDINAL_OFFSET
+
+# Completion counts per habit and calendar bucket, so that progress graphs read a
+# few rows per habit instead of every completion. Weeks are ISO weeks (Monday to
+# Sunday) numbered like weekly periods, (day - 1) // 7; months are year * 12 + month - 1.
+KINDS = ("week", "month")
+
+# SQL expressions of the bucket of a day ordinal column, matching bucket()
+BUCKET_SQL = {
+    "week": "(c.day - 1) / 7",
+    "month": f"CAST(strftime('%Y', c.day + {ORDINAL_OFFSET}) AS INTEGER) * 12"
+             f" + CAST(strftime('%m', c.day + {ORDINAL_OFFSET}) AS INTEGER) - 1",
+}
+
+
+def bucket(day, kind):
+    """
+    Return the week or month bucket number of a day ordinal.
+    """
+    if kind == "week":
+        return (day - 1) // 7
+    first = date.fromordinal(day)
+    return first.year * 12 + first.month - 1
+
+
+def bucket_days(number, kind):
+    """
+    Return the first and last day ordinals of a bucket.
+    """
+    if kind == "week":
+        return number * 7 + 1, number * 7 + 7
+    year, month = divmod(number, 12)
+    following = date(year + (month == 11), (month + 1) % 12 + 1, 1)
+    return date(year, month + 1, 1).toordinal(), following.toordinal() - 1
+
+
+def bucket_label(number, kind):
+    """
+    Return '2024-W05' for a week bucket or '2024-02' for a month bucket.
+    """
+    if kind == "week":
+        year, week, _ = date.fromordinal(number * 7 + 1).isocalendar()
+        return f"{year}-W{week:02d}"
+    year, month = divmod(number, 12)
+    return f"{year}-{month + 1:02d}"
+
+
+def record(conn, habit_id, day):
+    """
+    Count one new completion in the week and month buckets of its day. Must run
+    inside the transaction that stored the completion.
+    """
+    conn.executemany("""
+        INSERT INTO completion_rollups (habit_id, kind, bucket, completions) VALUES (?, ?, ?, 1)
+        ON CONFLICT (habit_id, kind, bucket) DO UPDATE SET completions = completions + 1
+    """, [(habit_id, kind, bucket(day, kind)) for kind in KINDS])
+
+
+def rebuild_rollups(conn, habit_filter="1", params=()):
+    """
+    Recompute the rollups of the habits matching habit_filter (on habits h) from their
+    completions. Under run-length storage only the runs of those habits are expanded,
+    as the completions view would expand every run in the database. The caller owns
+    the transaction.
+    """
+    conn.execute(f"""
+        DELETE FROM completion_rollups WHERE habit_id IN (SELECT h.id FROM habits h WHERE {habit_filter})
+    """, params)
+    if runs.uses_run_storage(conn):
+        source = f"""
+            WITH RECURSIVE expanded (habit_id, weekly, period, last) AS (
+                SELECT r.habit_id, h.periodicity = 'weekly', r.start, r.start + r.length - 1
+                FROM habits h JOIN completion_runs r ON r.habit_id = h.id
+                WHERE {habit_filter}
+                UNION ALL
+                SELECT habit_id, weekly, period + 1, last FROM expanded WHERE period < last
+            ), c (habit_id, day) AS (
+                SELECT habit_id, CASE WHEN weekly THEN period * 7 + 1 ELSE period END FROM expanded
+            )
+        """
+    else:
+        source = f"""
+            WITH c (habit_id, day) AS (
+                SELECT c.habit_id, c.day FROM habits h JOIN completions c ON c.habit_id = h.id
+                WHERE {habit_filter}
+            )
+        """
+    for kind, expression in BUCKET_SQL.items():
+        conn.execute(f"""
+            {source}
+            INSERT INTO completion_rollups (habit_id, kind, bucket, completions)
+            SELECT c.habit_id, '{kind}', {expression}, COUNT(*) FROM c
+            GROUP BY c.habit_id, {expression}
+        """, params)
+
+
+def completion_series(conn, habits, kind, first_day, last_day):
+    """
+    Return the completion rate of the given habits per bucket between two day ordinals, read
+    from the rollups in one indexed query. habits is a list of (habit_id, periodicity,
+    created_day) tuples. Each bucket gives the completions, the periods the habits could be
+    completed in (within the range and after their creation) and their ratio.
+    """
+    first_bucket, last_bucket = bucket(first_day, kind), bucket(last_day, kind)
+    counts = {}
+    if habits:
+        placeholders = ", ".join("?" * len(habits))
+        counts = {
+            (habit_id, number): completions
+            for habit_id, number, completions in conn.execute(f"""
+                SELECT habit_id, bucket, completions FROM completion_rollups
+                WHERE habit_id IN ({placeholders}) AND kind = ? AND bucket BETWEEN ? AND ?
+            """, [habit_id for habit_id, _, _ in habits] + [kind, first_bucket, last_bucket])
+        }
+
+    series = []
+    for number in range(first_bucket, last_bucket + 1):
+        start, end = bucket_days(number, kind)
+        completed = expected = 0
+        for habit_id, periodicity, created_day in habits:
+            count = counts.get((habit_id, number), 0)
+            active_from, active_to = max(start, first_day), min(end, last_day)
+            # Periods since the habit was created, or as many as it has completions
+            # when imported history predates it; extra completions in one week don't count
+            possible = min(count, _periods(active_from, active_to, periodicity))
+            possible = max(possible, _periods(max(active_from, created_day or start), active_to, periodicity))
+            expected += possible
+            completed += min(count, possible)
+        series.append({
+            "bucket": bucket_label(number, kind),
+            "start": date.fromordinal(start).isoformat(),
+            "completions": completed,
+            "expected": expected,
+            "rate": completed / expected if expected else 0.0,
+        })
+    return series
+
+
+def _periods(first_day, last_day, periodicity):
+    # Number of days or weeks touched by the range first_day..last_day
+    if first_day > last_day:
+        return 0
+    if periodicity == "weekly":
+        return (last_day - 1) // 7 - (first_day - 1) // 7 + 1
+    return last_day - first_day + 1
+
+
+def heatmap(conn, habit_ids, first_day, last_day):
+    """
+    Return {date: completions} for every day between two day ordinals, summed over the given
+    habits, for a calendar heatmap. Completions are read per habit from the (habit_id, day)
+    index, or from the overlapping runs under run-length storage.
+    """
+    days = dict.fromkeys(range(first_day, last_day + 1), 0)
+    if habit_ids:
+        placeholders = ", ".join("?" * len(habit_ids))
+        if runs.uses_run_storage(conn):
+            # Only the runs overlapping the range, in the period units of each habit
+            for start, length, weekly in conn.execute(f"""
+                SELECT r.start, r.length, h.periodicity = 'weekly' FROM completion_runs r
+                JOIN habits h ON h.id = r.habit_id
+                WHERE r.habit_id IN ({placeholders})
+                  AND r.start + r.length > CASE h.periodicity WHEN 'weekly' THEN (? - 1) / 7 ELSE ? END
+                  AND r.start <= CASE h.periodicity WHEN 'weekly' THEN (? - 1) / 7 ELSE ? END
+            """, list(habit_ids) + [first_day, first_day, last_day, last_day]):
+                first, last = ((first_day - 1) // 7, (last_day - 1) // 7) if weekly else (first_day, last_day)
+                for period in range(max(start, first), min(start + length, last + 1)):
+                    day = period * 7 + 1 if weekly else period
+                    if day in days:
+                        days[day] += 1
+        else:
+            for day, completions in conn.execute(f"""
+                SELECT day, COUNT(*) FROM completions
+                WHERE habit_id IN ({placeholders}) AND day BETWEEN ? AND ?
+                GROUP BY day
+            """, list(habit_ids) + [first_day, last_day]):
+                days[day] = completions
+    return {date.fromordinal(day).isoformat(): count for day, count in days.items()}
@@ -0,0 +1,178 @@
+# Run-length storage of completions. Instead of one row per completion, each
+# habit's history is kept in completion_runs as runs of consecutive periods
+# (start, length), so a habit completed every day for five years is a single
+# row. In this mode `completions` becomes a view expanding the runs back into
+# one row per period, so read-only SQL written against the row layout keeps working.
+# The view is for compatibility only: its recursive expansion starts from every run
+# in the database and no WHERE clause reaches it, so even a per-habit query through
+# it reads every completed period. The app's own run-mode paths read completion_runs.
+# Runs only record which periods were completed: duplicates within a period are
+# dropped and a weekly completion is reported on the Monday of its week.
+
+RUN_VIEW_SQL = """
+    CREATE VIEW completions AS
+    WITH RECURSIVE expanded (run_id, habit_id, period, step, length) AS (
+        SELECT id, habit_id, start, 0, length FROM completion_runs
+        UNION ALL
+        SELECT run_id, habit_id, period + 1, step + 1, length FROM expanded WHERE step + 1 < length
+    )
+    SELECT (e.run_id << 16) | e.step AS id, e.habit_id,
+           CASE h.periodicity WHEN 'weekly' THEN e.period * 7 + 1 ELSE e.period END AS day,
+           e.period
+    FROM expanded e
+    LEFT JOIN habits h ON h.id = e.habit_id
+"""
+
+# Deleting one row of the view removes its period, splitting the run it falls in
+RUN_VIEW_DELETE_TRIGGER_SQL = """
+    CREATE TRIGGER completions_delete INSTEAD OF DELETE ON completions
+    BEGIN
+        INSERT INTO completion_runs (habit_id, start, length)
+            SELECT habit_id, OLD.period + 1, start + length - OLD.period - 1 FROM completion_runs
+            WHERE habit_id = OLD.habit_id AND start <= OLD.period AND start + length > OLD.period + 1;
+        UPDATE completion_runs SET length = OLD.period - start
+            WHERE habit_id = OLD.habit_id AND start <= OLD.period AND start + length > OLD.period;
+        DELETE FROM completion_runs WHERE habit_id = OLD.habit_id AND length = 0;
+    END
+"""
+
+
+def uses_run_storage(conn):
+    """
+    Return True if the database keeps completions as runs (completions is then a view).
+    """
+    row = conn.execute("SELECT type FROM sqlite_master WHERE name = 'completions'").fetchone()
+    return row is not None and row[0] == 'view'
+
+
+def to_runs(periods):
+    """
+    Return the (start, length) runs of consecutive values in an iterable of periods.
+    """
+    result = []
+    for period in sorted(set(periods)):
+        if result and result[-1][0] + result[-1][1] == period:
+            result[-1][1] += 1
+        else:
+            result.append([period, 1])
+    return [tuple(run) for run in result]
+
+
+def record_period(conn, habit_id, period):
+    """
+    Add one completed period to a habit's runs, extending or merging the neighbouring runs.
+    Returns False if the period was already covered, so nothing changed.
+    """
+    left = conn.execute("""
+        SELECT id, start, length FROM completion_runs
+        WHERE habit_id = ? AND start <= ? ORDER BY start DESC LIMIT 1
+    """, (habit_id, period)).fetchone()
+    if left is not None and left[1] + left[2] > period:
+        return False
+    right = conn.execute("""
+        SELECT id, length FROM completion_runs WHERE habit_id = ? AND start = ?
+    """, (habit_id, period + 1)).fetchone()
+
+    touches_left = left is not None and left[1] + left[2] == period
+    if touches_left and right is not None:
+        conn.execute("UPDATE completion_runs SET length = length + 1 + ? WHERE id = ?", (right[1], left[0]))
+        conn.execute("DELETE FROM completion_runs WHERE id = ?", (right[0],))
+    elif touches_left:
+        conn.execute("UPDATE completion_runs SET length = length + 1 WHERE id = ?", (left[0],))
+    elif right is not None:
+        conn.execute("UPDATE completion_runs SET start = ?, length = length + 1 WHERE id = ?", (period, right[0]))
+    else:
+        conn.execute("INSERT INTO completion_runs (habit_id, start, length) VALUES (?, ?, 1)", (habit_id, period))
+    return True
+
+
+def merge_periods(conn, habit_id, periods):
+    """
+    Merge many completed periods into a habit's runs at once, rewriting its runs.
+    Returns the number of periods that were not covered yet.
+    """
+    covered = set(periods)
+    existing = 0
+    for start, length in conn.execute("""
+        SELECT start, length FROM completion_runs WHERE habit_id = ?
+    """, (habit_id,)):
+        covered.update(range(start, start + length))
+        existing += length
+    conn.execute("DELETE FROM completion_runs WHERE habit_id = ?", (habit_id,))
+    conn.executemany("""
+        INSERT INTO completion_runs (habit_id, start, length) VALUES (?, ?, ?)
+    """, [(habit_id, start, length) for start, length in to_runs(covered)])
+    return len(covered) - existing
+
+
+def habit_days(conn, habit_id, weekly):
+    """
+    Return the day ordinals of a habit's completed periods in ascending order,
+    expanded from its runs (the Monday of each week for weekly habits).
+    """
+    days = []
+    for start, length in conn.execute("""
+        SELECT start, length FROM completion_runs WHERE habit_id = ? ORDER BY start
+    """, (habit_id,)):
+        days.extend(period * 7 + 1 if weekly else period for period in range(start, start + length))
+    return days
+
+
+def use_run_storage(conn):
+    """
+    Convert the completions table into runs and replace it with the compatibility view.
+    Returns False if the database already uses runs. The caller owns the transaction.
+    """
+    if uses_run_storage(conn):
+        return False
+    conn.execute("DELETE FROM completion_runs")
+    conn.execute("""
+        INSERT INTO completion_runs (habit_id, start, length)
+        SELECT habit_id, MIN(period), COUNT(*)
+        FROM (
+            SELECT habit_id, period,
+                   period - ROW_NUMBER() OVER (PARTITION BY habit_id ORDER BY period) AS grp
+            FROM (SELECT DISTINCT habit_id, period FROM completions)
+        )
+        GROUP BY habit_id, grp
+        ORDER BY habit_id, MIN(period)
+    """)
+    conn.execute("DROP TABLE completions")
+    conn.execute(RUN_VIEW_SQL)
+    conn.execute(RUN_VIEW_DELETE_TRIGGER_SQL)
+    return True
+
+
+def use_row_storage(conn):
+    """
+    Expand the runs back into a completions table with one row per completed period.
+    Returns False if the database already uses rows. The caller owns the transaction.
+    """
+    if not uses_run_storage(conn):
+        return False
+    conn.execute("""
+        CREATE TABLE completions_rows (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            habit_id INTEGER NOT NULL,
+            day INTEGER NOT NULL,
+            period INTEGER NOT NULL,
+            FOREIGN KEY (habit_id) REFERENCES habits (id)
+        )
+    """)
+    conn.execute("""
+        WITH RECURSIVE expanded (habit_id, period, remaining) AS (
+            SELECT habit_id, start, length - 1 FROM completion_runs
+            UNION ALL
+            SELECT habit_id, period + 1, remaining - 1 FROM expanded WHERE remaining > 0
+        )
+        INSERT INTO completions_rows (habit_id, day, period)
+        SELECT e.habit_id, CASE h.periodicity WHEN 'weekly' THEN e.period * 7 + 1 ELSE e.period END, e.period
+        FROM expanded e
+        LEFT JOIN habits h ON h.id = e.habit_id
+        ORDER BY e.habit_id, e.period
+    """)
+    conn.execute("DROP VIEW completions")
+    conn.execute("ALTER TABLE completions_rows RENAME TO completions")
+    conn.execute("CREATE UNIQUE INDEX idx_completions_habit_day ON completions (habit_id, day, period)")
+    conn.execute("DELETE FROM completion_runs")
+    return True
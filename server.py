@@ -0,0 +1,534 @@
+import argparse
+import asyncio
+import base64
+import json
+import os
+import sys
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from urllib.parse import parse_qs, urlsplit
+
+from bulk_import import parse_date
+from habit import Habit
+from habit_tracker import HabitTracker
+
+# Latencies kept per route for the percentiles reported by /stats
+LATENCY_SAMPLES = 10000
+
+# Largest request body accepted, in bytes
+MAX_BODY_BYTES = 1 << 20
+
+REASONS = {200: "OK", 201: "Created", 400: "Bad Request", 401: "Unauthorized",
+           404: "Not Found", 409: "Conflict", 413: "Payload Too Large",
+           431: "Request Header Fields Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class HTTPError(Exception):
+    """
+    Raised by a route handler to answer with an error status and message.
+    """
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class RequestStats:
+    """
+    Counts requests and keeps recent latencies per route.
+    """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.counts = defaultdict(int)
+        self.latencies = defaultdict(lambda: deque(maxlen=LATENCY_SAMPLES))
+
+    def record(self, route, seconds):
+        self.counts[route] += 1
+        self.latencies[route].append(seconds)
+
+    def snapshot(self):
+        """
+        Return the request count, throughput and latency percentiles (in ms) of every route.
+        """
+        elapsed = time.perf_counter() - self.started
+        routes = {}
+        for route, samples in self.latencies.items():
+            routes[route] = dict(count=self.counts[route], **latency_summary(samples))
+        total = sum(self.counts.values())
+        return {"requests": total, "uptime_sec": elapsed,
+                "requests_per_sec": total / elapsed if elapsed else 0.0, "routes": routes}
+
+
+def latency_summary(samples):
+    """
+    Return the p50/p95/p99/max of a list of latencies in seconds, in milliseconds.
+    """
+    ordered = sorted(samples)
+    if not ordered:
+        return {}
+
+    def percentile(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+
+    return {"p50_ms": percentile(0.50), "p95_ms": percentile(0.95),
+            "p99_ms": percentile(0.99), "max_ms": ordered[-1] * 1000}
+
+
+def habit_summary(habit):
+    """
+    Return the JSON fields of a habit.
+    """
+    return {"name": habit.name, "periodicity": habit.periodicity, "created_at": str(habit.created_at)}
+
+
+class HabitServer:
+    """
+    HTTP/JSON front end over a HabitTracker. Requests are parsed on the event loop and the
+    blocking tracker calls run in a bounded thread pool, each inside its own user session.
+    Users authenticate every request with HTTP Basic credentials.
+    """
+    def __init__(self, tracker, workers=8, max_pending=256):
+        """
+        Serve tracker using `workers` threads, with at most max_pending requests queued for them.
+        """
+        self.tracker = tracker
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="habit-worker")
+        self.slots = asyncio.Semaphore(max_pending)
+        self.stats = RequestStats()
+        # Session token the request being handled authenticated with, see logout()
+        self._token = ContextVar(f"token_{id(self)}", default=None)
+        self.routes = {
+            ("POST", "/register"): (self.register, False),
+            ("POST", "/login"): (self.login, True),
+            ("POST", "/logout"): (self.logout, True),
+            ("GET", "/habits"): (self.list_habits, True),
+            ("POST", "/habits"): (self.add_habit, True),
+            ("POST", "/complete"): (self.complete_habit, True),
+            ("POST", "/delete"): (self.delete_habit, True),
+            ("POST", "/delete-all"): (self.delete_all_habits, True),
+            ("GET", "/analyze"): (self.analyze, True),
+            ("GET", "/progress"): (self.progress, True),
+            ("GET", "/heatmap"): (self.heatmap, True),
+            ("GET", "/due"): (self.due, True),
+        }
+
+    # Route handlers, run in the worker threads
+
+    def register(self, body, query):
+        username, password = require(body, "username"), require(body, "password")
+        if not self.tracker.create_user(username, password):
+            raise HTTPError(409, f"Username '{username}' is already taken.")
+        return 201, {"username": username}
+
+    def login(self, body, query):
+        # Later requests can send the token as a Bearer credential and skip password verification
+        return 200, {"username": self.tracker.current_user.username, "token": self.tracker.issue_token(),
+                     "expires_in": self.tracker.tokens.ttl}
+
+    def logout(self, body, query):
+        # Ends the session of the presented token; a password has no session to end
+        token = self._token.get()
+        if token is None:
+            raise HTTPError(400, "Log out with the Bearer token returned by /login.")
+        self.tracker.revoke_token(token)
+        return 200, {"username": self.tracker.current_user.username}
+
+    def list_habits(self, body, query):
+        param = lambda key: query.get(key, [None])[0]
+        periodicity = param("periodicity")
+        paging = ("name", "created_from", "created_to", "limit", "after")
+        if not any(param(key) for key in paging):
+            habits = [habit for habit in self.tracker.get_user_habits() if periodicity in (None, habit.periodicity)]
+            return 200, {"habits": [habit_summary(habit) for habit in habits]}
+
+        try:
+            limit, after = int(param("limit") or 50), int(param("after") or 0)
+        except ValueError:
+            raise HTTPError(400, "limit and after must be integers.")
+        for key in ("created_from", "created_to"):
+            if param(key) is not None and parse_date(param(key)) is None:
+                raise HTTPError(400, f"{key} must be a YYYY-MM-DD date.")
+        habits = self.tracker.list_habits(param("name"), periodicity, param("created_from"), param("created_to"),
+                                          limit, after)
+        return 200, {
+            "habits": [habit_summary(habit) for habit in habits],
+            # Pass as ?after= to get the next page; None on the last page
+            "next_after": habits[-1].id if len(habits) == limit else None,
+        }
+
+    def add_habit(self, body, query):
+        name, periodicity = require(body, "name"), require(body, "periodicity")
+        if periodicity not in ("daily", "weekly"):
+            raise HTTPError(400, "Periodicity must be 'daily' or 'weekly'.")
+        if not self.tracker.add_habit(Habit(name, periodicity, self.tracker.current_user.id)):
+            raise HTTPError(409, f"Habit '{name}' already exists.")
+        return 201, {"name": name, "periodicity": periodicity}
+
+    def complete_habit(self, body, query):
+        name = require(body, "name")
+        if not self.tracker.complete_habit(name):
+            raise HTTPError(404, f"Habit '{name}' not found.")
+        current, longest = self.tracker.get_habit_streak(name)
+        return 200, {"name": name, "current_streak": current, "longest_streak": longest}
+
+    def delete_habit(self, body, query):
+        name = require(body, "name")
+        if not self.tracker.delete_habit(name):
+            raise HTTPError(404, f"Habit '{name}' not found.")
+        return 200, {"deleted": name}
+
+    def delete_all_habits(self, body, query):
+        self.tracker.delete_all_habits()
+        return 200, {"deleted": "all"}
+
+    def analyze(self, body, query):
+        habit, streak = self.tracker.get_longest_streak()
+        return 200, {
+            "longest": {"habit": habit, "streak": streak},
+            "habits": [
+                {"name": name, "periodicity": periodicity, "current_streak": current, "longest_streak": longest}
+                for name, periodicity, current, longest in self.tracker.get_streaks()
+            ],
+        }
+
+    def progress(self, body, query):
+        param = lambda key: query.get(key, [None])[0]
+        kind = param("kind") or "week"
+        if kind not in ("week", "month"):
+            raise HTTPError(400, "kind must be 'week' or 'month'.")
+        name, start, end = self.progress_range(query)
+        return 200, {"kind": kind, "series": self.tracker.completion_rates(name, kind, start, end)}
+
+    def heatmap(self, body, query):
+        name, start, end = self.progress_range(query)
+        return 200, {"days": self.tracker.completion_heatmap(name, start, end)}
+
+    def due(self, body, query):
+        overdue = query.get("overdue", ["0"])[0] not in ("0", "false", "")
+        return 200, {"habits": [
+            {key: habit[key] for key in ("habit", "periodicity", "due", "overdue")}
+            for habit in self.tracker.due_habits(overdue=overdue)
+        ]}
+
+    def progress_range(self, query):
+        """
+        Return the checked habit, start and end parameters of /progress and /heatmap.
+        """
+        param = lambda key: query.get(key, [None])[0]
+        for key in ("start", "end"):
+            if param(key) is not None and parse_date(param(key)) is None:
+                raise HTTPError(400, f"{key} must be a YYYY-MM-DD date.")
+        name = param("habit")
+        if name is not None and self.tracker.get_habit(name) is None:
+            raise HTTPError(404, f"Habit '{name}' not found.")
+        return name, param("start"), param("end")
+
+    def dispatch(self, handler, needs_user, credentials, body, query):
+        """
+        Run one route handler in a fresh user session. Called in a worker thread.
+        """
+        with self.tracker.session():
+            token = None
+            if needs_user:
+                if isinstance(credentials, str):
+                    if not self.tracker.login_with_token(credentials):
+                        raise HTTPError(401, "Invalid or expired token.")
+                    token = credentials
+                elif not credentials or not self.tracker.login_user(*credentials):
+                    raise HTTPError(401, "Invalid username or password.")
+            reset = self._token.set(token)
+            try:
+                return handler(body, query)
+            finally:
+                self._token.reset(reset)
+
+    # HTTP plumbing, run on the event loop
+
+    async def handle_connection(self, reader, writer):
+        """
+        Serve the requests of one keep-alive connection.
+        """
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except HTTPError as error:
+                    # The rest of the stream can't be framed, so answer and hang up
+                    writer.write(encode_response(error.status, {"error": str(error)}, keep_alive=False))
+                    await writer.drain()
+                    self.stats.record("malformed", 0.0)
+                    break
+                if request is None:
+                    break
+                method, target, headers, raw_body = request
+                started = time.perf_counter()
+                status, payload, route = await self.respond(method, target, headers, raw_body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(encode_response(status, payload, keep_alive))
+                await writer.drain()
+                self.stats.record(route, time.perf_counter() - started)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, method, target, headers, raw_body):
+        """
+        Route a parsed request and return (status, payload, route name).
+        """
+        url = urlsplit(target)
+        route = f"{method} {url.path}"
+        if (method, url.path) == ("GET", "/stats"):
+            stats = self.stats.snapshot()
+            if self.tracker.cache is not None:
+                stats["cache"] = self.tracker.cache_stats()
+            if self.tracker.write_behind is not None:
+                stats["write_behind"] = self.tracker.write_behind.stats()
+            stats["tokens"] = self.tracker.tokens.stats()
+            if self.tracker.instrumentation is not None:
+                stats["tracker"] = self.tracker.instrumentation.snapshot()
+            return 200, stats, route
+        if (method, url.path) not in self.routes:
+            return 404, {"error": f"No route for {route}."}, "unknown"
+        handler, needs_user = self.routes[(method, url.path)]
+        try:
+            body = json.loads(raw_body) if raw_body else {}
+            if not isinstance(body, dict):
+                raise ValueError
+        except ValueError:
+            return 400, {"error": "Request body must be a JSON object."}, route
+
+        async with self.slots:
+            loop = asyncio.get_running_loop()
+            try:
+                status, payload = await loop.run_in_executor(
+                    self.executor, self.dispatch, handler, needs_user,
+                    bearer_token(headers) or basic_credentials(headers), body, parse_qs(url.query))
+            except HTTPError as error:
+                status, payload = error.status, {"error": str(error)}
+            except Exception as error:
+                # Such as 'database is locked' once the connection timeout ran out
+                print(f"Error in {route}: {error!r}", file=sys.stderr)
+                status, payload = 500, {"error": "Internal server error."}
+        return status, payload, route
+
+    async def serve(self, host="127.0.0.1", port=8080):
+        """
+        Accept connections until cancelled.
+        """
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+def require(body, field):
+    """
+    Return a required string field of a JSON body.
+    """
+    value = body.get(field)
+    if not isinstance(value, str) or not value:
+        raise HTTPError(400, f"Field '{field}' is required.")
+    return value
+
+
+def basic_credentials(headers):
+    """
+    Return (username, password) from a Basic Authorization header, or None.
+    """
+    scheme, _, value = headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "basic":
+        return None
+    try:
+        username, _, password = base64.b64decode(value).decode("utf-8").partition(":")
+    except ValueError:
+        return None
+    return username, password
+
+
+def bearer_token(headers):
+    """
+    Return the session token of a Bearer Authorization header, or None.
+    """
+    scheme, _, value = headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer":
+        return None
+    return value.strip() or None
+
+
+async def read_request(reader):
+    """
+    Read one HTTP/1.1 request. Returns (method, target, headers, body) or None at end of stream.
+    Raises HTTPError for a request that can't be framed, has a line longer than the
+    reader's limit (64 KiB by default) or whose body exceeds MAX_BODY_BYTES.
+    """
+    line = await read_line(reader)
+    if not line.strip():
+        return None
+    parts = line.decode("latin-1").split(" ", 2)
+    if len(parts) != 3:
+        raise HTTPError(400, "Malformed request line.")
+    method, target, _ = parts
+    headers = {}
+    while True:
+        line = await read_line(reader)
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise HTTPError(400, "Content-Length must be an integer.")
+    if length < 0:
+        raise HTTPError(400, "Content-Length must not be negative.")
+    if length > MAX_BODY_BYTES:
+        raise HTTPError(413, f"Request bodies are limited to {MAX_BODY_BYTES} bytes.")
+    body = await reader.readexactly(length) if length else b""
+    return method.upper(), target, headers, body
+
+
+async def read_line(reader):
+    """
+    Read one line of the request head, raising HTTPError 431 if it exceeds the reader's limit.
+    """
+    try:
+        return await reader.readline()
+    except (ValueError, asyncio.LimitOverrunError):  # readline wraps LimitOverrunError in ValueError
+        raise HTTPError(431, "Request line or header too long.")
+
+
+def encode_response(status, payload, keep_alive=True):
+    body = json.dumps(payload).encode("utf-8")
+    head = (f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    return head.encode("latin-1") + body
+
+
+# Load generator
+
+async def send_request(reader, writer, method, path, payload=None, credentials=None):
+    """
+    Send one request over an open keep-alive connection and return (status, decoded body).
+    credentials is a (username, password) pair or a session token from POST /login.
+    """
+    body = json.dumps(payload).encode("utf-8") if payload is not None else b""
+    head = f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\n"
+    if isinstance(credentials, str):
+        head += f"Authorization: Bearer {credentials}\r\n"
+    elif credentials:
+        token = base64.b64encode(":".join(credentials).encode("utf-8")).decode("ascii")
+        head += f"Authorization: Basic {token}\r\n"
+    writer.write(head.encode("latin-1") + b"\r\n" + body)
+    await writer.drain()
+    status_line = await reader.readline()
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    data = await reader.readexactly(int(headers.get("content-length", 0)))
+    return int(status_line.split()[1]), json.loads(data) if data else None
+
+
+async def run_load(host="127.0.0.1", port=8080, clients=20, requests_per_client=50):
+    """
+    Drive the server with `clients` concurrent users, each registering, logging in for a session
+    token, adding a habit and then sending requests_per_client requests that alternate between
+    completing and analyzing.
+    Returns the throughput and latency percentiles of those requests.
+    """
+    run_id = f"{os.getpid()}-{int(time.time())}"
+    latencies = []
+    failures = 0
+
+    async def client(number):
+        nonlocal failures
+        credentials = (f"load-{run_id}-{number}", "pw")
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            await send_request(reader, writer, "POST", "/register",
+                               {"username": credentials[0], "password": credentials[1]})
+            _, session = await send_request(reader, writer, "POST", "/login", {}, credentials)
+            credentials = session["token"]
+            await send_request(reader, writer, "POST", "/habits",
+                               {"name": "Load", "periodicity": "daily"}, credentials)
+            for i in range(requests_per_client):
+                method, path, payload = ("POST", "/complete", {"name": "Load"}) if i % 2 == 0 else ("GET", "/analyze", None)
+                started = time.perf_counter()
+                status, _ = await send_request(reader, writer, method, path, payload, credentials)
+                latencies.append(time.perf_counter() - started)
+                if status >= 400:
+                    failures += 1
+        finally:
+            writer.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client(number) for number in range(clients)))
+    elapsed = time.perf_counter() - started
+    return dict(requests=len(latencies), failures=failures, seconds=elapsed,
+                requests_per_sec=len(latencies) / elapsed if elapsed else 0.0,
+                **latency_summary(latencies))
+
+
+def main(argv=None):
+    """
+    Run the server ('serve') or the load generator against a running server ('load').
+    """
+    parser = argparse.ArgumentParser(prog="server.py", description="Habit Tracking App JSON server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve", help="run the HTTP/JSON server")
+    serve.add_argument("--db", default="habits.db", help="path to the SQLite database (default: habits.db)")
+    serve.add_argument("--workers", type=int, default=8, help="threads running database work (default: 8)")
+    serve.add_argument("--verbose", action="store_true", help="keep the tracker's console messages")
+    serve.add_argument("--instrument", action="store_true",
+                       help="measure every tracker method and include the figures in /stats")
+    serve.add_argument("--write-behind", action="store_true",
+                       help="queue completions and write them in batches (group commit)")
+    serve.add_argument("--hash-workers", type=int, default=os.cpu_count() or 1,
+                       help="processes hashing and verifying passwords (default: one per CPU, 0: none)")
+    serve.add_argument("--token-ttl", type=int, default=900, help="seconds a login token stays valid (default: 900)")
+    load = commands.add_parser("load", help="measure latency and throughput of a running server")
+    load.add_argument("--clients", type=int, default=20, help="concurrent connections (default: 20)")
+    load.add_argument("--requests", type=int, default=50, help="requests per connection (default: 50)")
+    args = parser.parse_args(argv)
+
+    if args.command == "load":
+        print(json.dumps(asyncio.run(run_load(args.host, args.port, args.clients, args.requests)), indent=2))
+        return 0
+
+    tracker = HabitTracker(args.db, token_ttl=args.token_ttl)
+    if args.hash_workers:
+        tracker.enable_password_pool(args.hash_workers)
+    if args.instrument:
+        tracker.enable_instrumentation()
+    if args.write_behind:
+        tracker.enable_write_behind()
+    if not args.verbose:
+        # The tracker reports every operation on stdout, which is noise for a server
+        sys.stdout = open(os.devnull, "w")
+    server = HabitServer(tracker, workers=args.workers)
+    print(f"Serving on http://{args.host}:{args.port}", file=sys.stderr)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        tracker.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
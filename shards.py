@@ -0,0 +1,235 @@
+import os
+import threading
+
+import migrations
+import runs
+from pool import ConnectionPool
+
+# Sharded storage: users are spread over several SQLite files so that writes,
+# file size and VACUUM time grow with one shard instead of the whole user base.
+# The tracker's own database is the catalog: it keeps every user's credentials,
+# the list of shards and the shard each user lives on, and doubles as shard 0,
+# so enabling sharding on an existing database leaves its users where they are.
+# A shard holds a copy of its users' rows and all of their habits and completions.
+# Several processes may open the same files: the catalog's shard_map version is bumped
+# on every change of the map, and each router checks it before using its cached routes.
+
+# Tables keyed by habit id that move with a user's habits
+HABIT_TABLES = ("habit_streaks", "completion_rollups")
+
+
+class ShardRouter:
+    """
+    Maps users to shard databases and hands out the calling thread's connection to a shard.
+    A new user is placed on shard user_id % number of shards; the placement is recorded
+    in the catalog's user_shards table, so adding shards never moves existing users.
+    Users without a placement (created before sharding was enabled) live on shard 0.
+    Cached routes are dropped, and shards added by other processes opened, whenever the
+    catalog's shard_map version has changed; on_change is then called.
+    """
+    def __init__(self, catalog_pool, on_change=None):
+        self.catalog_pool = catalog_pool
+        self.directory = os.path.dirname(os.path.abspath(catalog_pool.db_path))
+        self.on_change = on_change or (lambda: None)
+        self.pools = {0: catalog_pool}
+        self._user_shards = {}
+        self._lock = threading.Lock()
+        self.version = None
+        self.refresh()
+
+    def catalog(self):
+        return self.catalog_pool.connection()
+
+    def _open(self, number, path):
+        pool = ConnectionPool(os.path.join(self.directory, path), self.catalog_pool.timeout)
+        migrations.migrate(pool.connection())
+        self.pools[number] = pool
+        return pool
+
+    def refresh(self):
+        """
+        Drop the cached routes and open new shards if the shard map changed since the
+        last check. Returns True if it did.
+        """
+        catalog = self.catalog()
+        version = catalog.execute("SELECT version FROM shard_map").fetchone()[0]
+        if version == self.version:
+            return False
+        with self._lock:
+            for number, path in catalog.execute("SELECT number, path FROM shards WHERE number > 0 ORDER BY number"):
+                if number not in self.pools:
+                    self._open(number, path)
+            self._user_shards.clear()
+            changed, self.version = self.version is not None, version
+        if changed:
+            self.on_change()
+        return changed
+
+    def _bump_version(self, conn):
+        # Runs in the caller's catalog transaction
+        conn.execute("UPDATE shard_map SET version = version + 1")
+
+    def numbers(self):
+        """
+        Return the numbers of the shards, in order.
+        """
+        self.refresh()
+        return sorted(self.pools)
+
+    def pool(self, number):
+        """
+        Return the connection pool of a shard, opening it if another process added it.
+        """
+        if number not in self.pools:
+            self.refresh()
+        return self.pools[number]
+
+    def connection(self, number):
+        """
+        Return the calling thread's connection to a shard.
+        """
+        return self.pool(number).connection()
+
+    def shard_of(self, user_id):
+        """
+        Return the number of the shard holding a user.
+        """
+        self.refresh()
+        shard = self._user_shards.get(user_id)
+        if shard is None:
+            row = self.catalog().execute("SELECT shard FROM user_shards WHERE user_id = ?", (user_id,)).fetchone()
+            shard = row[0] if row else 0
+            with self._lock:
+                self._user_shards[user_id] = shard
+        return shard
+
+    def assign(self, user_id):
+        """
+        Place a new user on a shard and return its number. Runs in the caller's catalog transaction.
+        """
+        shard = sorted(self.pools)[user_id % len(self.pools)]
+        self.catalog().execute("INSERT OR REPLACE INTO user_shards (user_id, shard) VALUES (?, ?)", (user_id, shard))
+        with self._lock:
+            self._user_shards[user_id] = shard
+        return shard
+
+    def place_users(self, user_ids):
+        """
+        Assign new users (already in the catalog) to shards and copy their rows to the shards
+        they were placed on, which keep them for their joins; the catalog's rows are authoritative.
+        """
+        by_shard = {}
+        self.refresh()
+        catalog = self.catalog()
+        with catalog:
+            for user_id in user_ids:
+                by_shard.setdefault(self.assign(user_id), []).append(user_id)
+        for number, ids in by_shard.items():
+            if number == 0:
+                continue  # Shard 0's users table is the catalog's
+            rows = [catalog.execute("SELECT id, username, password, created_at FROM users WHERE id = ?",
+                                    (user_id,)).fetchone() for user_id in ids]
+            conn = self.connection(number)
+            with conn:
+                conn.executemany("INSERT INTO users (id, username, password, created_at) VALUES (?, ?, ?, ?)", rows)
+
+    def add_shard(self, path=None):
+        """
+        Create an empty shard, by default next to the catalog, and return its number.
+        """
+        self.refresh()
+        conn = self.catalog()
+        with conn:
+            if not conn.execute("SELECT 1 FROM shards WHERE number = 0").fetchone():
+                conn.execute("INSERT INTO shards (number, path) VALUES (0, ?)", (os.path.basename(self.catalog_pool.db_path),))
+            number = max(self.pools) + 1
+            if path is None:
+                stem, extension = os.path.splitext(os.path.basename(self.catalog_pool.db_path))
+                path = f"{stem}.shard{number}{extension or '.db'}"
+            conn.execute("INSERT INTO shards (number, path) VALUES (?, ?)", (number, path))
+            self._bump_version(conn)
+        shard = self._open(number, path).connection()
+        if runs.uses_run_storage(conn):
+            # Every shard stores completions the same way
+            with shard:
+                runs.use_run_storage(shard)
+        return number
+
+    def users_on(self, number):
+        """
+        Return the ids of the users living on a shard, in id order.
+        """
+        return [user_id for (user_id,) in self.catalog().execute("""
+            SELECT u.id FROM users u LEFT JOIN user_shards s ON s.user_id = u.id
+            WHERE COALESCE(s.shard, 0) = ? ORDER BY u.id
+        """, (number,))]
+
+    def move_user(self, user_id, target):
+        """
+        Move a user and all of their habits to another shard. The rows are copied first, then
+        the catalog is switched to the new shard, then the old rows are deleted, so the user
+        is readable throughout. The source shard's write lock is held from the copy to the
+        delete, so no completion can land on it in between; writers that routed to it before
+        the switch see the new shard_map version once they get the lock (see
+        HabitTracker's write transactions). Habits get new ids on the target shard.
+        Returns False if the user already lives there.
+        """
+        source = self.shard_of(user_id)
+        if source == target:
+            return False
+        src, dst = self.connection(source), self.connection(target)
+        catalog = self.catalog()
+        run_storage = runs.uses_run_storage(src)
+        src.execute("BEGIN IMMEDIATE")
+        try:
+            self._move_rows(src, dst, catalog, user_id, source, target, run_storage)
+            src.commit()
+        except BaseException:
+            src.rollback()
+            raise
+        return True
+
+    def _move_rows(self, src, dst, catalog, user_id, source, target, run_storage):
+        with dst:
+            user = src.execute("SELECT id, username, password, created_at FROM users WHERE id = ?", (user_id,)).fetchone()
+            dst.execute("INSERT OR IGNORE INTO users (id, username, password, created_at) VALUES (?, ?, ?, ?)", user)
+            columns = [row[1] for row in src.execute("PRAGMA table_info(habits)") if row[1] != "id"]
+            for habit in src.execute(f"SELECT id, {', '.join(columns)} FROM habits WHERE user_id = ?", (user_id,)).fetchall():
+                habit_id = dst.execute(f"""
+                    INSERT INTO habits ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})
+                """, habit[1:]).lastrowid
+                if run_storage:
+                    _copy_rows(src, dst, "completion_runs", habit[0], habit_id, exclude=("id",))
+                else:
+                    _copy_rows(src, dst, "completions", habit[0], habit_id, exclude=("id",))
+                for table in HABIT_TABLES:
+                    _copy_rows(src, dst, table, habit[0], habit_id)
+        # On shard 0 the catalog is the source connection, whose transaction the caller commits
+        catalog.execute("INSERT OR REPLACE INTO user_shards (user_id, shard) VALUES (?, ?)", (user_id, target))
+        self._bump_version(catalog)
+        if catalog is not src:
+            catalog.commit()
+        habits = "SELECT id FROM habits WHERE user_id = ?"
+        for table in ("completion_runs" if run_storage else "completions",) + HABIT_TABLES:
+            src.execute(f"DELETE FROM {table} WHERE habit_id IN ({habits})", (user_id,))
+        src.execute("DELETE FROM habits WHERE user_id = ?", (user_id,))
+        if source != 0:  # Shard 0's users table is the catalog's
+            src.execute("DELETE FROM users WHERE id = ?", (user_id,))
+
+    def close(self):
+        """
+        Close the shard connections; the catalog pool belongs to the tracker.
+        """
+        for number, pool in self.pools.items():
+            if number != 0:
+                pool.close()
+
+
+def _copy_rows(src, dst, table, old_habit_id, new_habit_id, exclude=()):
+    # Copy a habit's rows of a table keyed by habit_id, pointing them at the habit's new id
+    columns = [row[1] for row in src.execute(f"PRAGMA table_info({table})") if row[1] not in exclude + ("habit_id",)]
+    names = ", ".join(("habit_id",) + tuple(columns))
+    dst.executemany(f"INSERT INTO {table} ({names}) VALUES ({', '.join('?' * (len(columns) + 1))})", (
+        (new_habit_id,) + row
+        for row in src.execute(f"SELECT {', '.join(columns)} FROM {table} WHERE habit_id = ?", (old_habit_id,))
+    ))
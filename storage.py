@@ -0,0 +1,656 @@
+import bisect
+import itertools
+import threading
+from abc import ABC, abstractmethod
+from array import array
+from contextlib import contextmanager
+from datetime import date
+
+import pool
+import reminders
+import rollups
+import runs
+import streaks
+from habit import period_index
+
+# Storage backends hold the users, habits and completions behind HabitTracker's core
+# operations. Habit and completion writes run in the caller's transaction(); user
+# writes commit on their own. Rows are plain tuples: users as (id, username, password),
+# habits as (id, name, periodicity, created_at). Both backends return them in id order.
+
+
+class Storage(ABC):
+    """
+    The interface of a storage backend, see SQLiteStorage and MemoryStorage.
+    """
+    # True when completions are kept as runs of consecutive periods (see runs.py)
+    run_storage = False
+
+    @abstractmethod
+    def transaction(self):
+        """
+        Return a context manager grouping habit and completion writes into one atomic
+        transaction: if the block raises, none of its writes are kept.
+        """
+
+    @abstractmethod
+    def add_users(self, rows):
+        """
+        Store (username, password, created_at) rows. Returns the new user ids, None for
+        a username that is already taken (or repeated).
+        """
+
+    def add_user(self, username, password, created_at):
+        """
+        Store a user. Returns its id, or None if the username is taken.
+        """
+        return self.add_users([(username, password, created_at)])[0]
+
+    @abstractmethod
+    def find_user(self, username):
+        """
+        Return the (id, username, password) of a user, or None.
+        """
+
+    @abstractmethod
+    def set_password(self, user_id, password):
+        """
+        Replace the stored password hash of a user.
+        """
+
+    @abstractmethod
+    def usernames(self):
+        """
+        Return every username, in id order.
+        """
+
+    @abstractmethod
+    def add_habit(self, user_id, name, periodicity, created_at):
+        """
+        Store a habit. Returns its id, or None if the user already has a habit of that name.
+        """
+
+    @abstractmethod
+    def habits(self, user_id):
+        """
+        Return the habit rows of a user.
+        """
+
+    @abstractmethod
+    def page_habits(self, user_id, name=None, periodicity=None, created_from=None, created_to=None,
+                    limit=50, after_id=0):
+        """
+        Return up to `limit` habit rows of a user with ids above after_id, filtered by a
+        name substring (case-insensitive), a periodicity and the dates [created_from, created_to).
+        """
+
+    @abstractmethod
+    def find_habit(self, user_id, name):
+        """
+        Return the row of a user's habit, or None.
+        """
+
+    @abstractmethod
+    def habit_names(self, user_id, periodicity):
+        """
+        Return the names of a user's habits of a periodicity.
+        """
+
+    @abstractmethod
+    def delete_habit(self, habit_id):
+        """
+        Delete a habit with its completions.
+        """
+
+    @abstractmethod
+    def delete_user_habits(self, user_id):
+        """
+        Delete every habit of a user with their completions.
+        """
+
+    @abstractmethod
+    def completion_days(self, habit_id, periodicity):
+        """
+        Return the day ordinals of a habit's completions in ascending order.
+        """
+
+    @abstractmethod
+    def record_completion(self, habit_id, periodicity, day):
+        """
+        Store one completion and update the habit's streak. Returns False if it was already recorded.
+        """
+
+    @abstractmethod
+    def insert_completions(self, rows):
+        """
+        Store a batch of (habit_id, day, period) rows in the caller's transaction, ignoring
+        those already recorded, and return how many were stored. Streaks are brought up to
+        date by refresh().
+        """
+
+    @abstractmethod
+    def refresh(self, user_id=None):
+        """
+        Recompute the streaks (and other derived state) of a user's habits, or of everyone's.
+        """
+
+    @abstractmethod
+    def streak_state(self, habit_id):
+        """
+        Return the (current_streak, longest_streak, last_period) of a habit; current_streak
+        is the run ending in last_period, which may have been broken since (see streaks.is_alive).
+        """
+
+    @abstractmethod
+    def streaks(self, user_id):
+        """
+        Return (habit_name, periodicity, current_streak, longest_streak) of every habit of a user.
+        """
+
+    @abstractmethod
+    def compute_streaks(self, user_id=None):
+        """
+        Recompute the streaks of a user's habits, or of every habit, from their completions
+        rather than the maintained state. Returns {habit_id: (current_streak, longest_streak)}
+        for the habits that have completions and the (habit_id, user_id, name, periodicity)
+        rows of all of them, in id order.
+        """
+
+    @abstractmethod
+    def rebuild_streaks(self, check_only=False):
+        """
+        Compare the maintained streak state of every habit with a recomputation and, unless
+        check_only, replace it. Returns the drift as streaks.verify_streaks does.
+        """
+
+    @abstractmethod
+    def longest_streak(self, user_id):
+        """
+        Return the (habit_name, longest_streak) of the user's habit with the longest streak, or None.
+        """
+
+    def close(self):
+        pass
+
+
+class SQLiteStorage(Storage):
+    """
+    Stores everything in SQLite (see migrations.py for the schema). `connect` returns the
+    connection holding the current user's habits and `catalog` the one holding the users,
+    which differ on a sharded database (see shards.py). Completions also update the
+    streak, rollup and next_due tables in the same transaction. `stale` is checked once a
+    transaction holds the write lock and returns True if connect() may now route elsewhere.
+    """
+    def __init__(self, connect, catalog, stale=None):
+        self.connect = connect
+        self.catalog = catalog
+        self.stale = stale or (lambda: False)
+        self.run_storage = runs.uses_run_storage(catalog())
+
+    @property
+    def conn(self):
+        """
+        The connection the calling thread reads and writes habits through.
+        """
+        return self.connect()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Take the write lock up front (BEGIN IMMEDIATE), so that what the block reads stays
+        valid until it commits. If the routes changed while waiting for the lock (a user
+        moved to another shard), start again on the connection connect() returns now.
+        Inside a transaction already open on the connection, the block joins it. A connection
+        shared between threads (an in-memory database) is held for the whole block.
+        """
+        conn = self.connect()
+        with pool.hold(conn):
+            if conn.in_transaction:
+                yield conn
+                return
+            while True:
+                conn.execute("BEGIN IMMEDIATE")
+                if not self.stale():
+                    break
+                conn.rollback()
+                conn = self.connect()
+            with conn:
+                yield conn
+
+    def add_users(self, rows):
+        catalog = self.catalog()
+        ids = []
+        with catalog:
+            for username, password, created_at in rows:
+                cursor = catalog.execute("""
+                    INSERT OR IGNORE INTO users (username, password, created_at) VALUES (?, ?, ?)
+                """, (username, password, created_at))
+                ids.append(cursor.lastrowid if cursor.rowcount else None)
+        return ids
+
+    def find_user(self, username):
+        return self.catalog().execute("""
+            SELECT id, username, password FROM users WHERE username = ?
+        """, (username,)).fetchone()
+
+    def set_password(self, user_id, password):
+        catalog = self.catalog()
+        with catalog:
+            catalog.execute("UPDATE users SET password = ? WHERE id = ?", (password, user_id))
+
+    def usernames(self):
+        return [username for (username,) in self.catalog().execute("SELECT username FROM users ORDER BY id")]
+
+    def add_habit(self, user_id, name, periodicity, created_at):
+        conn = self.connect()
+        created = period_index(created_at.toordinal(), periodicity)
+        cursor = conn.execute("""
+            INSERT OR IGNORE INTO habits (name, periodicity, created_at, user_id, next_due)
+            VALUES (?, ?, ?, ?, ?)
+        """, (name, periodicity, created_at, user_id, reminders.period_start(created, periodicity)))
+        if not cursor.rowcount:
+            return None
+        conn.execute("INSERT INTO habit_streaks (habit_id) VALUES (?)", (cursor.lastrowid,))
+        return cursor.lastrowid
+
+    def habits(self, user_id):
+        return self.connect().execute("""
+            SELECT id, name, periodicity, created_at FROM habits
+            WHERE user_id = ? ORDER BY id
+        """, (user_id,)).fetchall()
+
+    def page_habits(self, user_id, name=None, periodicity=None, created_from=None, created_to=None,
+                    limit=50, after_id=0):
+        conditions, params = ["user_id = ?", "id > ?"], [user_id, after_id]
+        if name:
+            conditions.append("name LIKE ? ESCAPE '\\'")
+            params.append("%" + name.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+        if periodicity:
+            conditions.append("periodicity = ?")
+            params.append(periodicity)
+        if created_from is not None:
+            conditions.append("created_at >= ?")
+            params.append(created_from.isoformat())
+        if created_to is not None:
+            conditions.append("created_at < ?")
+            params.append(created_to.isoformat())
+        return self.connect().execute(f"""
+            SELECT id, name, periodicity, created_at FROM habits
+            WHERE {' AND '.join(conditions)}
+            ORDER BY id LIMIT ?
+        """, params + [limit]).fetchall()
+
+    def find_habit(self, user_id, name):
+        return self.connect().execute("""
+            SELECT id, name, periodicity, created_at FROM habits WHERE name = ? AND user_id = ?
+        """, (name, user_id)).fetchone()
+
+    def habit_names(self, user_id, periodicity):
+        return [name for (name,) in self.connect().execute("""
+            SELECT name FROM habits WHERE periodicity = ? AND user_id = ?
+        """, (periodicity, user_id))]
+
+    def _completion_table(self):
+        # The table holding the completions in the current storage mode
+        return "completion_runs" if self.run_storage else "completions"
+
+    def delete_habit(self, habit_id):
+        conn = self.connect()
+        conn.execute("DELETE FROM habits WHERE id = ?", (habit_id,))
+        for table in (self._completion_table(), "habit_streaks", "completion_rollups"):
+            conn.execute(f"DELETE FROM {table} WHERE habit_id = ?", (habit_id,))
+
+    def delete_user_habits(self, user_id):
+        conn = self.connect()
+        for table in (self._completion_table(), "habit_streaks", "completion_rollups"):
+            conn.execute(f"DELETE FROM {table} WHERE habit_id IN (SELECT id FROM habits WHERE user_id = ?)",
+                         (user_id,))
+        conn.execute("DELETE FROM habits WHERE user_id = ?", (user_id,))
+
+    def completion_days(self, habit_id, periodicity):
+        if self.run_storage:
+            return runs.habit_days(self.connect(), habit_id, periodicity == 'weekly')
+        return [
+            row[0] for row in self.connect().execute("""
+                SELECT day FROM completions WHERE habit_id = ? ORDER BY day ASC
+            """, (habit_id,))
+        ]
+
+    def record_completion(self, habit_id, periodicity, day):
+        """
+        Store one completion and fold it into the streak, rollup and next_due tables, inside
+        the caller's transaction. A completion already recorded (the same day, or a covered
+        period under run-length storage) is ignored and leaves those tables as they are.
+        """
+        conn = self.connect()
+        if self.run_storage:
+            stored = runs.record_period(conn, habit_id, period_index(day, periodicity))
+            if periodicity == 'weekly':
+                day = period_index(day, periodicity) * 7 + 1  # Runs keep the Monday of the week
+        else:
+            stored = conn.execute("""
+                INSERT OR IGNORE INTO completions (habit_id, day, period)
+                VALUES (?, ?, ?)
+            """, (habit_id, day, period_index(day, periodicity))).rowcount == 1
+        if stored:
+            streaks.record_completion(conn, habit_id, periodicity, day)
+            rollups.record(conn, habit_id, day)
+            reminders.record(conn, habit_id, periodicity, day)
+        return stored
+
+    def insert_completions(self, rows):
+        """
+        Insert a batch of (habit_id, day, period) rows in the caller's transaction,
+        merging them into the habits' runs under run-length storage.
+        Returns the number of rows stored; completions already recorded are ignored.
+        """
+        conn = self.connect()
+        if self.run_storage:
+            periods_by_habit = {}
+            for habit_id, _, period in rows:
+                periods_by_habit.setdefault(habit_id, []).append(period)
+            return sum(runs.merge_periods(conn, habit_id, periods)
+                       for habit_id, periods in periods_by_habit.items())
+        return conn.executemany("""
+            INSERT OR IGNORE INTO completions (habit_id, day, period)
+            VALUES (?, ?, ?)
+        """, rows).rowcount
+
+    def refresh(self, user_id=None):
+        with self.transaction() as conn:
+            if user_id is None:
+                streaks.rebuild_streaks(conn)
+                rollups.rebuild_rollups(conn)
+                reminders.rebuild_next_due(conn)
+            else:
+                streaks.rebuild_user_streaks(conn, user_id)
+                rollups.rebuild_rollups(conn, "h.user_id = ?", (user_id,))
+                reminders.rebuild_next_due(conn, "h.user_id = ?", (user_id,))
+
+    def streak_state(self, habit_id):
+        row = self.connect().execute("""
+            SELECT current_streak, longest_streak, last_period FROM habit_streaks WHERE habit_id = ?
+        """, (habit_id,)).fetchone()
+        return (row[0] or 0, row[1] or 0, row[2]) if row else (0, 0, None)
+
+    def streaks(self, user_id):
+        return streaks.query_streaks(self.connect(), user_id)
+
+    def compute_streaks(self, user_id=None):
+        conn = self.connect()
+        where, params = ("", ()) if user_id is None else ("WHERE h.user_id = ?", (user_id,))
+        habits = conn.execute(f"""
+            SELECT h.id, h.user_id, h.name, h.periodicity FROM habits h {where} ORDER BY h.id
+        """, params).fetchall()
+        if self.run_storage:
+            # Runs already are the streaks: read them instead of expanding every period
+            habit_filter, filter_params = ("1", ()) if user_id is None else ("h.user_id = ?", params * 2)
+            return {
+                habit_id: (last_streak if streaks.is_alive(periodicity, last_period) else 0, longest)
+                for habit_id, _, periodicity, last_streak, longest, last_period, _, _
+                in streaks.query_streak_state(conn, habit_filter, filter_params)
+            }, habits
+        habit_column, day_column = array('q'), array('q')
+        for habit_id, day in conn.execute(f"""
+            SELECT c.habit_id, c.day FROM habits h JOIN completions c ON c.habit_id = h.id {where}
+        """, params):
+            habit_column.append(habit_id)
+            day_column.append(day)
+        weekly_ids = [habit_id for habit_id, _, _, periodicity in habits if periodicity == 'weekly']
+        return streaks.batch_streaks(habit_column, day_column, weekly_ids), habits
+
+    def rebuild_streaks(self, check_only=False):
+        drift = streaks.verify_streaks(self.connect())
+        if drift and not check_only:
+            with self.transaction() as conn:
+                streaks.rebuild_streaks(conn)
+                reminders.rebuild_next_due(conn)
+        return drift
+
+    def longest_streak(self, user_id):
+        return self.connect().execute("""
+            SELECT h.name, s.longest_streak FROM habit_streaks s
+            JOIN habits h ON h.id = s.habit_id
+            WHERE h.user_id = ? AND s.longest_streak > 0
+            ORDER BY s.longest_streak DESC, h.id ASC
+            LIMIT 1
+        """, (user_id,)).fetchone()
+
+
+class MemoryStorage(Storage):
+    """
+    Keeps everything in dicts in this process, for tests, simulations and throwaway
+    analytics; nothing is persisted. Users are indexed by name and habits by id and by
+    (user_id, name). Each habit's completions are a sorted array('i') of day ordinals,
+    and its streak state is updated on every completion like the SQLite streak table.
+    Writes hold a lock, so threads may share the storage. A transaction holds the lock
+    for its whole block and logs how to undo each habit and completion write, so that
+    they are all undone if the block raises.
+    """
+    def __init__(self):
+        self._users = {}  # id -> [id, username, password]
+        self._user_ids = {}  # username -> id
+        self._habits = {}  # id -> (id, name, periodicity, created_at, user_id)
+        self._habit_ids = {}  # (user_id, name) -> habit id
+        self._user_habits = {}  # user_id -> habit ids in id order
+        self._days = {}  # habit id -> array('i') of completion days
+        self._streaks = {}  # habit id -> (current_streak, longest_streak, last_period)
+        self._next_user_id = itertools.count(1)
+        self._next_habit_id = itertools.count(1)
+        self._lock = threading.RLock()
+        self._undo = None  # Undo steps of the open transaction, newest last
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            if self._undo is not None:
+                yield self  # Joins the transaction already open in this thread
+                return
+            self._undo = []
+            try:
+                yield self
+            except BaseException:
+                for undo in reversed(self._undo):
+                    undo()
+                raise
+            finally:
+                self._undo = None
+
+    def _on_rollback(self, undo, *args):
+        # Called with the lock held: remember how to revert a write of the open transaction
+        if self._undo is not None:
+            self._undo.append(lambda: undo(*args))
+
+    def add_users(self, rows):
+        ids = []
+        with self._lock:
+            for username, password, _ in rows:
+                if username in self._user_ids:
+                    ids.append(None)
+                    continue
+                user_id = next(self._next_user_id)
+                self._users[user_id] = [user_id, username, password]
+                self._user_ids[username] = user_id
+                ids.append(user_id)
+        return ids
+
+    def find_user(self, username):
+        user_id = self._user_ids.get(username)
+        return tuple(self._users[user_id]) if user_id is not None else None
+
+    def set_password(self, user_id, password):
+        with self._lock:
+            self._users[user_id][2] = password
+
+    def usernames(self):
+        return [user[1] for user in self._users.values()]
+
+    def add_habit(self, user_id, name, periodicity, created_at):
+        with self._lock:
+            if (user_id, name) in self._habit_ids:
+                return None
+            habit_id = next(self._next_habit_id)
+            # As SQLite stores dates and datetimes
+            self._habits[habit_id] = (habit_id, name, periodicity, str(created_at), user_id)
+            self._habit_ids[user_id, name] = habit_id
+            self._user_habits.setdefault(user_id, []).append(habit_id)
+            self._days[habit_id] = array('i')
+            self._streaks[habit_id] = (0, 0, None)
+            self._on_rollback(self._delete_habit, habit_id)
+        return habit_id
+
+    def habits(self, user_id):
+        return [self._habits[habit_id][:4] for habit_id in self._user_habits.get(user_id, ())]
+
+    def page_habits(self, user_id, name=None, periodicity=None, created_from=None, created_to=None,
+                    limit=50, after_id=0):
+        habit_ids = self._user_habits.get(user_id, [])
+        page = []
+        for habit_id in habit_ids[bisect.bisect_right(habit_ids, after_id):]:
+            row = self._habits[habit_id][:4]
+            if ((name and name.lower() not in row[1].lower())
+                    or (periodicity and row[2] != periodicity)
+                    or (created_from is not None and row[3] < created_from.isoformat())
+                    or (created_to is not None and row[3] >= created_to.isoformat())):
+                continue
+            page.append(row)
+            if len(page) >= limit:
+                break
+        return page
+
+    def find_habit(self, user_id, name):
+        habit_id = self._habit_ids.get((user_id, name))
+        return self._habits[habit_id][:4] if habit_id is not None else None
+
+    def habit_names(self, user_id, periodicity):
+        return [row[1] for row in self.habits(user_id) if row[2] == periodicity]
+
+    def delete_habit(self, habit_id):
+        with self._lock:
+            self._on_rollback(self._restore_habit, self._habits[habit_id], self._days[habit_id],
+                              self._streaks[habit_id])
+            self._delete_habit(habit_id)
+
+    def _delete_habit(self, habit_id):
+        _, name, _, _, user_id = self._habits.pop(habit_id)
+        del self._habit_ids[user_id, name]
+        self._user_habits[user_id].remove(habit_id)
+        del self._days[habit_id], self._streaks[habit_id]
+
+    def _restore_habit(self, row, days, streak):
+        habit_id, name, _, _, user_id = row
+        self._habits[habit_id] = row
+        self._habit_ids[user_id, name] = habit_id
+        bisect.insort(self._user_habits[user_id], habit_id)
+        self._days[habit_id], self._streaks[habit_id] = days, streak
+
+    def delete_user_habits(self, user_id):
+        with self._lock:
+            for habit_id in list(self._user_habits.get(user_id, ())):
+                self.delete_habit(habit_id)
+
+    def completion_days(self, habit_id, periodicity):
+        return list(self._days.get(habit_id, ()))
+
+    def _store(self, habit_id, day):
+        # Insert a day into a habit's sorted days; False if it is already there
+        days = self._days[habit_id]
+        position = bisect.bisect_left(days, day)
+        if position < len(days) and days[position] == day:
+            return False
+        days.insert(position, day)
+        self._on_rollback(days.remove, day)
+        return True
+
+    def record_completion(self, habit_id, periodicity, day):
+        with self._lock:
+            if not self._store(habit_id, day):
+                return False
+            self._on_rollback(self._streaks.__setitem__, habit_id, self._streaks[habit_id])
+            period = period_index(day, periodicity)
+            current, longest, last_period = self._streaks[habit_id]
+            if last_period is None:
+                current, longest, last_period = 1, 1, period
+            elif period < last_period:
+                self._streaks[habit_id] = self._streak_state(habit_id, periodicity)
+                return True
+            elif period == last_period + 1:
+                current, longest, last_period = current + 1, max(longest, current + 1), period
+            elif period > last_period:
+                current, longest, last_period = 1, max(longest, 1), period
+            self._streaks[habit_id] = (current, longest, last_period)
+        return True
+
+    def _streak_state(self, habit_id, periodicity):
+        # Recompute a habit's streak state from its sorted days
+        current = longest = 0
+        last_period = None
+        for day in self._days[habit_id]:
+            period = period_index(day, periodicity)
+            if last_period is not None and period == last_period:
+                continue
+            current = current + 1 if last_period is not None and period == last_period + 1 else 1
+            longest = max(longest, current)
+            last_period = period
+        return current, longest, last_period
+
+    def insert_completions(self, rows):
+        with self._lock:
+            return sum(self._store(habit_id, day) for habit_id, day, _ in rows)
+
+    def refresh(self, user_id=None):
+        with self._lock:
+            habit_ids = self._habits if user_id is None else self._user_habits.get(user_id, ())
+            for habit_id in habit_ids:
+                self._streaks[habit_id] = self._streak_state(habit_id, self._habits[habit_id][2])
+
+    def streak_state(self, habit_id):
+        return self._streaks.get(habit_id, (0, 0, None))
+
+    def streaks(self, user_id):
+        today = date.today()
+        results = []
+        for habit_id, name, periodicity, _ in self.habits(user_id):
+            current, longest, last_period = self._streaks[habit_id]
+            results.append((name, periodicity, current if streaks.is_alive(periodicity, last_period, today) else 0,
+                            longest))
+        return results
+
+    def compute_streaks(self, user_id=None):
+        with self._lock:
+            habit_ids = sorted(self._habits) if user_id is None else list(self._user_habits.get(user_id, ()))
+            habits = [(habit_id, owner_id, name, periodicity) for habit_id, name, periodicity, _, owner_id
+                      in (self._habits[habit_id] for habit_id in habit_ids)]
+            habit_column, day_column = array('q'), array('i')
+            for habit_id in habit_ids:
+                days = self._days[habit_id]
+                habit_column.extend(itertools.repeat(habit_id, len(days)))
+                day_column.extend(days)
+        weekly_ids = [habit_id for habit_id, _, _, periodicity in habits if periodicity == 'weekly']
+        return streaks.batch_streaks(habit_column, day_column, weekly_ids), habits
+
+    def rebuild_streaks(self, check_only=False):
+        drift = []
+        with self._lock:
+            for habit_id in sorted(self._habits):
+                _, name, periodicity, _, _ = self._habits[habit_id]
+                expected = self._streak_state(habit_id, periodicity)
+                if expected != self._streaks[habit_id]:
+                    # Totals are not kept apart from the days, so they can't drift
+                    total = len(self._days[habit_id])
+                    drift.append((habit_id, name, expected + (total,), self._streaks[habit_id] + (total,)))
+                    if not check_only:
+                        self._streaks[habit_id] = expected
+        return drift
+
+    def longest_streak(self, user_id):
+        best = None
+        for habit_id, name, _, _ in self.habits(user_id):
+            longest = self._streaks[habit_id][1]
+            if longest > 0 and (best is None or longest > best[1]):
+                best = (name, longest)
+        return best
+
+
+# Names of the backends selectable in HabitTracker(backend=...)
+BACKENDS = ("sqlite", "memory")
@@ -0,0 +1,301 @@
+from datetime import date
+from habit import period_index
+import runs
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; batch_streaks falls back to pure Python
+    np = None
+
+# Gaps-and-islands over the distinct periods of every habit: consecutive
+# periods minus their row number give the same group value, so each group
+# is one streak and its size is the streak length. The {habit_filter}
+# placeholder restricts the habits (to one user, one habit or none).
+STREAK_STATE_SQL = """
+    WITH periods AS (
+        SELECT h.id AS habit_id, c.period,
+               COUNT(*) AS completions,
+               MAX(c.day) AS last_day
+        FROM habits h
+        JOIN completions c ON c.habit_id = h.id
+        WHERE {habit_filter}
+        GROUP BY h.id, c.period
+    ),
+    islands AS (
+        SELECT habit_id, period, completions, last_day,
+               period - ROW_NUMBER() OVER (PARTITION BY habit_id ORDER BY period) AS grp
+        FROM periods
+    ),
+    runs AS (
+        SELECT habit_id, COUNT(*) AS length, MAX(period) AS last_period,
+               SUM(completions) AS completions, MAX(last_day) AS last_day,
+               ROW_NUMBER() OVER (PARTITION BY habit_id ORDER BY MAX(period) DESC) AS recency
+        FROM islands
+        GROUP BY habit_id, grp
+    ),
+    summary AS (
+        SELECT habit_id,
+               MAX(length) AS longest,
+               MAX(CASE WHEN recency = 1 THEN length END) AS last_length,
+               MAX(last_period) AS last_period,
+               MAX(last_day) AS last_day,
+               SUM(completions) AS completions
+        FROM runs
+        GROUP BY habit_id
+    )
+    SELECT h.id, h.name, h.periodicity,
+           COALESCE(s.last_length, 0), COALESCE(s.longest, 0),
+           s.last_period, s.last_day, COALESCE(s.completions, 0)
+    FROM habits h
+    LEFT JOIN summary s ON s.habit_id = h.id
+    WHERE {habit_filter}
+    ORDER BY h.id
+"""
+
+# The same state read from run-length storage (see runs.py): every run is a
+# streak already, so the longest streak is the longest run and the last streak
+# is the run with the highest start.
+RUN_STREAK_STATE_SQL = """
+    WITH summary AS (
+        SELECT r.habit_id,
+               MAX(r.length) AS longest,
+               MAX(r.start) AS last_start,
+               SUM(r.length) AS completions
+        FROM habits h
+        JOIN completion_runs r ON r.habit_id = h.id
+        WHERE {habit_filter}
+        GROUP BY r.habit_id
+    )
+    SELECT h.id, h.name, h.periodicity,
+           COALESCE(r.length, 0), COALESCE(s.longest, 0),
+           r.start + r.length - 1,
+           CASE h.periodicity WHEN 'weekly' THEN (r.start + r.length - 1) * 7 + 1
+                ELSE r.start + r.length - 1 END,
+           COALESCE(s.completions, 0)
+    FROM habits h
+    LEFT JOIN summary s ON s.habit_id = h.id
+    LEFT JOIN completion_runs r ON r.habit_id = h.id AND r.start = s.last_start
+    WHERE {habit_filter}
+    ORDER BY h.id
+"""
+
+
+def is_alive(periodicity, last_period, today=None):
+    """
+    Return True if a streak whose last completion fell in last_period has not been broken yet,
+    i.e. the habit was completed in the current or the previous period.
+    """
+    if last_period is None:
+        return False
+    today = (today or date.today()).toordinal()
+    return last_period >= period_index(today, periodicity) - 1
+
+
+def query_streak_state(conn, habit_filter="1", params=()):
+    """
+    Recompute the streak state of the habits matching habit_filter straight from completions.
+    Returns (habit_id, name, periodicity, last_streak, longest_streak, last_period,
+    last_day, total_completions) tuples, where last_streak is the length of the
+    most recent run whether or not it is still alive. With run-length storage the
+    runs are read directly and total_completions counts completed periods.
+    """
+    sql = RUN_STREAK_STATE_SQL if runs.uses_run_storage(conn) else STREAK_STATE_SQL
+    return conn.execute(sql.format(habit_filter=habit_filter), params).fetchall()
+
+
+def query_streaks(conn, user_id, today=None):
+    """
+    Compute the current and longest streak of every habit of a user in a single query.
+    Returns a list of (habit_name, periodicity, current_streak, longest_streak) tuples.
+    """
+    rows = query_streak_state(conn, "h.user_id = ?", (user_id, user_id))
+    return [
+        (name, periodicity, last_streak if is_alive(periodicity, last_period, today) else 0, longest)
+        for _, name, periodicity, last_streak, longest, last_period, _, _ in rows
+    ]
+
+
+def record_completion(conn, habit_id, periodicity, day):
+    """
+    Fold one new completion into the materialized streak state of a habit.
+    Must run inside the transaction that inserted the completion. Completions
+    older than the last recorded one cannot be folded in and trigger a
+    recomputation of that habit only.
+    """
+    period = period_index(day, periodicity)
+    row = conn.execute("""
+        SELECT current_streak, longest_streak, last_period FROM habit_streaks WHERE habit_id = ?
+    """, (habit_id,)).fetchone()
+    if row is None or row[2] is None:
+        current, longest = 1, 1
+    elif period < row[2]:
+        rebuild_habit_streak(conn, habit_id)
+        return
+    elif period == row[2]:
+        current, longest = row[0], row[1]
+    elif period == row[2] + 1:
+        current, longest = row[0] + 1, max(row[1], row[0] + 1)
+    else:
+        current, longest = 1, max(row[1], 1)
+
+    conn.execute("""
+        INSERT INTO habit_streaks
+            (habit_id, current_streak, longest_streak, last_period, last_day, total_completions)
+        VALUES (?, ?, ?, ?, ?, 1)
+        ON CONFLICT (habit_id) DO UPDATE SET
+            current_streak = excluded.current_streak,
+            longest_streak = excluded.longest_streak,
+            last_period = excluded.last_period,
+            last_day = MAX(COALESCE(last_day, 0), excluded.last_day),
+            total_completions = total_completions + 1
+    """, (habit_id, current, longest, period, day))
+
+
+def advance(state, periodicity, day):
+    """
+    Return the (current_streak, longest_streak, last_period) of a habit after a completion
+    on a day ordinal, given its state before. A completion in or before last_period changes nothing.
+    """
+    period = period_index(day, periodicity)
+    current, longest, last_period = state
+    if last_period is None:
+        return 1, max(longest, 1), period
+    if period <= last_period:
+        return state
+    current = current + 1 if period == last_period + 1 else 1
+    return current, max(longest, current), period
+
+
+def rebuild_habit_streak(conn, habit_id):
+    """
+    Recompute the streak state of a single habit from its completions.
+    """
+    _store_streak_state(conn, query_streak_state(conn, "h.id = ?", (habit_id, habit_id)))
+
+
+def rebuild_user_streaks(conn, user_id):
+    """
+    Recompute the streak state of every habit of one user from its completions.
+    """
+    _store_streak_state(conn, query_streak_state(conn, "h.user_id = ?", (user_id, user_id)))
+
+
+def rebuild_streaks(conn):
+    """
+    Recompute the whole streak table from completions. Returns the number of habits written.
+    The caller owns the transaction.
+    """
+    rows = query_streak_state(conn)
+    conn.execute("DELETE FROM habit_streaks")
+    _store_streak_state(conn, rows)
+    return len(rows)
+
+
+def verify_streaks(conn):
+    """
+    Compare the materialized streak table with a fresh recomputation.
+    Returns a list of (habit_id, habit_name, expected, actual) tuples for every habit that drifted,
+    where expected and actual are (current_streak, longest_streak, last_period, total_completions).
+    """
+    stored = {
+        row[0]: tuple(row[1:])
+        for row in conn.execute("""
+            SELECT habit_id, current_streak, longest_streak, last_period, total_completions
+            FROM habit_streaks
+        """)
+    }
+    drift = []
+    for habit_id, name, _, last_streak, longest, last_period, _, total in query_streak_state(conn):
+        expected = (last_streak, longest, last_period, total)
+        actual = stored.pop(habit_id, (0, 0, None, 0))
+        if expected != actual:
+            drift.append((habit_id, name, expected, actual))
+    for habit_id, actual in stored.items():
+        # Streak rows left behind by habits that no longer exist
+        drift.append((habit_id, None, None, actual))
+    return drift
+
+
+def _store_streak_state(conn, rows):
+    conn.executemany("""
+        INSERT OR REPLACE INTO habit_streaks
+            (habit_id, current_streak, longest_streak, last_period, last_day, total_completions)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, [
+        (habit_id, last_streak, longest, last_period, last_day, total)
+        for habit_id, _, _, last_streak, longest, last_period, last_day, total in rows
+    ])
+
+
+def batch_streaks(habit_ids, days, weekly_ids=(), today=None, use_numpy=None):
+    """
+    Compute the current and longest streak of many habits at once from flat, parallel
+    sequences of habit ids and completion day ordinals (in any order). weekly_ids lists
+    the habits counted in weeks; the others are daily. Returns a dict mapping each habit id
+    that has completions to (current_streak, longest_streak), with the same meaning as
+    Habit.current_streak() and Habit.streak().
+    NumPy is used when it is installed, unless use_numpy is False.
+    """
+    today = (today or date.today()).toordinal()
+    if use_numpy is None:
+        use_numpy = np is not None
+    if use_numpy:
+        return _batch_streaks_numpy(habit_ids, days, weekly_ids, today)
+    return _batch_streaks_python(habit_ids, days, weekly_ids, today)
+
+
+def _batch_streaks_numpy(habit_ids, days, weekly_ids, today):
+    habit_ids = np.asarray(habit_ids, dtype=np.int64)
+    days = np.asarray(days, dtype=np.int64)
+    if habit_ids.size == 0:
+        return {}
+    weekly_ids = np.asarray(list(weekly_ids), dtype=np.int64)
+    periods = np.where(np.isin(habit_ids, weekly_ids), (days - 1) // 7, days)
+
+    # Pack (habit, period) into one sortable key (periods of real dates fit in 32 bits),
+    # then sort and keep one entry per (habit, period)
+    keys = np.sort((habit_ids << 32) | periods)
+    keys = keys[np.append(True, keys[1:] != keys[:-1])]
+    habit_ids, periods = keys >> 32, keys & 0xFFFFFFFF
+
+    # A run starts at a new habit or after a gap; label every entry with its run
+    new_habit = np.ones(habit_ids.size, dtype=bool)
+    new_habit[1:] = habit_ids[1:] != habit_ids[:-1]
+    run_start = new_habit.copy()
+    run_start[1:] |= periods[1:] - periods[:-1] != 1
+    run_starts = np.flatnonzero(run_start)
+    run_lengths = np.diff(np.append(run_starts, habit_ids.size))
+
+    # Runs are ordered by habit, so each habit's runs form one segment
+    habit_of_run = habit_ids[run_starts]
+    segment_starts = np.flatnonzero(new_habit[run_starts])
+    longest = np.maximum.reduceat(run_lengths, segment_starts)
+    last_runs = np.append(segment_starts[1:], run_starts.size) - 1
+    last_index = np.append(np.flatnonzero(new_habit)[1:], habit_ids.size) - 1
+    today_period = np.where(np.isin(habit_ids[last_index], weekly_ids), (today - 1) // 7, today)
+    alive = periods[last_index] >= today_period - 1
+    current = np.where(alive, run_lengths[last_runs], 0)
+
+    return {
+        int(habit_id): (int(current_streak), int(longest_streak))
+        for habit_id, current_streak, longest_streak in zip(habit_of_run[segment_starts], current, longest)
+    }
+
+
+def _batch_streaks_python(habit_ids, days, weekly_ids, today):
+    weekly_ids = set(weekly_ids)
+    periods_by_habit = {}
+    for habit_id, day in zip(habit_ids, days):
+        periods_by_habit.setdefault(habit_id, set()).add((day - 1) // 7 if habit_id in weekly_ids else day)
+
+    result = {}
+    for habit_id, periods in periods_by_habit.items():
+        longest = length = 0
+        previous = None
+        for period in sorted(periods):
+            length = length + 1 if previous is not None and period == previous + 1 else 1
+            longest = max(longest, length)
+            previous = period
+        today_period = (today - 1) // 7 if habit_id in weekly_ids else today
+        result[habit_id] = (length if previous >= today_period - 1 else 0, longest)
+    return result
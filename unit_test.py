@@ -1,24 +1,62 @@
+import analytics
+import asyncio
+import csv
+import io
+import json
+import os
+import random
+import re
+import tempfile
+import threading
 import unittest
+import unittest.mock
+from contextlib import redirect_stderr, redirect_stdout
 import sqlite3
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+import benchmark
+import cli
+import export
+from cache import MISSING, HabitCache, TokenCache
+import migrations
+import passwords
+import rollups
+import runs
+import storage
+import streaks
 from habit import Habit
 from habit_tracker import HabitTracker
+from server import HabitServer, run_load, send_request
+from pool import ConnectionPool
 from user import User
+from write_behind import WriteBehindQueue
+
+# Cheap hashes keep the tests fast; every hash records its own iteration count
+passwords.ITERATIONS = 1000
 
 
 class TestHabitTracker(unittest.TestCase):
     def setUp(self):
         """Initialize a test database and tracker instance before each test"""
-        self.tracker = HabitTracker()
-        self.tracker.conn = sqlite3.connect(':memory:')  # Use in-memory DB for testing
-        self.tracker.create_tables()
+        self.tracker = HabitTracker(':memory:')  # Use in-memory DB for testing
         self.user = User("testuser", "password")
         self.tracker.create_user(self.user.username, self.user.password)
         self.tracker.login_user(self.user.username, self.user.password)
 
     def tearDown(self):
         """Close the database connection after each test"""
-        self.tracker.conn.close()
+        self.tracker.close()
+
+    def assertNoTableScans(self, statements):
+        """Assert that EXPLAIN QUERY PLAN of every statement only searches tables, never scans them"""
+        tables = {row[0] for row in self.tracker.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        for sql in statements:
+            if not re.match(r"\s*(SELECT|WITH|DELETE|UPDATE)", sql, re.IGNORECASE):
+                continue
+            names = set(tables)
+            names.update(alias for table, alias in re.findall(r"(?:FROM|JOIN)\s+(\w+)\s+(\w+)", sql) if table in tables)
+            for row in self.tracker.conn.execute("EXPLAIN QUERY PLAN " + sql):
+                scan = re.match(r"SCAN (\w+)", row[3])
+                self.assertFalse(scan and scan.group(1) in names, f"{row[3]!r} in query plan of: {sql}")
 
     def test_create_habit(self):
         """Test creating a new habit"""
@@ -46,19 +84,32 @@ class TestHabitTracker(unittest.TestCase):
         completion_dates = [(datetime.now() - timedelta(days=i)).date() for i in range(5)]
         for date in completion_dates:
             self.tracker.conn.execute("""
-                INSERT INTO completions (habit_id, completion_date)
-                VALUES (?, ?)
-            """, (habit_id, date))
+                INSERT INTO completions (habit_id, day, period)
+                VALUES (?, ?, ?)
+            """, (habit_id, date.toordinal(), date.toordinal()))
         self.tracker.conn.commit()
 
-        # Fetch completions from DB and update habit's completed_dates
+        # Fetch completions from DB and update habit's completed_days
         completions = self.tracker.conn.execute("""
-            SELECT completion_date FROM completions WHERE habit_id = ? ORDER BY completion_date ASC
+            SELECT day FROM completions WHERE habit_id = ? ORDER BY day ASC
         """, (habit_id,)).fetchall()
-        habit.completed_dates = [datetime.strptime(row[0], "%Y-%m-%d").date() for row in completions]
+        habit.completed_days = [row[0] for row in completions]
 
         self.assertEqual(habit.streak(), 5)
 
+    def test_completed_dates_and_add_completion(self):
+        """Test that completed_dates is a read-only view and add_completion keeps days sorted"""
+        habit = Habit("Stretch", "daily", self.tracker.current_user.id)
+        today = date.today()
+        habit.completed_dates = [today, today - timedelta(days=2)]
+        self.assertEqual(habit.completed_dates, (today - timedelta(days=2), today))
+        with self.assertRaises(AttributeError):
+            habit.completed_dates.append(today)  # Use add_completion()
+        habit.add_completion(today - timedelta(days=1))
+        habit.add_completion(today.toordinal() - 3)
+        self.assertEqual(habit.completed_days.tolist(), [today.toordinal() - offset for offset in (3, 2, 1, 0)])
+        self.assertEqual(habit.streak(), 4)
+
     def test_get_longest_streak(self):
         """Test retrieving the longest streak"""
         habit1 = Habit("Walk", "daily", self.tracker.current_user.id)
@@ -69,20 +120,522 @@ class TestHabitTracker(unittest.TestCase):
         for i in range(3):
             date = (datetime.now() - timedelta(days=i)).date()
             self.tracker.conn.execute("""
-                INSERT INTO completions (habit_id, completion_date)
-                VALUES ((SELECT id FROM habits WHERE name = 'Walk'), ?)
-            """, (date,))
+                INSERT INTO completions (habit_id, day, period)
+                VALUES ((SELECT id FROM habits WHERE name = 'Walk'), ?, ?)
+            """, (date.toordinal(), date.toordinal()))
         for i in range(5):
             date = (datetime.now() - timedelta(days=i)).date()
             self.tracker.conn.execute("""
-                INSERT INTO completions (habit_id, completion_date)
-                VALUES ((SELECT id FROM habits WHERE name = 'Exercise'), ?)
-            """, (date,))
+                INSERT INTO completions (habit_id, day, period)
+                VALUES ((SELECT id FROM habits WHERE name = 'Exercise'), ?, ?)
+            """, (date.toordinal(), date.toordinal()))
         self.tracker.conn.commit()
+        self.tracker.rebuild_streaks()  # Raw inserts bypass the streak table
         longest_habit, longest_streak = self.tracker.get_longest_streak()
         self.assertEqual(longest_habit, "Exercise")
         self.assertEqual(longest_streak, 5)
 
+    def test_get_streaks_weekly_and_gaps(self):
+        """Test current and longest streaks computed in SQL for daily and weekly habits"""
+        self.tracker.add_habit(Habit("Yoga", "daily", self.tracker.current_user.id))
+        self.tracker.add_habit(Habit("Hike", "weekly", self.tracker.current_user.id))
+        today = datetime.now().date()
+        # Yoga: 2 days ending today, a gap, then 4 older consecutive days (and a duplicate)
+        yoga_days = [0, 1, 3, 4, 5, 6, 6]
+        # Hike: 3 consecutive weeks ending three weeks ago, so no current streak
+        hike_days = [21, 28, 35]
+        for name, offsets in (("Yoga", yoga_days), ("Hike", hike_days)):
+            self.tracker.bulk_import((name, today - timedelta(days=offset)) for offset in offsets)
+
+
+        streaks = {name: (current, longest) for name, _, current, longest in self.tracker.get_streaks()}
+        self.assertEqual(streaks["Yoga"], (2, 4))
+        self.assertEqual(streaks["Hike"], (0, 3))
+        self.assertEqual(self.tracker.get_longest_streak(), ("Yoga", 4))
+
+        habit = Habit("Yoga", "daily", self.tracker.current_user.id)
+        habit.completed_dates = [today - timedelta(days=offset) for offset in yoga_days]
+        self.assertEqual((habit.current_streak(), habit.streak()), (2, 4))
+
+    def test_streak_table_maintenance(self):
+        """Test that completions and deletes keep the streak table in sync, and drift is reported"""
+        self.tracker.add_habit(Habit("Stretch", "daily", self.tracker.current_user.id))
+        self.tracker.add_habit(Habit("Journal", "daily", self.tracker.current_user.id))
+        self.tracker.complete_habit("Stretch")
+        self.tracker.complete_habit("Stretch")
+        self.assertEqual(self.tracker.get_habit_streak("Stretch"), (1, 1))
+        self.assertIsNone(self.tracker.get_habit_streak("Unknown"))
+        self.assertEqual(self.tracker.rebuild_streaks(check_only=True), [])
+
+        # A backdated completion inserted behind the tracker's back is reported and repaired
+        yesterday = datetime.now().date().toordinal() - 1
+        self.tracker.conn.execute("""
+            INSERT INTO completions (habit_id, day, period)
+            VALUES ((SELECT id FROM habits WHERE name = 'Stretch'), ?, ?)
+        """, (yesterday, yesterday))
+        self.tracker.conn.commit()
+        drift = self.tracker.rebuild_streaks(check_only=True)
+        self.assertEqual([name for _, name, _, _ in drift], ["Stretch"])
+        self.tracker.rebuild_streaks()
+        self.assertEqual(self.tracker.get_habit_streak("Stretch"), (2, 2))
+        self.assertEqual(self.tracker.get_longest_streak(), ("Stretch", 2))
+
+        self.tracker.delete_habit("Stretch")
+        self.assertEqual(self.tracker.get_longest_streak(), (None, 0))
+        self.tracker.delete_all_habits()
+        count = self.tracker.conn.execute("SELECT COUNT(*) FROM habit_streaks").fetchone()[0]
+        self.assertEqual(count, 0)
+
+    def test_query_plans_use_indexes(self):
+        """Test that per-user operations are served by indexes instead of table scans"""
+        self.tracker.add_habit(Habit("Floss", "daily", self.tracker.current_user.id))
+        self.tracker.add_habit(Habit("Call family", "weekly", self.tracker.current_user.id))
+        statements = []
+        self.tracker.conn.set_trace_callback(statements.append)
+        self.tracker.complete_habit("Floss")
+        self.tracker.get_user_habits()
+        self.tracker.get_habits_by_periodicity("weekly")
+        self.tracker.get_streaks()
+        self.tracker.get_longest_streak()
+        self.tracker.get_habit_streak("Floss")
+        self.tracker.delete_habit("Floss")
+        self.tracker.delete_all_habits()
+        self.tracker.conn.set_trace_callback(None)
+        self.assertNoTableScans(statements)
+
+        plan = " ".join(row[3] for row in self.tracker.conn.execute("""
+            EXPLAIN QUERY PLAN SELECT id FROM habits WHERE name = ? AND user_id = ?
+        """, ("Floss", 1)))
+        self.assertIn("idx_habits_user_name", plan)
+        plan = " ".join(row[3] for row in self.tracker.conn.execute("""
+            EXPLAIN QUERY PLAN SELECT day, period FROM completions WHERE habit_id = ? ORDER BY day
+        """, (1,)))
+        self.assertIn("COVERING INDEX idx_completions_habit_day", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_add_duplicate_habit(self):
+        """Test that a user cannot have two habits with the same name"""
+        self.tracker.add_habit(Habit("Run", "daily", self.tracker.current_user.id))
+        self.tracker.add_habit(Habit("Run", "weekly", self.tracker.current_user.id))
+        habits = self.tracker.get_user_habits()
+        self.assertEqual([(h.name, h.periodicity) for h in habits], [("Run", "daily")])
+
+    def test_bulk_import(self):
+        """Test importing completions in batches and streaming them from CSV and NDJSON files"""
+        self.tracker.add_habit(Habit("Read", "daily", self.tracker.current_user.id))
+        self.tracker.add_habit(Habit("Swim", "weekly", self.tracker.current_user.id))
+        today = datetime.now().date()
+        rows = [("Read", today - timedelta(days=i)) for i in range(10)]
+        rows += [("Swim", (today - timedelta(weeks=i)).isoformat()) for i in range(3)]
+        rows += [("Unknown", today), ("Read", "not a date")]
+        result = self.tracker.bulk_import(rows, batch_size=4)
+        self.assertEqual((result["imported"], result["skipped"]), (13, 2))
+        self.assertEqual(self.tracker.get_habit_streak("Read"), (10, 10))
+        self.assertEqual(self.tracker.get_habit_streak("Swim"), (3, 3))
+
+        directory = tempfile.mkdtemp()
+        csv_path = os.path.join(directory, "completions.csv")
+        ndjson_path = os.path.join(directory, "completions.ndjson")
+        with open(csv_path, "w") as handle:
+            handle.write(f"habit,date\nRead,{today - timedelta(days=10)}\n")
+        with open(ndjson_path, "w") as handle:
+            handle.write(f'{{"habit": "Read", "date": "{today - timedelta(days=11)}"}}\n\n')
+        self.assertEqual(self.tracker.import_file(csv_path)["imported"], 1)
+        self.assertEqual(self.tracker.import_file(ndjson_path)["imported"], 1)
+        self.assertEqual(self.tracker.get_habit_streak("Read"), (12, 12))
+        self.assertEqual(self.tracker.rebuild_streaks(check_only=True), [])
+
+        # Missing columns and keys are named instead of failing with a KeyError
+        with open(csv_path, "w") as handle:
+            handle.write(f"habit,day\nRead,{today}\n")
+        with open(ndjson_path, "w") as handle:
+            handle.write(f'{{"habit": "Read", "date": "{today}"}}\n\n{{"habit": "Read"}}\n')
+        with self.assertRaisesRegex(ValueError, 'the CSV header has no "date" column'):
+            self.tracker.import_file(csv_path)
+        with self.assertRaisesRegex(ValueError, 'line 3 has no "date" field'):
+            self.tracker.import_file(ndjson_path)
+        os.remove(csv_path)
+        os.remove(ndjson_path)
+        os.rmdir(directory)
+
+    def test_streaming_export(self):
+        """Test exporting completions page by page to CSV and NDJSON, and resuming after a cursor"""
+        self.tracker.add_habit(Habit("Read", "daily", self.tracker.current_user.id))
+        self.tracker.add_habit(Habit("Swim", "weekly", self.tracker.current_user.id))
+        today = date.today()
+        self.tracker.bulk_import([("Read", today - timedelta(days=i)) for i in range(7)] + [("Swim", today)])
+        self.tracker.create_user("other", "pw")
+        with self.tracker.session():
+            self.tracker.login_user("other", "pw")
+            self.tracker.add_habit(Habit("Walk", "daily", self.tracker.current_user.id))
+            self.tracker.complete_habit("Walk")
+
+        stream = io.StringIO()
+        result = export.write_export(self.tracker.export_completions(batch_size=3), stream, "csv")
+        rows = list(csv.DictReader(io.StringIO(stream.getvalue())))
+        self.assertEqual((result["rows"], len(rows)), (8, 8))
+        self.assertEqual([row["id"] for row in rows], [str(i) for i in range(1, 9)])
+        self.assertEqual(rows[0], {"id": "1", "username": "testuser", "habit": "Read",
+                                   "periodicity": "daily", "date": today.isoformat()})
+
+        stream = io.StringIO()
+        result = export.write_export(self.tracker.export_completions(after_id=5, batch_size=2), stream, "ndjson")
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([record["id"] for record in records], [6, 7, 8])
+        self.assertEqual((records[-1]["habit"], result["cursor"]), ("Swim", 8))
+        self.assertEqual([habit["name"] for habit in self.tracker.export_habits()], ["Read", "Swim"])
+
+        # Under run-length storage the same completions come out of the runs
+        self.tracker.set_completion_storage("runs")
+        exported = list(self.tracker.export_completions(all_users=True, batch_size=1))
+        self.assertEqual(len(exported), 9)
+        self.assertEqual(sorted(r["date"] for r in exported if r["habit"] == "Read"),
+                         sorted(row["date"] for row in rows if row["habit"] == "Read"))
+        resumed = list(self.tracker.export_completions(after_id=exported[2]["id"]))
+        self.assertEqual(resumed, [record for record in exported[3:] if record["username"] == "testuser"])
+
+    def test_instrumentation(self):
+        """Test that instrumentation counts calls, statements and rows per method, and can be removed"""
+        self.tracker.add_habit(Habit("Read", "daily", self.tracker.current_user.id))
+        self.tracker.add_habit(Habit("Swim", "weekly", self.tracker.current_user.id))
+        instrumentation = self.tracker.enable_instrumentation()
+        self.tracker.get_user_habits()
+        self.tracker.get_user_habits()
+        self.tracker.complete_habit("Read")
+        snapshot = instrumentation.snapshot()
+
+        self.assertEqual(set(snapshot), {"get_user_habits", "complete_habit"})
+        self.assertEqual(snapshot["get_user_habits"]["calls"], 2)
+        # The second call is answered by the habit cache
+        self.assertEqual(snapshot["get_user_habits"]["statements"], 1)
+        self.assertEqual(snapshot["get_user_habits"]["rows_fetched"], 2)
+        self.assertEqual(sum(snapshot["complete_habit"]["latency_histogram"].values()), 1)
+        self.assertGreaterEqual(snapshot["complete_habit"]["statements"], 4)
+
+        self.tracker.disable_instrumentation()
+        self.assertNotIn("get_user_habits", vars(self.tracker))
+        self.tracker.get_user_habits()
+        self.assertEqual(instrumentation.snapshot()["get_user_habits"]["calls"], 2)
+
+    def test_habit_cache(self):
+        """Test that repeated reads are served from the cache and writes invalidate only what changed"""
+        self.tracker.add_habit(Habit("Read", "daily", self.tracker.current_user.id))
+        self.tracker.add_habit(Habit("Swim", "weekly", self.tracker.current_user.id))
+        self.tracker.complete_habit("Read")
+        statements = []
+        self.tracker.conn.set_trace_callback(statements.append)
+
+        self.assertEqual(len(self.tracker.get_user_habits()), 2)
+        self.assertEqual(len(self.tracker.get_habit("Read").completed_dates), 1)
+        self.tracker.get_habit("Swim")
+        reads = len(statements)
+        self.tracker.get_user_habits()
+        self.tracker.get_habit("Read")
+        self.tracker.get_habit("Swim")
+        self.assertEqual(len(statements), reads)
+
+        self.tracker.complete_habit("Swim")
+        self.tracker.get_habit("Read")
+        self.assertEqual(len(self.tracker.get_habit("Swim").completed_dates), 1)
+        self.tracker.delete_habit("Read")
+        self.assertEqual([h.name for h in self.tracker.get_user_habits()], ["Swim"])
+        self.assertIsNone(self.tracker.get_habit("Read"))
+        self.tracker.conn.set_trace_callback(None)
+
+        stats = self.tracker.cache_stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (4, 6))
+        self.tracker.delete_all_habits()
+        self.assertEqual(self.tracker.get_user_habits(), [])
+        self.assertEqual(self.tracker.cache_stats()["entries"], 1)
+
+    def test_cache_eviction(self):
+        """Test that the cache keeps only the most recently used entries"""
+        cache = HabitCache(max_entries=2)
+        for name in ("a", "b"):
+            cache.put(1, name, name.upper(), cache.version(1))
+        cache.get(1, "a")
+        cache.put(1, "c", "C", cache.version(1))
+        self.assertIs(cache.get(1, "b"), MISSING)
+        self.assertEqual((cache.get(1, "a"), cache.get(1, "c")), ("A", "C"))
+        self.assertEqual(cache.stats()["evictions"], 1)
+        # A value read before an invalidation is not cached
+        version = cache.version(1)
+        cache.invalidate(1, "a")
+        cache.put(1, "a", "stale", version)
+        self.assertIs(cache.get(1, "a"), MISSING)
+
+    def test_write_behind_group_commit(self):
+        """Test that queued completions are written in batches, on a timer and on logout"""
+        # The flush thread needs the pool's connection, usable from any thread
+        self.tracker.close()
+        self.tracker = HabitTracker(':memory:')
+        self.tracker.create_user(self.user.username, self.user.password)
+        self.tracker.login_user(self.user.username, self.user.password)
+        names = ["Read", "Walk", "Swim", "Cook", "Call"]
+        for name in names:
+            self.tracker.add_habit(Habit(name, "daily", self.tracker.current_user.id))
+        queue = self.tracker.enable_write_behind(max_batch=3, max_delay=60)
+        count = lambda: self.tracker.conn.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+        self.assertTrue(self.tracker.complete_habit("Read"))
+        self.assertTrue(self.tracker.complete_habit("Walk"))
+        self.assertFalse(self.tracker.complete_habit("Unknown"))
+        self.assertEqual((queue.depth(), count()), (2, 0))
+        self.assertEqual(self.tracker.get_habit_streak("Read"), (1, 1))
+        self.tracker.complete_habit("Swim")
+        self.assertEqual((queue.depth(), count()), (0, 3))
+        self.tracker.complete_habit("Cook")
+        self.tracker.logout_user()
+        self.assertEqual(count(), 4)
+        stats = queue.stats()
+        self.assertEqual((stats["flushes"], stats["flushed"], stats["max_depth"]), (2, 4, 3))
+        self.assertGreater(stats["max_flush_ms"], 0)
+
+        self.tracker.login_user(self.user.username, self.user.password)
+        self.assertEqual(self.tracker.get_habit("Cook").completed_days.tolist(), [date.today().toordinal()])
+        self.assertEqual(self.tracker.rebuild_streaks(check_only=True), [])
+        self.tracker.disable_write_behind()
+        queue = self.tracker.enable_write_behind(max_batch=100, max_delay=0.01)
+        self.tracker.complete_habit("Call")
+        for _ in range(200):
+            if not queue.depth():
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual(count(), 5)
+        self.tracker.disable_write_behind()
+
+    def test_write_behind_drops_failing_items(self):
+        """Test that an item failing on its own is dropped instead of blocking the queue"""
+        written = []
+
+        def write(batch):
+            if "bad" in batch:
+                raise sqlite3.IntegrityError("bad item")
+            written.extend(batch)
+
+        queue = WriteBehindQueue(write, max_batch=100, max_delay=60)
+        for item in ["a", "bad", "b"]:
+            queue.put(item)
+        with redirect_stderr(io.StringIO()) as errors:
+            self.assertEqual(queue.flush(), 2)
+        self.assertIn("'bad'", errors.getvalue())
+        queue.put("c")
+        self.assertEqual(queue.close(), 1)
+        self.assertEqual(written, ["a", "b", "c"])
+        self.assertEqual((queue.stats()["failures"], queue.stats()["dropped"], queue.depth()), (1, 1, 0))
+
+    def test_write_behind_retries_transient_errors(self):
+        """Test that a batch failing on a lock timeout is kept and retried, not dropped"""
+        written, attempts = [], []
+
+        def write(batch):
+            attempts.append(list(batch))
+            if len(attempts) <= 2:
+                raise sqlite3.OperationalError("database is locked")
+            written.extend(batch)
+
+        queue = WriteBehindQueue(write, max_batch=100, max_delay=0.01)
+        with redirect_stderr(io.StringIO()):
+            queue.put("a")
+            queue.put("b")
+            with self.assertRaises(sqlite3.OperationalError):
+                queue.flush()
+            self.assertEqual(queue.depth(), 2)
+            for _ in range(200):
+                if written:
+                    break
+                threading.Event().wait(0.01)
+            queue.close()
+        self.assertEqual(written, ["a", "b"])
+        stats = queue.stats()
+        self.assertEqual((stats["retries"], stats["dropped"], stats["depth"]), (2, 0, 0))
+
+    def test_duplicate_completions_and_compaction(self):
+        """Test that a habit is completed once per day and compact removes orphaned rows"""
+        self.tracker.add_habit(Habit("Read", "daily", self.tracker.current_user.id))
+        self.tracker.complete_habit("Read")
+        self.tracker.complete_habit("Read")
+        today = date.today()
+        result = self.tracker.bulk_import([("Read", today), ("Read", today - timedelta(days=1))])
+        self.assertEqual((result["imported"], result["duplicates"]), (1, 1))
+        self.assertEqual(self.tracker.conn.execute("SELECT COUNT(*) FROM completions").fetchone()[0], 2)
+        self.assertEqual(self.tracker.rebuild_streaks(check_only=True), [])
+
+        # Rows left behind by a habit removed without its completions
+        self.tracker.conn.executemany("INSERT INTO completions (habit_id, day, period) VALUES (99, ?, ?)",
+                                      [(day, day) for day in range(700000, 702000)])
+        self.tracker.conn.execute("INSERT INTO habit_streaks (habit_id) VALUES (99)")
+        self.tracker.conn.commit()
+        result = self.tracker.compact()
+        self.assertEqual((result["orphaned_completions"], result["orphaned_streaks"]), (2000, 1))
+        self.assertGreater(result["bytes_reclaimed"], 0)
+        self.assertEqual(self.tracker.get_habit_streak("Read"), (2, 2))
+        self.assertEqual(self.tracker.rebuild_streaks(check_only=True), [])
+
+    def test_lazy_habits_and_paginated_listing(self):
+        """Test that habits load their completions on first access and can be listed page by page"""
+        for name, periodicity in [("Read", "daily"), ("Swim", "weekly"), ("Read aloud", "daily"), ("Run", "daily")]:
+            self.tracker.add_habit(Habit(name, periodicity, self.tracker.current_user.id))
+        self.tracker.complete_habit("Read")
+        statements = []
+        self.tracker.conn.set_trace_callback(statements.append)
+        habits = self.tracker.get_user_habits()
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(len(habits[0].completed_dates), 1)
+        self.assertEqual(habits[1].completed_days.tolist(), [])
+        self.assertEqual(len(statements), 3)
+        habit = self.tracker.get_habit("Run")
+        self.assertEqual((habit.name, habit.periodicity), ("Run", "daily"))
+        self.assertEqual(len(statements), 4)
+        self.tracker.conn.set_trace_callback(None)
+
+        first = self.tracker.list_habits(limit=3)
+        self.assertEqual([h.name for h in first], ["Read", "Swim", "Read aloud"])
+        self.assertEqual([h.name for h in self.tracker.list_habits(limit=3, after_id=first[-1].id)], ["Run"])
+        self.assertEqual([h.name for h in self.tracker.list_habits(name="read")], ["Read", "Read aloud"])
+        self.assertEqual([h.name for h in self.tracker.list_habits(name="R", periodicity="daily", limit=2)],
+                         ["Read", "Read aloud"])
+        self.assertEqual([h.name for h in self.tracker.list_habits(name="%")], [])
+        today = date.today()
+        self.assertEqual(len(self.tracker.list_habits(created_from=today, created_to=today.isoformat())), 4)
+        self.assertEqual(self.tracker.list_habits(created_to=today - timedelta(days=1)), [])
+        self.assertEqual(self.tracker.list_habits(created_from="yesterday"), [])
+
+    def test_completion_rollups(self):
+        """Test the weekly and monthly completion rates and the heatmap read from the rollups"""
+        self.tracker.add_habit(Habit("Read", "daily", self.tracker.current_user.id))
+        self.tracker.add_habit(Habit("Swim", "weekly", self.tracker.current_user.id))
+        monday = date.today() - timedelta(days=date.today().weekday())
+        rows = [("Read", monday - timedelta(days=i)) for i in range(1, 11)]
+        rows += [("Swim", monday - timedelta(days=3)), ("Swim", monday - timedelta(days=2))]
+        self.tracker.bulk_import(rows)
+        self.tracker.complete_habit("Read")
+
+        statements = []
+        self.tracker.conn.set_trace_callback(statements.append)
+        series = self.tracker.completion_rates(start=monday - timedelta(weeks=2), end=date.today())
+        self.assertEqual(len(statements), 2)
+        self.tracker.conn.set_trace_callback(None)
+        self.assertNoTableScans(statements)
+        self.assertEqual([week["completions"] for week in series], [3, 8, 1])
+        self.assertEqual([week["expected"] for week in series], [3, 8, 2])
+        self.assertEqual(series[1]["start"], (monday - timedelta(weeks=1)).isoformat())
+        self.assertEqual(series[1]["bucket"], "{}-W{:02d}".format(*(monday - timedelta(weeks=1)).isocalendar()[:2]))
+
+        reads = self.tracker.completion_rates("Read", kind="month", start=monday - timedelta(days=10))
+        self.assertEqual(sum(month["completions"] for month in reads), 11)
+        self.assertEqual(reads[0]["start"], (monday - timedelta(days=10)).replace(day=1).isoformat())
+        heatmap = self.tracker.completion_heatmap(start=monday - timedelta(days=3), end=monday)
+        self.assertEqual(list(heatmap.values()), [2, 2, 1, int(monday == date.today())])
+        self.assertEqual(len(self.tracker.completion_heatmap()), 365)
+        self.assertEqual(self.tracker.completion_rates("Unknown"), [])
+        self.assertEqual(self.tracker.completion_rates(end="not a date"), [])
+        self.assertEqual(self.tracker.completion_heatmap(end="not a date"), {})
+
+        rollups_sql = "SELECT habit_id, kind, bucket, completions FROM completion_rollups ORDER BY 1, 2, 3"
+        incremental = self.tracker.conn.execute(rollups_sql).fetchall()
+        rollups.rebuild_rollups(self.tracker.conn)
+        self.assertEqual(self.tracker.conn.execute(rollups_sql).fetchall(), incremental)
+        self.tracker.delete_habit("Swim")
+        self.assertEqual({row[0] for row in self.tracker.conn.execute(rollups_sql)}, {1})
+
+    def test_due_habits_and_reminders(self):
+        """Test listing due and overdue habits and emitting reminders in due order"""
+        for name, periodicity in [("Read", "daily"), ("Swim", "weekly"), ("Walk", "daily")]:
+            self.tracker.add_habit(Habit(name, periodicity, self.tracker.current_user.id))
+        today = date.today()
+        self.tracker.bulk_import([("Read", today - timedelta(days=1)), ("Swim", today - timedelta(weeks=1)),
+                                  ("Walk", today - timedelta(days=3))])
+        self.tracker.complete_habit("Read")
+
+        statements = []
+        self.tracker.conn.set_trace_callback(statements.append)
+        due = self.tracker.due_habits()
+        overdue = self.tracker.due_habits(all_users=True, overdue=True)
+        self.tracker.conn.set_trace_callback(None)
+        self.assertNoTableScans(statements)
+        self.assertEqual(sorted(habit["habit"] for habit in due), ["Swim", "Walk"])
+        self.assertEqual([(habit["habit"], habit["due"]) for habit in overdue],
+                         [("Walk", (today - timedelta(days=2)).isoformat())])
+        self.assertEqual(self.tracker.due_habits(limit=1), sorted(due, key=lambda habit: habit["due"])[:1])
+
+        emitted = []
+        scheduler = self.tracker.reminder_scheduler(emitted.append, hour=9)
+        at = lambda day, hour: datetime.combine(day, datetime.min.time()).replace(hour=hour).timestamp()
+        self.assertEqual(sorted(habit["habit"] for habit in scheduler.tick(at(today, 10))), ["Swim", "Walk"])
+        self.assertEqual(scheduler.tick(at(today, 11)), [])
+        self.tracker.complete_habit("Walk")
+        self.tracker.add_habit(Habit("Yoga", "daily", self.tracker.current_user.id))
+        self.tracker.add_habit(Habit("Stretch", "daily", self.tracker.current_user.id))
+        self.tracker.delete_habit("Stretch")
+        self.assertEqual([habit["habit"] for habit in scheduler.tick(at(today, 12))], ["Yoga"])
+        self.assertEqual(scheduler.tick(at(today + timedelta(days=1), 8)), [])
+        tomorrow = [habit["habit"] for habit in scheduler.tick(at(today + timedelta(days=1), 9))]
+        self.assertEqual(sorted(tomorrow), sorted(["Read", "Walk", "Yoga"] + ["Swim"] * (today.weekday() == 6)))
+        self.assertEqual(len(emitted), 3 + len(tomorrow))
+
+    def test_password_hashing_and_tokens(self):
+        """Test that passwords are stored hashed, upgraded on login, and that tokens expire"""
+        stored = self.tracker.conn.execute("SELECT password FROM users WHERE username = 'testuser'").fetchone()[0]
+        self.assertTrue(stored.startswith("pbkdf2_sha256$1000$"))
+        self.assertFalse(self.tracker.login_user("testuser", "wrong"))
+        with self.tracker.conn:
+            self.tracker.conn.execute("INSERT INTO users (username, password, created_at) VALUES ('old', 'pw', '2024-01-01')")
+        self.assertTrue(self.tracker.login_user("old", "pw"))
+        upgraded = self.tracker.conn.execute("SELECT password FROM users WHERE username = 'old'").fetchone()[0]
+        self.assertTrue(passwords.verify_password("pw", upgraded))
+        self.assertFalse(passwords.needs_rehash(upgraded))
+        self.assertTrue(passwords.needs_rehash(upgraded, iterations=2000))
+
+        token = self.tracker.issue_token()
+        self.tracker.logout_user()
+        self.assertTrue(self.tracker.login_with_token(token))
+        self.assertEqual(self.tracker.current_user.username, "old")
+        self.assertTrue(self.tracker.revoke_token(token))
+        self.assertFalse(self.tracker.login_with_token(token))
+
+        now = [0.0]
+        tokens = TokenCache(ttl=10, max_entries=2, clock=lambda: now[0])
+        first, second = tokens.issue(1, "a"), tokens.issue(2, "b")
+        self.assertEqual(tokens.get(first), (1, "a"))
+        tokens.issue(3, "c")
+        self.assertIsNone(tokens.get(first))
+        now[0] = 10.0
+        self.assertIsNone(tokens.get(second))
+        self.assertEqual(tokens.stats()["expired"], 1)
+
+    def test_password_pool(self):
+        """Test hashing and verifying passwords in worker processes"""
+        tracker = HabitTracker(':memory:')
+        try:
+            tracker.enable_password_pool(workers=1)
+            tracker.create_user("pool", "secret")
+            self.assertTrue(tracker.login_user("pool", "secret"))
+            self.assertFalse(tracker.login_user("pool", "guess"))
+        finally:
+            tracker.close()
+        self.assertIsNone(tracker.password_hasher)
+
+    def test_batch_operations(self):
+        """Test creating users, adding habits and completing them in batches"""
+        result = self.tracker.create_users([("ann", "pw1"), ("bob", "pw2"), ("testuser", "x"), ("ann", "pw3")])
+        self.assertEqual(result, {"created": ["ann", "bob"], "taken": ["testuser", "ann"]})
+        self.assertTrue(self.tracker.login_user("bob", "pw2"))
+        self.assertFalse(self.tracker.login_user("ann", "pw3"))
+
+        self.tracker.login_user("ann", "pw1")
+        user_id = self.tracker.current_user.id
+        result = self.tracker.add_habits([Habit("Read", "daily", user_id), Habit("Swim", "weekly", user_id),
+                                          Habit("Read", "daily", user_id)])
+        self.assertEqual(result, {"added": ["Read", "Swim"], "existing": ["Read"]})
+        today = date.today()
+        for days_ago in (2, 1, 0):
+            self.tracker.complete_habits(["Read", "Swim"], today - timedelta(days=days_ago))
+        result = self.tracker.complete_habits(["Read", "Walk"])
+        self.assertEqual(result, {"completed": 0, "duplicates": 1, "unknown": ["Walk"]})
+        self.assertIsNone(self.tracker.complete_habits(["Read"], "yesterday"))
+        self.assertEqual([row[1:] for row in self.tracker.compute_streaks()],
+                         [("Read", "daily", 3, 3), ("Swim", "weekly", 1, 1)])
+
     def test_get_habits_by_periodicity(self):
         """Test filtering habits by periodicity"""
         daily_habit = Habit("Run", "daily", self.tracker.current_user.id)
@@ -94,5 +647,762 @@ class TestHabitTracker(unittest.TestCase):
         self.assertNotIn("Swim", daily_habits)
 
 
+
+class TestMigrations(unittest.TestCase):
+    def setUp(self):
+        """Create a temporary database file for each test"""
+        handle, self.path = tempfile.mkstemp(suffix=".db")
+        os.close(handle)
+
+    def tearDown(self):
+        """Remove the temporary database file"""
+        os.remove(self.path)
+
+    def test_habits_survive_restart(self):
+        """Test that reopening the database keeps habits and only migrates once"""
+        tracker = HabitTracker(self.path)
+        tracker.create_user("alice", "secret")
+        tracker.login_user("alice", "secret")
+        tracker.add_habit(Habit("Read", "daily", tracker.current_user.id))
+        tracker.complete_habit("Read")
+        tracker.conn.close()
+
+        tracker = HabitTracker(self.path)
+        tracker.login_user("alice", "secret")
+        self.assertEqual([h.name for h in tracker.get_user_habits()], ["Read"])
+        self.assertEqual(migrations.schema_version(tracker.conn), migrations.SCHEMA_VERSION)
+        self.assertEqual(migrations.migrate(tracker.conn), [])
+        tracker.conn.close()
+
+    def test_upgrade_legacy_database(self):
+        """Test migrating a database written before schema versioning"""
+        conn = sqlite3.connect(self.path)
+        conn.executescript("""
+            CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT UNIQUE NOT NULL,
+                                password TEXT NOT NULL, created_at TEXT NOT NULL);
+            CREATE TABLE habits (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, periodicity TEXT NOT NULL,
+                                 created_at TEXT NOT NULL, user_id INTEGER NOT NULL);
+            CREATE TABLE completions (habit_id INTEGER, completion_date TEXT);
+            INSERT INTO users VALUES (1, 'bob', 'pw', '2024-01-01');
+            INSERT INTO habits VALUES (1, 'Walk', 'daily', '2024-01-01', 1);
+            INSERT INTO habits VALUES (2, 'Walk', 'daily', '2024-01-02', 1);
+            INSERT INTO completions VALUES (1, '2024-01-01');
+            INSERT INTO completions VALUES (2, '2024-01-02');
+            INSERT INTO completions VALUES (1, '2024-01-03');
+        """)
+        self.assertEqual(len(migrations.migrate(conn)), migrations.SCHEMA_VERSION)
+        self.assertEqual(conn.execute("SELECT id, name FROM habits").fetchall(), [(1, "Walk")])
+        self.assertEqual(conn.execute("SELECT id, habit_id, day FROM completions ORDER BY id").fetchall(),
+                         [(1, 1, 738886), (2, 1, 738887), (3, 1, 738888)])
+        self.assertEqual(conn.execute("SELECT longest_streak, total_completions FROM habit_streaks").fetchall(),
+                         [(3, 3)])
+        self.assertTrue(passwords.verify_password("pw", conn.execute("SELECT password FROM users").fetchone()[0]))
+        self.assertNotEqual(conn.execute("SELECT password FROM users").fetchone()[0], "pw")
+        conn.close()
+
+    def test_day_ordinal_migration_keeps_periods(self):
+        """Test that text dates become day ordinals with the week number for weekly habits"""
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA user_version = 3")
+        migrations.MIGRATIONS[0](conn)
+        migrations.MIGRATIONS[1](conn)
+        migrations.MIGRATIONS[2](conn)
+        conn.executescript("""
+            INSERT INTO users VALUES (1, 'dana', 'pw', '2024-01-01');
+            INSERT INTO habits VALUES (1, 'Swim', 'weekly', '2024-01-01', 1);
+            INSERT INTO completions (habit_id, completion_date) VALUES (1, '2024-01-07');
+            INSERT INTO completions (habit_id, completion_date) VALUES (1, '2024-01-08');
+            INSERT INTO completions (habit_id, completion_date) VALUES (1, 'garbage');
+        """)
+        conn.commit()
+        self.assertEqual(migrations.migrate(conn), ["store_day_ordinals", "create_run_table", "deduplicate_completions", "create_rollup_table", "add_next_due", "hash_passwords", "create_shard_tables", "create_shard_map_version"])
+        rows = conn.execute("SELECT day, period FROM completions ORDER BY day").fetchall()
+        sunday, monday = date(2024, 1, 7).toordinal(), date(2024, 1, 8).toordinal()
+        self.assertEqual(rows, [(sunday, (sunday - 1) // 7), (monday, (monday - 1) // 7)])
+        self.assertEqual(rows[1][1] - rows[0][1], 1)
+        self.assertEqual(conn.execute("SELECT longest_streak, last_day FROM habit_streaks").fetchone(), (2, monday))
+        conn.close()
+
+
+    def test_duplicate_completions_are_removed(self):
+        """Test that upgrading keeps the first completion of a habit per day"""
+        conn = sqlite3.connect(self.path)
+        for migration in migrations.MIGRATIONS[:5]:
+            migration(conn)
+        conn.executescript("""
+            PRAGMA user_version = 5;
+            INSERT INTO users VALUES (1, 'fay', 'pw', '2024-01-01');
+            INSERT INTO habits VALUES (1, 'Walk', 'daily', '2024-01-01', 1);
+            INSERT INTO completions (habit_id, day, period) VALUES (1, 738886, 738886), (1, 738886, 738886),
+                                                                   (1, 738887, 738887), (1, 738886, 738886);
+        """)
+        self.assertEqual(migrations.migrate(conn), ["deduplicate_completions", "create_rollup_table", "add_next_due", "hash_passwords", "create_shard_tables", "create_shard_map_version"])
+        self.assertEqual(conn.execute("SELECT id, day FROM completions ORDER BY id").fetchall(),
+                         [(1, 738886), (3, 738887)])
+        self.assertEqual(conn.execute("SELECT longest_streak, total_completions FROM habit_streaks").fetchone(), (2, 2))
+        with self.assertRaises(sqlite3.IntegrityError):
+            conn.execute("INSERT INTO completions (habit_id, day, period) VALUES (1, 738887, 738887)")
+        conn.close()
+
+
+class TestRunStorage(unittest.TestCase):
+    def setUp(self):
+        """Create a tracker with a daily and a weekly habit that have histories with gaps"""
+        self.tracker = HabitTracker(':memory:')
+        self.tracker.create_user("erin", "pw")
+        self.tracker.login_user("erin", "pw")
+        self.tracker.add_habit(Habit("Read", "daily", self.tracker.current_user.id))
+        self.tracker.add_habit(Habit("Swim", "weekly", self.tracker.current_user.id))
+        self.today = date.today()
+        rows = [("Read", self.today - timedelta(days=i)) for i in list(range(1, 6)) + list(range(8, 20)) + [3]]
+        rows += [("Swim", self.today - timedelta(weeks=i)) for i in (0, 1, 3)]
+        self.tracker.bulk_import(rows)
+
+    def tearDown(self):
+        self.tracker.close()
+
+    def test_record_period_extends_and_merges_runs(self):
+        """Test that a new period extends, bridges or starts runs, and a covered one changes nothing"""
+        conn = self.tracker.conn
+        for period in (10, 11, 14, 13):
+            self.assertTrue(runs.record_period(conn, 1, period))
+        self.assertFalse(runs.record_period(conn, 1, 11))
+        self.assertTrue(runs.record_period(conn, 1, 12))
+        self.assertEqual(conn.execute("SELECT start, length FROM completion_runs WHERE habit_id = 1").fetchall(),
+                         [(10, 5)])
+        self.assertEqual(runs.to_runs([5, 3, 4, 4, 9]), [(3, 3), (9, 1)])
+
+    def test_streaks_and_view_survive_conversion(self):
+        """Test converting to runs and back keeps streaks and the completions seen through the view"""
+        streaks_before = self.tracker.get_streaks()
+        self.assertEqual(self.tracker.set_completion_storage("runs"), True)
+        self.assertEqual(self.tracker.set_completion_storage("runs"), False)
+        conn = self.tracker.conn
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM completion_runs").fetchone()[0], 4)
+        self.assertEqual(self.tracker.get_streaks(), streaks_before)
+        self.assertEqual([row[3:] for row in self.tracker.compute_streaks()], [row[2:] for row in streaks_before])
+        self.assertEqual(self.tracker.rebuild_streaks(check_only=True), [])
+
+        read_days = [day for (day,) in conn.execute("""
+            SELECT day FROM completions WHERE habit_id = 1 ORDER BY day
+        """)]
+        self.assertEqual(read_days, self.tracker.get_habit("Read").completed_days.tolist())
+        self.assertEqual(len(read_days), 17)
+        self.assertEqual({day % 7 for (day,) in conn.execute("SELECT day FROM completions WHERE habit_id = 2")}, {1})
+
+        # Completing twice today records one period; deleting through the view splits a run
+        self.assertTrue(self.tracker.complete_habit("Read"))
+        self.assertTrue(self.tracker.complete_habit("Read"))
+        self.assertEqual(self.tracker.get_habit_streak("Read"), (6, 12))
+        conn.execute("DELETE FROM completions WHERE habit_id = 1 AND day = ?", ((self.today - timedelta(days=12)).toordinal(),))
+        conn.commit()
+        self.tracker.rebuild_streaks()
+        self.assertEqual(self.tracker.get_habit_streak("Read"), (6, 7))
+
+        self.assertTrue(self.tracker.set_completion_storage("rows"))
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM completion_runs").fetchone()[0], 0)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM completions WHERE habit_id = 1").fetchone()[0], 17)
+        self.assertEqual(self.tracker.get_habit_streak("Read"), (6, 7))
+
+    def test_run_storage_paths_skip_the_view(self):
+        """Test that the tracker's own queries read completion_runs, never the expanding completions view"""
+        self.tracker.set_completion_storage("runs")
+        statements = []
+        self.tracker.conn.set_trace_callback(statements.append)
+        self.tracker.complete_habit("Read")
+        self.tracker.complete_habits(["Swim"], self.today - timedelta(weeks=5))
+        [habit.completed_days for habit in self.tracker.get_user_habits()]
+        self.tracker.get_streaks()
+        self.tracker.compute_streaks(all_users=True)
+        self.tracker.rebuild_streaks(check_only=True)
+        self.tracker.completion_heatmap("Read", start=self.today - timedelta(days=30))
+        self.tracker.bulk_import([("Read", self.today - timedelta(days=40))])
+        self.tracker.due_habits()
+        list(self.tracker.export_completions())
+        self.tracker.delete_habit("Swim")
+        self.tracker.conn.set_trace_callback(None)
+        view_reads = [sql for sql in statements if re.search(r"(FROM|JOIN)\s+completions\b", sql)]
+        self.assertEqual(view_reads, [])
+        self.tracker.set_completion_storage("rows")
+        self.assertEqual(self.tracker.get_habit("Read").completed_days.tolist()[-1], self.today.toordinal())
+
+    def test_writes_under_run_storage(self):
+        """Test that bulk imports merge into runs and deletes drop a habit's runs"""
+        self.tracker.set_completion_storage("runs")
+        self.tracker.bulk_import([("Read", self.today - timedelta(days=i)) for i in (0, 6, 7)])
+        self.assertEqual(self.tracker.get_habit_streak("Read"), (20, 20))
+        self.assertEqual(self.tracker.conn.execute("""
+            SELECT start, length FROM completion_runs WHERE habit_id = 1
+        """).fetchall(), [(self.today.toordinal() - 19, 20)])
+        heatmap = self.tracker.completion_heatmap("Swim", start=self.today - timedelta(weeks=4))
+        self.assertEqual(sum(heatmap.values()), 3)
+        middle = self.tracker.completion_heatmap("Read", start=self.today - timedelta(days=9), end=self.today - timedelta(days=5))
+        self.assertEqual(list(middle.values()), [1] * 5)
+        rollups_sql = "SELECT * FROM completion_rollups ORDER BY habit_id, kind, bucket"
+        incremental = self.tracker.conn.execute(rollups_sql).fetchall()
+        with self.tracker.conn:
+            rollups.rebuild_rollups(self.tracker.conn)
+        self.assertEqual(self.tracker.conn.execute(rollups_sql).fetchall(), incremental)
+        self.tracker.delete_habit("Read")
+        self.assertEqual(self.tracker.conn.execute("SELECT COUNT(*) FROM completion_runs WHERE habit_id = 1").fetchone()[0], 0)
+        self.tracker.delete_all_habits()
+        self.assertEqual(self.tracker.conn.execute("SELECT COUNT(*) FROM completions").fetchone()[0], 0)
+
+
+class TestConcurrentSessions(unittest.TestCase):
+    def setUp(self):
+        """Create a tracker on a temporary database file shared by several threads"""
+        self.directory = tempfile.mkdtemp()
+        self.tracker = HabitTracker(os.path.join(self.directory, "habits.db"))
+
+    def tearDown(self):
+        """Close all pooled connections and remove the database files"""
+        self.tracker.close()
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+    def test_threads_have_their_own_session_and_connection(self):
+        """Test that concurrent users complete habits without sharing a user or a connection"""
+        errors = []
+        connections = set()
+
+        def session(number):
+            try:
+                username = f"user{number}"
+                self.tracker.create_user(username, "pw")
+                self.tracker.login_user(username, "pw")
+                connections.add(id(self.tracker.conn))
+                self.tracker.add_habit(Habit("Read", "daily", self.tracker.current_user.id))
+                for _ in range(5):
+                    self.tracker.complete_habit("Read")
+                    self.assertEqual(self.tracker.current_user.username, username)
+                self.assertEqual(self.tracker.get_habit_streak("Read"), (1, 1))
+            except Exception as error:  # Collected so the main thread can fail the test
+                errors.append(error)
+
+        threads = [threading.Thread(target=session, args=(number,)) for number in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(connections), 8)
+        self.assertIsNone(self.tracker.current_user)
+        self.assertEqual(self.tracker.conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        count = self.tracker.conn.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+        self.assertEqual(count, 8)
+
+    def test_session_restores_previous_user(self):
+        """Test that a session block does not leak its user into the caller"""
+        self.tracker.create_user("carol", "pw")
+        with self.tracker.session():
+            self.tracker.login_user("carol", "pw")
+            self.assertEqual(self.tracker.current_user.username, "carol")
+        self.assertIsNone(self.tracker.current_user)
+
+    def test_shared_memory_connection_serializes_transactions(self):
+        """Test that threads sharing an in-memory connection can't roll back each other's work"""
+        pool = ConnectionPool(':memory:')
+        pool.connection().execute("CREATE TABLE t (x INTEGER)")
+        inside, release = threading.Event(), threading.Event()
+
+        def commit():
+            with pool.connection() as conn:
+                conn.execute("INSERT INTO t VALUES (1)")
+                inside.set()
+                release.wait(5)
+
+        def roll_back():
+            try:
+                with pool.connection() as conn:
+                    conn.execute("INSERT INTO t VALUES (2)")
+                    raise RuntimeError("rolled back")
+            except RuntimeError:
+                pass
+
+        first, second = threading.Thread(target=commit), threading.Thread(target=roll_back)
+        first.start()
+        inside.wait(5)
+        second.start()
+        second.join(0.2)
+        self.assertTrue(second.is_alive())  # Waits for the first transaction
+        release.set()
+        first.join()
+        second.join()
+        self.assertEqual(pool.connection().execute("SELECT x FROM t").fetchall(), [(1,)])
+        pool.close()
+
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        """Create a server over a tracker on a temporary database file"""
+        self.directory = tempfile.mkdtemp()
+        self.tracker = HabitTracker(os.path.join(self.directory, "habits.db"))
+        self.server = HabitServer(self.tracker, workers=4)
+
+    def tearDown(self):
+        """Stop the workers, close the connections and remove the database files"""
+        self.server.close()
+        self.tracker.close()
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+    def run_against_server(self, scenario):
+        """Start the server on a free port, run scenario(port) and return its result"""
+        async def main():
+            listener = await asyncio.start_server(self.server.handle_connection, "127.0.0.1", 0)
+            port = listener.sockets[0].getsockname()[1]
+            async with listener:
+                return await scenario(port)
+        return asyncio.run(main())
+
+    def test_json_api(self):
+        """Test the register/add/complete/analyze/delete flow over HTTP"""
+        async def scenario(port):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            alice = ("alice", "pw")
+            responses = [
+                await send_request(reader, writer, "POST", "/register", {"username": "alice", "password": "pw"}),
+                await send_request(reader, writer, "POST", "/login", {}, ("alice", "wrong")),
+                await send_request(reader, writer, "POST", "/habits", {"name": "Read", "periodicity": "daily"}, alice),
+                await send_request(reader, writer, "POST", "/complete", {"name": "Read"}, alice),
+                await send_request(reader, writer, "POST", "/complete", {"name": "Nope"}, alice),
+                await send_request(reader, writer, "GET", "/analyze", None, alice),
+                await send_request(reader, writer, "POST", "/delete", {"name": "Read"}, alice),
+                await send_request(reader, writer, "GET", "/habits", None, alice),
+                await send_request(reader, writer, "POST", "/habits", {"name": "Walk", "periodicity": "weekly"}, alice),
+                await send_request(reader, writer, "POST", "/habits", {"name": "Swim", "periodicity": "weekly"}, alice),
+                await send_request(reader, writer, "GET", "/habits?periodicity=weekly&limit=1", None, alice),
+                await send_request(reader, writer, "GET", "/habits?limit=x", None, alice),
+            ]
+            responses.append(await send_request(reader, writer, "GET",
+                                                f"/habits?limit=1&after={responses[-2][1]['next_after']}", None, alice))
+            responses.append(await send_request(reader, writer, "GET", "/progress?kind=month", None, alice))
+            responses.append(await send_request(reader, writer, "GET", "/heatmap?habit=Nope", None, alice))
+            responses.append(await send_request(reader, writer, "GET", "/due", None, alice))
+            responses.append(await send_request(reader, writer, "POST", "/login", {}, alice))
+            responses.append(await send_request(reader, writer, "GET", "/habits", None, responses[-1][1]["token"]))
+            responses.append(await send_request(reader, writer, "GET", "/habits", None, "not-a-token"))
+            token = responses[-3][1]["token"]
+            responses.append(await send_request(reader, writer, "POST", "/logout", {}, token))
+            responses.append(await send_request(reader, writer, "GET", "/habits", None, token))
+            responses.append(await send_request(reader, writer, "POST", "/logout", {}, alice))
+            writer.close()
+            return responses
+
+        responses = self.run_against_server(scenario)
+        self.assertEqual([status for status, _ in responses], [201, 401, 201, 200, 404, 200, 200, 200, 201, 201, 200, 400, 200, 200, 404, 200, 200, 200, 401, 200, 401, 400])
+        self.assertEqual(responses[3][1]["current_streak"], 1)
+        self.assertEqual(responses[5][1]["longest"], {"habit": "Read", "streak": 1})
+        self.assertEqual(responses[7][1], {"habits": []})
+        self.assertEqual([habit["name"] for habit in responses[10][1]["habits"]], ["Walk"])
+        self.assertEqual([habit["name"] for habit in responses[12][1]["habits"]], ["Swim"])
+        self.assertEqual(len(responses[13][1]["series"]), 12)
+        self.assertEqual(sorted(habit["habit"] for habit in responses[15][1]["habits"]), ["Swim", "Walk"])
+        self.assertEqual(len(responses[17][1]["habits"]), 2)
+        self.assertEqual(responses[19][1], {"username": "alice"})
+        self.assertIsNone(self.tracker.current_user)
+
+    def test_errors_get_a_response(self):
+        """Test that malformed requests and failing handlers are answered instead of dropping the connection"""
+        async def raw(port, request):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(request)
+            await writer.drain()
+            status_line = await reader.readline()
+            writer.close()
+            return int(status_line.split()[1])
+
+        async def scenario(port):
+            statuses = [
+                await raw(port, b"GARBAGE\r\n\r\n"),
+                await raw(port, b"POST /register HTTP/1.1\r\nContent-Length: ten\r\n\r\n"),
+                await raw(port, b"POST /register HTTP/1.1\r\nContent-Length: 99999999999\r\n\r\n"),
+                await raw(port, b"GET /habits HTTP/1.1\r\nX-Padding: " + b"x" * 70000 + b"\r\n\r\n"),
+            ]
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            with unittest.mock.patch.object(self.tracker, "get_user_habits",
+                                            side_effect=sqlite3.OperationalError("database is locked")):
+                with redirect_stderr(io.StringIO()):
+                    statuses.append(await send_request(reader, writer, "GET", "/habits", None, ("bob", "pw")))
+            # The connection stays usable after a handler failed
+            statuses.append(await send_request(reader, writer, "POST", "/register", {"username": "bob", "password": "pw"}))
+            writer.close()
+            return statuses
+
+        with unittest.mock.patch.object(self.tracker, "login_user", return_value=True):
+            statuses = self.run_against_server(scenario)
+        self.assertEqual(statuses[:4], [400, 400, 413, 431])
+        self.assertEqual(statuses[4], (500, {"error": "Internal server error."}))
+        self.assertEqual(statuses[5][0], 201)
+
+    def test_load_generator(self):
+        """Test that the load generator runs concurrent clients without errors and reports latency"""
+        result = self.run_against_server(lambda port: run_load("127.0.0.1", port, clients=5, requests_per_client=6))
+        self.assertEqual((result["requests"], result["failures"]), (30, 0))
+        self.assertIn("p95_ms", result)
+        self.assertEqual(self.server.stats.counts["POST /complete"], 15)
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_run_scale_reports_every_operation(self):
+        """Test that a small benchmark run generates data and times every operation"""
+        directory = tempfile.mkdtemp()
+        result = benchmark.run_scale("unit", users=4, habits_per_user=3, days=60, samples=2, directory=directory)
+        os.rmdir(directory)
+        self.assertEqual((result["users"], result["habits"]), (4, 12))
+        self.assertGreater(result["completions"], 0)
+        self.assertEqual(set(result["operations"]), set(benchmark.OPERATIONS))
+        self.assertEqual(result["operations"]["get_longest_streak"]["calls"], 2)
+
+    def test_temporary_directories_are_removed(self):
+        """Test that benchmarks run without a directory leave no temporary directory behind"""
+        leftovers = lambda: {name for name in os.listdir(tempfile.gettempdir()) if name.startswith("habit-bench-")}
+        before = leftovers()
+        benchmark.run_scale("unit", users=2, habits_per_user=2, days=10, samples=1)
+        benchmark.login_throughput(pool_sizes=(0,), logins=2, threads=2)
+        self.assertEqual(leftovers(), before)
+
+    def test_memory_footprint(self):
+        """Test that slotted habits hold a completion in four bytes, several times less than before"""
+        dict_dates, slots_array = benchmark.memory_footprint(completions=20000, habits=100)
+        self.assertEqual(slots_array["completions"], 20000)
+        self.assertAlmostEqual(slots_array["bytes_per_completion"], 4, delta=0.5)
+        self.assertGreater(dict_dates["bytes_per_completion"], 5 * slots_array["bytes_per_completion"])
+
+    def test_compare_flags_regressions(self):
+        """Test that a slower mean latency beyond the threshold is reported"""
+        def document(mean):
+            return {"results": [{"scale": "tiny", "operations": {"add_habit": {"mean_ms": mean}}}]}
+        self.assertEqual(benchmark.compare(document(1.0), document(1.1)), [])
+        self.assertEqual(len(benchmark.compare(document(1.0), document(1.5))), 1)
+
+
+class TestAnalytics(unittest.TestCase):
+    def setUp(self):
+        """Generate a small multi-user database file"""
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "analytics.db")
+        self.tracker = HabitTracker(self.path)
+        benchmark.generate_dataset(self.tracker, users=12, habits_per_user=4, days=90, seed=3)
+
+    def tearDown(self):
+        self.tracker.close()
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+    def test_sharded_report_matches_single_process(self):
+        """Test that shards analyzed by worker processes merge into the same report"""
+        parallel = self.tracker.leaderboard(top=5, workers=2)
+        single = analytics.run_report(conn=self.tracker.conn, top=5, workers=1, shards=1)
+        for key in ("seconds", "workers", "shards"):
+            parallel.pop(key), single.pop(key)
+        self.assertEqual(parallel, single)
+        self.assertEqual((parallel["users"], parallel["habits"]), (12, 48))
+        self.assertEqual(sum(parallel["rate_histogram"].values()), 12)
+
+        best = {}
+        for user_id, _, _, _, longest in self.tracker.compute_streaks(all_users=True):
+            best[user_id] = max(best.get(user_id, 0), longest)
+        leaders = parallel["leaderboard"]
+        self.assertEqual(len(leaders), 5)
+        self.assertEqual([user["longest_streak"] for user in leaders], sorted(best.values(), reverse=True)[:5])
+        self.assertEqual(best[leaders[0]["user_id"]], leaders[0]["longest_streak"])
+
+        self.tracker.set_completion_storage("runs")
+        runs_report = self.tracker.leaderboard(top=5, workers=1)
+        self.assertEqual(runs_report["leaderboard"], leaders)
+
+
+class TestBatchStreaks(unittest.TestCase):
+    def random_histories(self, seed):
+        """Build random habits with gaps and duplicate completions, as flat arrays"""
+        rng = random.Random(seed)
+        today = date(2024, 6, 15)
+        habits, habit_ids, days, weekly_ids = {}, [], [], set()
+        for habit_id in range(1, 40):
+            periodicity = rng.choice(["daily", "weekly"])
+            habit = Habit(f"Habit {habit_id}", periodicity, 1)
+            step = 7 if periodicity == "weekly" else 1
+            offset, history = rng.randint(0, 3), []
+            for _ in range(rng.randint(0, 60)):
+                offset += rng.choice([0, step, step, step, 2 * step, 3 * step])
+                history.append(today.toordinal() - offset)
+            rng.shuffle(history)
+            for day in history:
+                habit.add_completion(day)
+            self.assertEqual(list(habit.completed_days), sorted(history))
+            habits[habit_id] = habit
+            if periodicity == "weekly":
+                weekly_ids.add(habit_id)
+            habit_ids.extend([habit_id] * len(history))
+            days.extend(history)
+        return today, habits, habit_ids, days, weekly_ids
+
+    def check_kernel(self, use_numpy):
+        for seed in range(20):
+            today, habits, habit_ids, days, weekly_ids = self.random_histories(seed)
+            result = streaks.batch_streaks(habit_ids, days, weekly_ids, today, use_numpy=use_numpy)
+            expected = {
+                habit_id: (habit.current_streak(today), habit.streak())
+                for habit_id, habit in habits.items() if habit.completed_days
+            }
+            self.assertEqual(result, expected)
+
+    def test_python_kernel_matches_habit_streak(self):
+        """Test the pure Python batch kernel against Habit.streak() on random histories"""
+        self.check_kernel(use_numpy=False)
+
+    @unittest.skipIf(streaks.np is None, "NumPy is not installed")
+    def test_numpy_kernel_matches_habit_streak(self):
+        """Test the NumPy batch kernel against Habit.streak() on random histories"""
+        self.check_kernel(use_numpy=True)
+
+    def test_compute_streaks_on_tracker(self):
+        """Test computing streaks for one user and for the whole database"""
+        tracker = HabitTracker(":memory:")
+        today = datetime.now().date()
+        for username, count in (("erin", 3), ("finn", 5)):
+            tracker.create_user(username, "pw")
+            tracker.login_user(username, "pw")
+            tracker.add_habit(Habit("Read", "daily", tracker.current_user.id))
+            tracker.add_habit(Habit("Idle", "weekly", tracker.current_user.id))
+            tracker.bulk_import(("Read", today - timedelta(days=i)) for i in range(count))
+        self.assertEqual([row[1:] for row in tracker.compute_streaks()],
+                         [("Read", "daily", 5, 5), ("Idle", "weekly", 0, 0)])
+        everyone = tracker.compute_streaks(all_users=True)
+        self.assertEqual([(row[0], row[3]) for row in everyone], [(1, 3), (1, 0), (2, 5), (2, 0)])
+        tracker.close()
+
+
+class TestBatchCli(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "habits.db")
+
+    def tearDown(self):
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+    def run_cli(self, *argv, stdin=""):
+        """Run a command and return its exit code and the JSON objects it printed"""
+        output = io.StringIO()
+        with unittest.mock.patch("sys.stdin", io.StringIO(stdin)), redirect_stdout(output), \
+                redirect_stderr(io.StringIO()):
+            status = cli.run(["--db", self.path] + list(argv))
+        return status, [json.loads(line) for line in output.getvalue().splitlines()]
+
+    def test_commands_take_many_targets(self):
+        """Test the bulk subcommands with targets as arguments and on stdin"""
+        status, output = self.run_cli("user", "create", "--password", "pw", "ann", "bob", "ann")
+        self.assertEqual((status, output[0]["created"], output[0]["taken"]), (0, ["ann", "bob"], ["ann"]))
+        status, output = self.run_cli("habit", "add", "--user", "ann", "--password", "pw", stdin="Read\nWalk\n")
+        self.assertEqual(output[0]["added"], ["Read", "Walk"])
+        status, output = self.run_cli("complete", "--user", "ann", "--password", "pw", "Read", "Walk", "Nope")
+        self.assertEqual((status, output[0]["completed"], output[0]["unknown"]), (1, 2, ["Nope"]))
+        status, output = self.run_cli("streaks", "--user", "ann", "--password", "pw", "Read")
+        self.assertEqual(output[0]["streaks"], [
+            {"user_id": 1, "habit": "Read", "periodicity": "daily", "current": 1, "longest": 1}])
+
+    def test_batch_stream(self):
+        """Test that a command stream runs in order, merging consecutive lines of one call"""
+        self.run_cli("user", "create", "--password", "pw", "ann", "bob")
+        stream = "\n".join([
+            "habit add --user ann --password pw Read",
+            "habit add --user ann --password pw 'Drink Water'",
+            "# comments and blank lines are skipped",
+            "",
+        ] + [f"complete --user ann --password pw --date 2024-01-{day:02d} Read" for day in range(1, 11)] + [
+            "export --all",
+            "complete --user bob --password wrong Read",
+            "streaks --all",
+        ])
+        status, output = self.run_cli("batch", stdin=stream)
+        self.assertEqual(status, 1)
+        self.assertEqual(output[0]["added"], ["Read", "Drink Water"])
+        self.assertEqual(len(output), 14)
+        self.assertEqual([result["completed"] for result in output[1:]
+                          if result.get("command") == "complete"], [1] * 10)
+        self.assertIn("cannot be batched", output[-3]["error"])
+        self.assertEqual(output[-2]["error"], "invalid username or password")
+        self.assertEqual(output[-1]["streaks"][0]["longest"], 10)
+
+    def test_batch_reports_bad_quoting(self):
+        """Test that a line with an unbalanced quote is reported without losing the line before it"""
+        self.run_cli("user", "create", "--password", "pw", "ann")
+        stream = "\n".join([
+            "habit add --user ann --password pw Read",
+            'habit add --user ann --password pw "Walk',
+            "habit add --user ann --password pw Swim",
+        ])
+        status, output = self.run_cli("batch", stdin=stream)
+        self.assertEqual(status, 1)
+        self.assertEqual(output[0]["added"], ["Read"])
+        self.assertEqual(output[1], {"line": 2, "error": "invalid quoting: No closing quotation"})
+        self.assertEqual(output[2]["added"], ["Swim"])
+
+
+class TestSharding(unittest.TestCase):
+    def setUp(self):
+        """Create a database sharded over three files with six users"""
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "habits.db")
+        self.tracker = HabitTracker(self.path, shards=3)
+        today = datetime.now().date()
+        for number in range(1, 7):
+            self.tracker.create_user(f"user{number}", "pw")
+            self.tracker.login_user(f"user{number}", "pw")
+            self.tracker.add_habit(Habit("Read", "daily", self.tracker.current_user.id))
+            self.tracker.add_habit(Habit("Idle", "weekly", self.tracker.current_user.id))
+            self.tracker.bulk_import(("Read", today - timedelta(days=i)) for i in range(number))
+        self.tracker.logout_user()
+
+    def tearDown(self):
+        self.tracker.close()
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+    def longest_streaks(self):
+        return {row[0]: row[4] for row in self.tracker.compute_streaks(all_users=True) if row[1] == "Read"}
+
+    def test_users_are_spread_over_shards(self):
+        """Test that users live on different files and all-user operations cover every shard"""
+        info = self.tracker.shard_info()
+        self.assertEqual([(shard["shard"], shard["users"], shard["habits"]) for shard in info],
+                         [(0, 2, 4), (1, 2, 4), (2, 2, 4)])
+        self.assertTrue(os.path.exists(os.path.join(self.directory, "habits.shard2.db")))
+
+        self.assertEqual(self.longest_streaks(), {number: number for number in range(1, 7)})
+        report = self.tracker.leaderboard(top=3, workers=1)
+        self.assertEqual((report["users"], report["habits"], report["completions"]), (6, 12, 21))
+        self.assertEqual([user["username"] for user in report["leaderboard"]], ["user6", "user5", "user4"])
+        self.assertEqual(len(list(self.tracker.export_completions(all_users=True))), 21)
+        due = self.tracker.due_habits(all_users=True)
+        self.assertEqual(sorted(habit["username"] for habit in due), [f"user{n}" for n in range(1, 7)])
+        noon = datetime.combine(datetime.now().date(), datetime.min.time()).replace(hour=12).timestamp()
+        self.assertEqual(len(self.tracker.reminder_scheduler(remind=lambda habit: None).tick(noon)), 6)
+
+        # Reopening finds the shards, and each user works on their own
+        self.tracker.close()
+        self.tracker = HabitTracker(self.path)
+        self.assertTrue(self.tracker.login_user("user5", "pw"))
+        self.tracker.complete_habit("Idle")
+        self.assertEqual(len(self.tracker.get_user_habits()), 2)
+        self.assertFalse(self.tracker.login_user("user5", "wrong"))
+
+    def test_split_shard_moves_users_with_history(self):
+        """Test that splitting a shard moves half its users and keeps their streaks"""
+        self.tracker.set_completion_storage("runs")
+        result = self.tracker.split_shard(0)
+        self.assertEqual(result, {"shard": 3, "moved": 1})
+        self.assertEqual([shard["users"] for shard in self.tracker.shard_info()], [1, 2, 2, 1])
+        self.assertEqual(self.longest_streaks(), {number: number for number in range(1, 7)})
+        self.assertTrue(self.tracker.login_user("user6", "pw"))
+        self.assertEqual(self.tracker.get_longest_streak()[1], 6)
+        self.assertEqual(self.tracker.leaderboard(workers=1)["completions"], 21)
+        with self.assertRaises(ValueError):
+            self.tracker.split_shard(9)
+
+    def test_split_by_another_tracker_reroutes_users(self):
+        """Test that a tracker notices users moved by another one and follows them to their new shard"""
+        self.assertTrue(self.tracker.login_user("user6", "pw"))
+        self.assertEqual(len(self.tracker.get_user_habits()), 2)  # Caches the route and the habits
+        other = HabitTracker(self.path)
+        try:
+            self.assertEqual(other.split_shard(0)["shard"], 3)
+            self.assertEqual(other.router.shard_of(self.tracker.current_user.id), 3)
+            self.assertEqual([habit.name for habit in self.tracker.get_user_habits()], ["Read", "Idle"])
+            with redirect_stdout(io.StringIO()):
+                self.tracker.complete_habits(["Idle"])
+            self.assertEqual(self.tracker.conn.execute("PRAGMA database_list").fetchone()[2],
+                             os.path.join(self.directory, "habits.shard3.db"))
+            self.assertTrue(other.login_user("user6", "pw"))
+            self.assertEqual(other.get_habit_streak("Idle"), (1, 1))
+        finally:
+            other.close()
+
+class TestStorageBackends(unittest.TestCase):
+    def scenario(self, tracker):
+        """Run the same user, habit and completion operations and collect what the tracker reports"""
+        today = date.today()
+        with redirect_stdout(io.StringIO()):
+            tracker.create_users([("alice", "pw"), ("bob", "pw"), ("alice", "other")])
+            tracker.login_user("alice", "pw")
+            tracker.add_habits([Habit("Read", "daily", user_id=None), Habit("Gym", "weekly", user_id=None),
+                                Habit("Read", "daily", user_id=None)])
+            tracker.add_habit(Habit("Swim", "daily", user_id=None))
+            tracker.bulk_import([("Read", today - timedelta(days=offset)) for offset in (5, 4, 3, 1)])
+            tracker.complete_habit("Read")
+            tracker.complete_habits(["Gym", "Swim", "Nap"], today - timedelta(days=2))
+            tracker.complete_habits(["Swim"], today - timedelta(days=3))
+            tracker.delete_habit("Swim")
+            tracker.complete_habits(["Read"], today - timedelta(days=2))  # Backfill joins two runs
+            return {
+                "habits": [(habit.name, habit.periodicity, habit.completed_days.tolist())
+                           for habit in tracker.get_user_habits()],
+                "streaks": tracker.get_streaks(),
+                "longest": tracker.get_longest_streak(),
+                "habit_streak": tracker.get_habit_streak("Read"),
+                "batch_streaks": tracker.compute_streaks(all_users=True),
+                "drift": tracker.rebuild_streaks(check_only=True),
+                "weekly": tracker.get_habits_by_periodicity("weekly"),
+                "page": [habit.name for habit in tracker.list_habits(name="ea", created_to=today)],
+                "wrong_password": tracker.login_user("alice", "other"),
+                "bob": tracker.login_user("bob", "pw") and tracker.get_user_habits(),
+            }
+
+    def test_memory_backend_matches_sqlite(self):
+        """Test that both storage backends give the same results for the same operations"""
+        sqlite_tracker, memory_tracker = HabitTracker(':memory:'), HabitTracker(backend="memory")
+        try:
+            expected = self.scenario(sqlite_tracker)
+            self.assertEqual(self.scenario(memory_tracker), expected)
+        finally:
+            sqlite_tracker.close()
+            memory_tracker.close()
+        self.assertEqual(expected["habits"][0][2][-1] - expected["habits"][0][2][0], 5)
+        self.assertEqual(expected["longest"], ("Read", 6))
+        self.assertEqual(expected["batch_streaks"][0], (1, "Read", "daily", 6, 6))
+
+    def test_memory_transactions_roll_back(self):
+        """Test that a failing transaction leaves the memory backend as it was"""
+        tracker = HabitTracker(backend="memory")
+        tracker.create_user("alice", "pw")
+        tracker.login_user("alice", "pw")
+        tracker.add_habit(Habit("Read", "daily", user_id=None))
+        tracker.complete_habit("Read")
+        backend = tracker.storage
+        read = backend.find_habit(tracker.current_user.id, "Read")
+        before = (backend.habits(1), backend.completion_days(read[0], "daily"), backend.streak_state(read[0]))
+        yesterday = date.today().toordinal() - 1
+        with self.assertRaises(RuntimeError):
+            with backend.transaction():
+                backend.record_completion(read[0], "daily", yesterday)
+                backend.add_habit(1, "Walk", "weekly", date.today())
+                backend.delete_habit(read[0])
+                raise RuntimeError("failed halfway")
+        self.assertEqual((backend.habits(1), backend.completion_days(read[0], "daily"), backend.streak_state(read[0])), before)
+        self.assertEqual(tracker.rebuild_streaks(), [])
+        with self.assertRaises(TypeError):
+            storage.Storage()
+
+    def test_memory_backend_rejects_sql_features(self):
+        """Test that SQLite-only features fail clearly on the memory backend"""
+        tracker = HabitTracker(backend="memory")
+        with self.assertRaises(ValueError):
+            tracker.conn
+        with self.assertRaises(ValueError):
+            tracker.enable_sharding()
+        with self.assertRaises(ValueError):
+            HabitTracker(backend="memory", shards=2)
+        with self.assertRaises(ValueError):
+            HabitTracker(backend="postgres")
+
 if __name__ == "__main__":
     unittest.main()
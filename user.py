@@ -5,11 +5,14 @@ class User:
     """
     Represents a user in the Habit Tracking App.
     """
+    __slots__ = ("id", "username", "password", "created_at")
+
     def __init__(self, username, password):
         """
         Initialize a new user with a username, password, and creation date.
         """
+        self.id = None  # Set once the user is stored
         self.username = username
-        self.password = password  # In production, passwords should be hashed!
+        self.password = password  # The stored password hash (see passwords.py)
         self.created_at = datetime.now()
 
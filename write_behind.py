@@ -0,0 +1,181 @@
+import sqlite3
+import sys
+import threading
+import time
+
+# Longest wait, in seconds, between retries of a batch that failed on a transient error
+MAX_BACKOFF = 5.0
+
+
+class WriteBehindQueue:
+    """
+    Buffers writes and hands them to a flush callback in batches, so that many
+    writes share one transaction and one commit (group commit). A batch is flushed
+    as soon as max_batch items are waiting, by the thread adding the last one, or
+    once the oldest item has waited max_delay seconds, by a background thread.
+    Items are flushed in the order they were added. A batch failing on a transient error
+    (such as 'database is locked') is queued again and retried after a growing delay.
+    A batch failing on any other error is written again one item at a time, and the items
+    that still fail that way are dropped and reported on stderr, so that one bad item
+    can't hold back the ones queued after it.
+    """
+    def __init__(self, flush, max_batch=500, max_delay=0.05, transient=(sqlite3.OperationalError,)):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.transient = transient
+        self._flush = flush
+        self._pending = []
+        self._flushing = []
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.max_depth = self.flushes = self.flushed = self.failures = self.dropped = self.retries = 0
+        self._backoff = 0.0
+        self._retry_at = 0.0  # Until then the queue waits instead of retrying, see _requeue()
+        self.flush_seconds = self.max_flush_seconds = self.last_flush_seconds = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def put(self, item):
+        """
+        Queue one item, flushing right away if the batch is full.
+        """
+        with self._lock:
+            self._pending.append(item)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            self.max_depth = max(self.max_depth, len(self._pending))
+            full = len(self._pending) >= self.max_batch and time.monotonic() >= self._retry_at
+        if full:
+            try:
+                self.flush()
+            except self.transient as error:
+                # The item is queued and the background thread retries
+                print(f"Write-behind flush failed, will retry: {error}", file=sys.stderr)
+
+    def depth(self):
+        """
+        Return the number of items waiting to be flushed.
+        """
+        with self._lock:
+            return len(self._pending)
+
+    def queued(self):
+        """
+        Return the items not written yet: those waiting and those being flushed.
+        """
+        with self._lock:
+            return self._flushing + self._pending
+
+    def flush(self):
+        """
+        Write every queued item now. Returns the number of items written.
+        On a transient error the items are queued again and the error is raised. On
+        another error the batch is retried item by item and the items that fail again
+        are dropped (see stats()). An interrupt puts the batch back in the queue.
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending, self._oldest = self._pending, [], None
+                self._flushing = batch
+            if not batch:
+                return 0
+            started = time.perf_counter()
+            try:
+                try:
+                    self._flush(batch)
+                    written = len(batch)
+                except self.transient:
+                    self._requeue(batch)
+                    raise
+                except Exception:
+                    with self._lock:
+                        self.failures += 1
+                    written, retry, error = self._flush_one_by_one(batch)
+                    if retry:
+                        self._requeue(retry)
+                        raise error
+            except self.transient:
+                raise
+            except BaseException:
+                with self._lock:
+                    self._pending[:0] = batch
+                    self._oldest = self._oldest or time.monotonic()
+                raise
+            finally:
+                with self._lock:
+                    self._flushing = []
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self._backoff = self._retry_at = 0.0
+                self.flushes += 1
+                self.flushed += written
+                self.flush_seconds += elapsed
+                self.last_flush_seconds = elapsed
+                self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+            return written
+
+    def _flush_one_by_one(self, batch):
+        # Isolate the items that fail on their own. Returns how many were written, the
+        # items that hit a transient error and should be retried, and the last such error
+        written, retry, transient_error = 0, [], None
+        for item in batch:
+            try:
+                self._flush([item])
+                written += 1
+            except self.transient as error:
+                retry.append(item)
+                transient_error = error
+            except Exception as error:
+                with self._lock:
+                    self.dropped += 1
+                print(f"Write-behind dropped {item!r}: {error}", file=sys.stderr)
+        return written, retry, transient_error
+
+    def _requeue(self, items):
+        # Put items back at the front of the queue and wait longer before each retry
+        with self._lock:
+            self._pending[:0] = items
+            self._oldest = self._oldest or time.monotonic()
+            self.retries += 1
+            self._backoff = min(max(self._backoff * 2, self.max_delay), MAX_BACKOFF)
+            self._retry_at = time.monotonic() + self._backoff
+
+    def _run(self):
+        while not self._stop.wait(self.max_delay):
+            with self._lock:
+                now = time.monotonic()
+                due = self._oldest is not None and now - self._oldest >= self.max_delay and now >= self._retry_at
+            if due:
+                try:
+                    self.flush()
+                except self.transient as error:
+                    print(f"Write-behind flush failed, retrying in {self._backoff:.2f}s: {error}", file=sys.stderr)
+
+    def close(self):
+        """
+        Stop the background thread and flush what is left.
+        """
+        self._stop.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        return self.flush()
+
+    def stats(self):
+        """
+        Return the queue depth, flush counts and flush latency figures.
+        """
+        with self._lock:
+            return {
+                "depth": len(self._pending),
+                "max_depth": self.max_depth,
+                "flushes": self.flushes,
+                "flushed": self.flushed,
+                "failures": self.failures,
+                "dropped": self.dropped,
+                "retries": self.retries,
+                "mean_flush_ms": self.flush_seconds * 1000 / self.flushes if self.flushes else 0.0,
+                "last_flush_ms": self.last_flush_seconds * 1000,
+                "max_flush_ms": self.max_flush_seconds * 1000,
+            }